@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#
+#This file is part of Cosmonium.
+#
+#Copyright (C) 2018-2019 Laurent Deru.
+#
+#Cosmonium is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Cosmonium is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Cosmonium.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""Headless benchmark of the simulation pipeline.
+
+A universe is built from synthetic catalogs, or from the given SSC and STC files, without
+opening a window. A scripted camera path is replayed at a fixed date and the per frame time
+of each stage is collected by the frame profiler and written as a JSON report."""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import sys
+import os
+
+# Add lib/ directory to import path to be able to load the c++ libraries
+sys.path.insert(1, 'lib')
+# Add third-party/ directory to import path to be able to load the external libraries
+sys.path.insert(1, 'third-party')
+# CEFPanda and glTF modules aree not at top level
+sys.path.insert(1, 'third-party/cefpanda')
+sys.path.insert(1, 'third-party/gltf')
+
+from panda3d.core import LPoint3d, LVector3d, LQuaterniond, PandaSystem, look_at, loadPrcFileData
+
+from cosmonium.cosmonium import Cosmonium
+from cosmonium.celestia import ssc_parser
+from cosmonium.celestia import stc_parser
+from cosmonium.celestia import stream_parser
+from cosmonium.dircontext import defaultDirContext
+from cosmonium.astro import units
+from cosmonium.utils import get_rss
+from cosmonium import pstats
+from cosmonium import settings
+
+#import orbits and rotations elements to add them to the DB
+from cosmonium.astro.tables import uniform
+
+from math import asin, degrees
+from time import time
+import argparse
+import platform
+import tempfile
+import random
+import json
+
+#Settings recorded in the report as they change the measured code paths
+report_settings = ['columnar_star_catalog', 'octree_array_leaves', 'cache_octree', 'octree_coherent_traversal',
+                   'batch_ephemeris', 'stream_celestia_parser', 'cache_celestia_catalogs', 'deferred_ssc_bodies',
+                   'lowest_app_magnitude', 'min_body_size']
+
+#Main stages of a frame, as named by the frame profiler
+stages = ['Engine:update_octree', 'Engine:update_universe', 'Engine:update_obs', 'Engine:update_visibility',
+          'Engine:update_instances', 'Engine:points_update', 'Frame:time']
+
+spectral_types = ['O9V', 'B5V', 'A0V', 'F5V', 'G2V', 'K0V', 'K5III', 'M2V', 'M5V']
+
+def generate_stc(nb_stars, rng):
+    lines = ['"Sol" { RA 0 Dec 0 Distance 0 SpectralType "G2V" AbsMag 4.83 Radius 695700 }\n']
+    for i in range(nb_stars):
+        lines.append('%d "Bench %d" { RA %g Dec %g Distance %g SpectralType "%s" AbsMag %g }\n' %
+                     (i + 1, i + 1,
+                      rng.uniform(0, 360), degrees(asin(rng.uniform(-1, 1))),
+                      4.0 + 1000.0 * rng.random() ** (1 / 3.0),
+                      rng.choice(spectral_types), rng.gauss(4.0, 3.0)))
+    return ''.join(lines)
+
+def generate_orbit(rng, semi_major_axis, period):
+    return ('\tEllipticalOrbit {\n'
+            '\t\tPeriod %g\n'
+            '\t\tSemiMajorAxis %g\n'
+            '\t\tEccentricity %g\n'
+            '\t\tInclination %g\n'
+            '\t\tAscendingNode %g\n'
+            '\t\tArgOfPericenter %g\n'
+            '\t\tMeanAnomaly %g\n'
+            '\t}\n' % (period, semi_major_axis, rng.uniform(0, 0.2), rng.uniform(0, 10),
+                       rng.uniform(0, 360), rng.uniform(0, 360), rng.uniform(0, 360)))
+
+def generate_ssc(nb_planets, nb_moons, nb_asteroids, rng):
+    lines = []
+    for i in range(nb_planets):
+        semi_major_axis = 0.4 * 1.7 ** i
+        lines.append('"Planet%d" "Sol" {\n'
+                     '\tRadius %g\n'
+                     '%s'
+                     '\tRotationPeriod %g\n'
+                     '\tAlbedo 0.3\n'
+                     '}\n\n' % (i + 1, rng.uniform(2000, 70000), generate_orbit(rng, semi_major_axis, semi_major_axis ** 1.5), rng.uniform(8, 30)))
+        for j in range(nb_moons):
+            semi_major_axis = 200000.0 * (1 + j)
+            lines.append('"Moon%d-%d" "Sol/Planet%d" {\n'
+                         '\tRadius %g\n'
+                         '%s'
+                         '\tAlbedo 0.2\n'
+                         '}\n\n' % (i + 1, j + 1, i + 1, rng.uniform(10, 2500), generate_orbit(rng, semi_major_axis, 2.0 + 5.0 * j), ))
+    for i in range(nb_asteroids):
+        semi_major_axis = rng.uniform(2.1, 3.3)
+        lines.append('"%d Asteroid%d" "Sol" {\n'
+                     '\tClass "asteroid"\n'
+                     '\tRadius %g\n'
+                     '%s'
+                     '\tRotationPeriod %g\n'
+                     '\tAlbedo 0.09\n'
+                     '}\n\n' % (i + 1, i + 1, rng.uniform(1, 400), generate_orbit(rng, semi_major_axis, semi_major_axis ** 1.5), rng.uniform(2, 20)))
+    return ''.join(lines)
+
+class CameraPath(object):
+    """Piecewise linear camera path, the camera looks at the interpolated target"""
+    def __init__(self, keyframes):
+        self.keyframes = keyframes
+
+    def get_at(self, t):
+        nb_segments = len(self.keyframes) - 1
+        segment = min(int(t * nb_segments), nb_segments - 1)
+        f = t * nb_segments - segment
+        (start_pos, start_target) = self.keyframes[segment]
+        (end_pos, end_target) = self.keyframes[segment + 1]
+        position = start_pos + (end_pos - start_pos) * f
+        target = start_target + (end_target - start_target) * f
+        direction = target - position
+        direction.normalize()
+        rotation = LQuaterniond()
+        look_at(rotation, direction, LVector3d.up())
+        return (position, rotation)
+
+class BenchmarkConfig(object):
+    def __init__(self):
+        self.default_home = 'Sol'
+        self.default_target = None
+        self.script = None
+        self.prc_file = 'config.prc'
+        self.test_start = True
+
+class CosmoniumBenchmark(Cosmonium):
+    def __init__(self, args):
+        self.args = args
+        self.app_config = BenchmarkConfig()
+        self.load_time = 0.0
+        self.load_rss = 0
+        self.catalog_cache = None
+        settings.prc_file = self.app_config.prc_file
+        #Everything must be done during the frame to have reproducible measures
+        settings.sync_data_load = True
+        settings.sync_texture_load = True
+        Cosmonium.__init__(self)
+
+    def load_task(self):
+        start = time()
+        start_rss = get_rss()
+        Cosmonium.load_task(self)
+        self.load_time = time() - start
+        self.load_rss = get_rss() - start_rss
+
+    def load_universe(self):
+        if self.args.catalogs:
+            catalogs = self.args.catalogs
+        else:
+            rng = random.Random(self.args.seed)
+            #The path only depends on the parameters, so that the catalog cache entries are reused by the next runs
+            data_dir = os.path.join(tempfile.gettempdir(), 'cosmonium-benchmark',
+                                    '%d-%d-%d-%d-%d' % (self.args.seed, self.args.stars, self.args.planets, self.args.moons, self.args.asteroids))
+            if not os.path.exists(data_dir):
+                os.makedirs(data_dir)
+            with open(os.path.join(data_dir, 'benchmark.stc'), 'w') as stc:
+                stc.write(generate_stc(self.args.stars, rng))
+            with open(os.path.join(data_dir, 'benchmark.ssc'), 'w') as ssc:
+                ssc.write(generate_ssc(self.args.planets, self.args.moons, self.args.asteroids, rng))
+            defaultDirContext.add_path('data', data_dir)
+            catalogs = ['benchmark.stc', 'benchmark.ssc']
+        self.catalog_cache = self.get_catalog_cache_mode(catalogs)
+        for catalog in catalogs:
+            if catalog.lower().endswith('.stc'):
+                stc_parser.load(catalog, self.universe)
+            elif catalog.lower().endswith('.ssc'):
+                ssc_parser.load(catalog, self.universe)
+            else:
+                print("Unsupported catalog", catalog)
+
+    def get_catalog_cache_mode(self, catalogs):
+        """Return whether the catalogs are loaded without cache, from a cold cache or from a warm cache"""
+        if not settings.stream_celestia_parser or not settings.cache_celestia_catalogs:
+            return 'disabled'
+        for catalog in catalogs:
+            filepath = defaultDirContext.find_data(catalog)
+            if filepath is None or not os.path.exists(stream_parser.catalogCache.get_filename(filepath)):
+                return 'cold'
+        return 'warm'
+
+    def create_camera_path(self):
+        target = self.universe.find_by_name(self.args.target) if self.args.target is not None else None
+        if target is None:
+            print("Target not found, using Sol")
+            target = self.universe.find_by_name('Sol')
+        target_pos = target.get_global_position() + target.get_local_position()
+        distance = max(target.get_extend() * 10, 1000.0)
+        origin = LPoint3d()
+        keyframes = [(LPoint3d(0, -40 * units.AU, 8 * units.AU), origin),
+                     (LPoint3d(0, -4 * units.AU, 0.6 * units.AU), origin),
+                     (LPoint3d(2.6 * units.AU, -0.5 * units.AU, 0.05 * units.AU), LPoint3d(2.6 * units.AU, 1 * units.AU, 0)),
+                     (LPoint3d(0.5 * units.AU, 2.7 * units.AU, 0.05 * units.AU), LPoint3d(-1 * units.AU, 2.7 * units.AU, 0)),
+                     (target_pos + LVector3d(0, -distance * 100, distance * 10), target_pos),
+                     (target_pos + LVector3d(0, -distance, 0), target_pos)]
+        return CameraPath(keyframes)
+
+    def run_frames(self, path, first_frame, nb_frames):
+        total = self.args.warmup + self.args.frames
+        for frame in range(first_frame, first_frame + nb_frames):
+            (position, rotation) = path.get_at(frame / float(max(1, total - 1)))
+            self.time.set_time_jd(units.J2000 + frame * self.args.time_step)
+            self.ship.set_pos(position, local=False)
+            self.ship.set_rot(rotation)
+            self.time_task(None)
+
+    def start_universe(self):
+        settings.debug_jump = False
+        path = self.create_camera_path()
+        self.time.freeze()
+        profiler = pstats.profiler
+        profiler.enable(history=self.args.frames)
+        self.run_frames(path, 0, self.args.warmup)
+        profiler.reset()
+        start = time()
+        self.run_frames(path, self.args.warmup, self.args.frames)
+        profiler.next_frame()
+        run_time = time() - start
+        profiler.disable()
+        report = {'benchmark': {'frames': self.args.frames,
+                                'warmup': self.args.warmup,
+                                'time_step': self.args.time_step,
+                                'seed': self.args.seed,
+                                'stars': self.args.stars,
+                                'planets': self.args.planets,
+                                'moons': self.args.moons,
+                                'asteroids': self.args.asteroids,
+                                'catalogs': self.args.catalogs,
+                                'target': self.args.target},
+                  'settings': dict([(name, getattr(settings, name)) for name in report_settings]),
+                  'platform': {'python': platform.python_version(),
+                               'panda3d': PandaSystem.get_version_string(),
+                               'system': platform.system(),
+                               'machine': platform.machine()},
+                  'load': {'time': self.load_time,
+                           'rss': self.load_rss,
+                           'catalog_cache': self.catalog_cache},
+                  'run': {'time': run_time,
+                          'fps': self.args.frames / run_time if run_time > 0 else 0.0,
+                          'rss': get_rss()},
+                  'profile': profiler.to_dict()}
+        print_report(report)
+        if self.args.output is not None:
+            with open(self.args.output, 'w') as output:
+                json.dump(report, output, indent=1, sort_keys=True)
+            print("Report written to", self.args.output)
+        if self.args.compare is not None:
+            with open(self.args.compare) as baseline:
+                compare_reports(json.load(baseline), report)
+
+def print_report(report):
+    print("Load time: %.3fs, RSS %+.1f MB, catalog cache %s" % (report['load']['time'], report['load']['rss'] / 1048576.0, report['load'].get('catalog_cache')))
+    print("Run: %d frames in %.3fs (%.1f fps)" % (report['benchmark']['frames'], report['run']['time'], report['run']['fps']))
+    summary = report['profile']['summary']
+    print("%-28s %10s %10s %10s %10s" % ("Stage (ms)", "Mean", "P50", "P95", "Max"))
+    for stage in stages:
+        stats = summary.get(stage)
+        if stats is None: continue
+        print("%-28s %10.3f %10.3f %10.3f %10.3f" % (stage, stats['mean'], stats['p50'], stats['p95'], stats['max']))
+
+def compare_reports(baseline, report):
+    """Print the mean and p95 ratio of each stage against a baseline report, > 1 means slower"""
+    print("%-28s %10s %10s %8s %10s %10s %8s" % ("Stage (ms)", "Base mean", "Mean", "Ratio", "Base p95", "P95", "Ratio"))
+    base_summary = baseline['profile']['summary']
+    summary = report['profile']['summary']
+    for stage in stages:
+        base_stats = base_summary.get(stage)
+        stats = summary.get(stage)
+        if base_stats is None or stats is None: continue
+        mean_ratio = stats['mean'] / base_stats['mean'] if base_stats['mean'] > 0 else 0.0
+        p95_ratio = stats['p95'] / base_stats['p95'] if base_stats['p95'] > 0 else 0.0
+        print("%-28s %10.3f %10.3f %8.2f %10.3f %10.3f %8.2f" % (stage, base_stats['mean'], stats['mean'], mean_ratio, base_stats['p95'], stats['p95'], p95_ratio))
+
+parser = argparse.ArgumentParser(description="Headless benchmark of the simulation pipeline")
+parser.add_argument("--frames", help="Number of measured frames", type=int, default=300)
+parser.add_argument("--warmup", help="Number of frames run before the measures", type=int, default=20)
+parser.add_argument("--time-step", help="Simulated time between two frames, in days", type=float, default=0.01)
+parser.add_argument("--seed", help="Seed of the synthetic catalogs", type=int, default=0)
+parser.add_argument("--stars", help="Number of synthetic stars", type=int, default=20000)
+parser.add_argument("--planets", help="Number of synthetic planets", type=int, default=8)
+parser.add_argument("--moons", help="Number of synthetic moons per planet", type=int, default=4)
+parser.add_argument("--asteroids", help="Number of synthetic asteroids", type=int, default=5000)
+parser.add_argument("--catalogs", help="SSC and STC catalogs to load instead of the synthetic catalogs", nargs='+', default=None)
+parser.add_argument("--target", help="Body approached at the end of the camera path", default='Planet3')
+parser.add_argument("--output", help="Path of the JSON report", default=None)
+parser.add_argument("--compare", help="JSON report to compare the results with", default=None)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    loadPrcFileData("", "audio-library-name null")
+    app = CosmoniumBenchmark(args)
@@ -21,12 +21,12 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 from panda3d.core import LPoint3d, LQuaternion, LColor, LVector3, LVector3d
-from panda3d.core import GeomVertexFormat, GeomVertexData, GeomVertexWriter, GeomVertexRewriter, InternalName
-from panda3d.core import Geom, GeomNode, GeomLines
+from panda3d.core import GeomVertexFormat, GeomVertexData, GeomVertexWriter
+from panda3d.core import Geom, GeomNode, GeomLines, GeomLinestrips, LMatrix3d
 from panda3d.core import NodePath
 
 from .foundation import VisibleObject, ObjectLabel, LabelledObject
-from .astro.orbits import FixedOrbit, InfinitePosition
+from .astro.orbits import FixedOrbit, InfinitePosition, EllipticalOrbit
 from .astro import units
 from .bodyclass import bodyClasses
 from .shaders import BasicShader, FlatLightingModel, LargeObjectVertexControl
@@ -35,7 +35,9 @@ from .mesh import load_panda_model
 from .utils import srgb_to_linear
 from . import settings
 
+from collections import OrderedDict
 from math import sin, cos, atan2, pi
+import numpy
 
 class AnnotationLabel(ObjectLabel):
     def update_instance(self, camera_pos, camera_rot):
@@ -57,6 +59,31 @@ class BackgroundLabel(AnnotationLabel):
         AnnotationLabel.create_instance(self)
         self.instance.setBin('background', self.parent.background_level)
 
+class OrbitPathCache(object):
+    """LRU cache of the orbit paths, keyed by the orbital elements and the orientation of the frame."""
+    def __init__(self, max_entries=None):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+
+    def get_max_entries(self):
+        if self.max_entries is not None:
+            return self.max_entries
+        return settings.orbit_path_cache_size
+
+    def get(self, key, generator):
+        points = self.entries.pop(key, None)
+        if points is None:
+            points = generator()
+        self.entries[key] = points
+        while len(self.entries) > self.get_max_entries():
+            self.entries.popitem(last=False)
+        return points
+
+    def clear(self):
+        self.entries.clear()
+
+orbitPathCache = OrbitPathCache()
+
 class Orbit(VisibleObject):
     ignore_light = True
     default_shown = False
@@ -114,10 +141,15 @@ class Orbit(VisibleObject):
         if self.instance:
             self.instance.setColor(srgb_to_linear(self.color * self.fade))
 
-    def create_instance(self):
-        self.vertexData = GeomVertexData('vertexData', GeomVertexFormat.getV3(), Geom.UHStatic)
-        self.vertexWriter = GeomVertexWriter(self.vertexData, 'vertex')
+    def calc_path(self):
+        """Returns the points of the orbit path, relative to the parent of the body, and whether the path is closed"""
         delta = self.body.parent.get_local_position()
+        if isinstance(self.orbit, EllipticalOrbit) and self.orbit.is_closed():
+            frame = self.orbit.frame
+            orientation = frame.get_orientation()
+            key = (self.orbit.pericenter_distance, self.orbit.eccentricity, tuple(self.orbit.rotation), tuple(orientation), self.nbOfPoints)
+            points = orbitPathCache.get(key, lambda: self.calc_frame_path(orientation))
+            return (points + numpy.array(frame.get_center() - delta, dtype=numpy.float32), True)
         if self.orbit.is_periodic():
             epoch = self.context.time.time_full - self.orbit.period / 2
             step = self.orbit.period / (self.nbOfPoints - 1)
@@ -125,19 +157,36 @@ class Orbit(VisibleObject):
             #TODO: Properly calculate orbit start and end time
             epoch = self.orbit.get_time_of_perihelion() - self.orbit.period * 5.0
             step = self.orbit.period * 10.0 / (self.nbOfPoints - 1)
+        points = numpy.empty((self.nbOfPoints, 3), dtype=numpy.float32)
         for i in range(self.nbOfPoints):
             time = epoch + step * i
-            pos = self.orbit.get_position_at(time) - delta
-            self.vertexWriter.addData3f(*pos)
-        self.lines = GeomLines(Geom.UHStatic)
-        for i in range(self.nbOfPoints-1):
-            self.lines.addVertex(i)
-            self.lines.addVertex(i+1)
-        if self.orbit.is_periodic() and self.orbit.is_closed():
-            self.lines.addVertex(self.nbOfPoints-1)
-            self.lines.addVertex(0)
+            points[i] = self.orbit.get_position_at(time) - delta
+        return (points, self.orbit.is_periodic() and self.orbit.is_closed())
+
+    def calc_frame_path(self, orientation):
+        points = self.orbit.get_frame_path(self.nbOfPoints)
+        matrix = LMatrix3d()
+        orientation.extract_to_matrix(matrix)
+        return numpy.dot(points, numpy.array(matrix, dtype=numpy.float64).reshape(3, 3)).astype(numpy.float32)
+
+    def upload_path(self, geom, points, closed):
+        if closed:
+            points = numpy.concatenate([points, points[:1]])
+        nb_points = len(points)
+        vdata = geom.modify_vertex_data()
+        vdata.unclean_set_num_rows(nb_points)
+        vdata.modify_array_handle(0).copy_data_from(numpy.ascontiguousarray(points, dtype=numpy.float32))
+        lines = GeomLinestrips(Geom.UHStatic)
+        lines.add_next_vertices(nb_points)
+        lines.close_primitive()
+        geom.set_primitive(0, lines)
+
+    def create_instance(self):
+        (points, closed) = self.calc_path()
+        self.vertexData = GeomVertexData('vertexData', GeomVertexFormat.getV3(), Geom.UHStatic)
         self.geom = Geom(self.vertexData)
-        self.geom.addPrimitive(self.lines)
+        self.geom.addPrimitive(GeomLinestrips(Geom.UHStatic))
+        self.upload_path(self.geom, points, closed)
         self.node = GeomNode(self.body.get_ascii_name() + '-orbit')
         self.node.addGeom(self.geom)
         self.instance = NodePath(self.node)
@@ -155,22 +204,8 @@ class Orbit(VisibleObject):
         self.shader.update(self, self.appearance)
 
     def update_geom(self):
-        geom = self.node.modify_geom(0)
-        vdata = geom.modify_vertex_data()
-        vwriter = GeomVertexRewriter(vdata, InternalName.get_vertex())
-        #TODO: refactor with above code !!!
-        delta = self.body.parent.get_local_position()
-        if self.orbit.is_periodic():
-            epoch = self.context.time.time_full - self.orbit.period
-            step = self.orbit.period / (self.nbOfPoints - 1)
-        else:
-            #TODO: Properly calculate orbit start and end time
-            epoch = self.orbit.get_time_of_perihelion() - self.orbit.period * 5.0
-            step = self.orbit.period * 10.0 / (self.nbOfPoints - 1)
-        for i in range(self.nbOfPoints):
-            time = epoch + step * i
-            pos = self.orbit.get_position_at(time) - delta
-            vwriter.setData3f(*pos)
+        (points, closed) = self.calc_path()
+        self.upload_path(self.node.modify_geom(0), points, closed)
 
     def check_visibility(self, pixel_size):
         if self.parent.parent.visible and self.parent.shown and self.orbit:
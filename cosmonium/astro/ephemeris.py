@@ -0,0 +1,49 @@
+#
+#This file is part of Cosmonium.
+#
+#Copyright (C) 2018-2019 Laurent Deru.
+#
+#Cosmonium is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Cosmonium is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Cosmonium.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .orbits import EllipticalOrbit
+from .rotations import UniformRotation
+
+class EphemerisBatch(object):
+    """Group the orbits and rotations of many bodies to evaluate them in one vectorized pass.
+    The results are kept in the orbits and rotations and used by their get_xxx_at() methods for the same time."""
+    def __init__(self):
+        self.orbits = []
+        self.rotations = []
+
+    def clear(self):
+        self.orbits = []
+        self.rotations = []
+
+    def add_body(self, body):
+        orbit = body.orbit
+        if orbit is not None and orbit.__class__ is EllipticalOrbit:
+            self.orbits.append(orbit)
+        rotation = body.rotation
+        if rotation is not None and rotation.__class__ is UniformRotation:
+            self.rotations.append(rotation)
+
+    def evaluate(self, time):
+        if len(self.orbits) > 0:
+            EllipticalOrbit.precompute_frame_positions_at(self.orbits, time)
+        if len(self.rotations) > 0:
+            UniformRotation.precompute_frame_rotations_at(self.rotations, time)
@@ -25,3 +25,5 @@ except ImportError as e:
     print("WARNING: Could not load Kepler C implementation, fallback on python implementation")
     print("\t", e)
     from .pyastro.pykepler import kepler_pos
+
+from .pyastro.pykepler import kepler_pos_array
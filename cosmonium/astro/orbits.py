@@ -20,16 +20,17 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-from panda3d.core import LPoint3d, LVector3d, LQuaterniond
+from panda3d.core import LPoint3d, LVector3d, LQuaterniond, LMatrix3d
 
 from ..parameters import ParametersGroup, UserParameter, AutoUserParameter
 
 from . import units
 from .frame import J2000EclipticReferenceFrame, J2000EquatorialReferenceFrame
-from .kepler import kepler_pos
+from .kepler import kepler_pos, kepler_pos_array
 from .astro import calc_orientation
 
 from math import pi, asin, atan2
+import numpy
 
 class Orbit(object):
     dynamic = False
@@ -226,6 +227,8 @@ class EllipticalOrbit(Orbit):
         self.arg_of_periapsis = arg_of_periapsis * pi / 180
         self.mean_anomaly = mean_anomaly * pi / 180
         self.epoch = epoch
+        self.batch_time = None
+        self.batch_position = None
         self.update_rotation()
 
     def set_period(self, period):
@@ -234,10 +237,23 @@ class EllipticalOrbit(Orbit):
             self.mean_motion = 2 * pi / period
         else:
             self.mean_motion = 0
+        self.batch_time = None
 
     def get_period(self):
         return self.period
 
+    @classmethod
+    def precompute_frame_positions_at(cls, orbits, time):
+        pericenters = numpy.array([orbit.pericenter_distance for orbit in orbits])
+        eccentricities = numpy.array([orbit.eccentricity for orbit in orbits])
+        mean_motions = numpy.array([orbit.mean_motion for orbit in orbits])
+        epochs = numpy.array([orbit.epoch for orbit in orbits])
+        mean_anomalies = numpy.array([orbit.mean_anomaly for orbit in orbits])
+        positions = kepler_pos_array(pericenters, eccentricities, (time - epochs) * mean_motions + mean_anomalies)
+        for (orbit, position) in zip(orbits, positions.tolist()):
+            orbit.batch_time = time
+            orbit.batch_position = LPoint3d(*position)
+
     def update_rotation(self):
         inclination_quat = LQuaterniond()
         inclination_quat.setFromAxisAngleRad(self.inclination, LVector3d.unitX())
@@ -262,6 +278,7 @@ class EllipticalOrbit(Orbit):
 
     def update_user_parameters(self):
         self.update_rotation()
+        self.batch_time = None
 
     def is_periodic(self):
         return self.eccentricity < 1.0
@@ -279,12 +296,28 @@ class EllipticalOrbit(Orbit):
         return abs(self.apocenter_distance)
 
     def get_frame_position_at(self, time):
+        if time == self.batch_time:
+            return self.batch_position
         mean_anomaly = (time - self.epoch) * self.mean_motion + self.mean_anomaly
         return kepler_pos(self.pericenter_distance, self.eccentricity, mean_anomaly)
 
     def get_frame_rotation_at(self, time):
         return self.rotation
 
+    def get_frame_path(self, nb_points):
+        """Sample the closed orbit uniformly in eccentric anomaly, the points are denser near the pericenter
+        where the curvature is higher. Returns an array of shape (nb_points, 3) in the reference frame of the orbit."""
+        ecc_anom = numpy.linspace(0.0, 2 * pi, nb_points, endpoint=False)
+        a = self.pericenter_distance / (1.0 - self.eccentricity)
+        b = a * numpy.sqrt(1.0 - self.eccentricity * self.eccentricity)
+        points = numpy.zeros((nb_points, 3))
+        points[:, 0] = a * (numpy.cos(ecc_anom) - self.eccentricity)
+        points[:, 1] = b * numpy.sin(ecc_anom)
+        matrix = LMatrix3d()
+        self.rotation.extract_to_matrix(matrix)
+        #Panda3D uses row vectors
+        return numpy.dot(points, numpy.array(matrix, dtype=numpy.float64).reshape(3, 3))
+
 class FuncOrbit(Orbit):
     dynamic = True
     def __init__(self, period, semi_major_axis, eccentricity, frame):
@@ -22,6 +22,8 @@ from __future__ import absolute_import
 
 from panda3d.core import LPoint3d
 
+import numpy
+
 from math import sqrt, cos, sin, fabs, pi, atan2, exp, log, fmod, atan, sinh, cosh
 
 THRESH = 1.0e-12
@@ -173,3 +175,52 @@ def kepler_pos(pericenter, ecc, mean_anom):
         x = a * (ecc - cosh(ecc_anom) )
         y = a * sqrt(ecc * ecc - 1) * sinh(ecc_anom)
         return LPoint3d(x, y, 0.0)
+
+def kepler_elliptic_array(ecc, mean_anom):
+    mean_anom = numpy.asarray(mean_anom, dtype=numpy.float64)
+    ecc = numpy.broadcast_to(numpy.asarray(ecc, dtype=numpy.float64), mean_anom.shape)
+    tmod = numpy.fmod(mean_anom, pi * 2.0)
+    tmod = numpy.where(tmod > pi, tmod - 2.0 * pi, tmod)
+    tmod = numpy.where(tmod < -pi, tmod + 2.0 * pi, tmod)
+    offset = mean_anom - tmod
+    sign = numpy.where(tmod < 0.0, -1.0, 1.0)
+    anom = numpy.abs(tmod)
+    curr = numpy.arctan2(numpy.sin(anom), numpy.cos(anom) - ecc)
+    #Highly eccentric orbits near the pericenter need a better starting point
+    high = (ecc > 0.8) & (anom < pi / 3.0)
+    if numpy.any(high):
+        one_minus_e = numpy.abs(1.0 - ecc[high])
+        trial = anom[high] / one_minus_e
+        trial = numpy.where(trial * trial > 6.0 * one_minus_e, numpy.cbrt(6.0 * anom[high]), trial)
+        curr[high] = trial
+    thresh = numpy.maximum(THRESH * numpy.abs(1.0 - ecc), MIN_THRESH)
+    thresh = numpy.where(ecc < 0.9, THRESH, numpy.minimum(thresh, THRESH))
+    active = numpy.ones(curr.shape, dtype=bool)
+    for i in range(MAX_ITERATIONS):
+        e = ecc[active]
+        c = curr[active]
+        delta = -(c - e * numpy.sin(c) - anom[active]) / (1.0 - e * numpy.cos(c))
+        curr[active] = c + delta
+        converged = numpy.abs(delta) <= thresh[active]
+        active[numpy.flatnonzero(active)[converged]] = False
+        if not numpy.any(active): break
+    return offset + sign * curr
+
+def kepler_pos_array(pericenter, ecc, mean_anom):
+    """Vectorized version of kepler_pos, returns the positions as an array of shape (N, 3)"""
+    pericenter = numpy.asarray(pericenter, dtype=numpy.float64)
+    ecc = numpy.asarray(ecc, dtype=numpy.float64)
+    mean_anom = numpy.asarray(mean_anom, dtype=numpy.float64)
+    positions = numpy.zeros((len(mean_anom), 3))
+    elliptic = ecc < 1.0
+    if numpy.any(elliptic):
+        e = ecc[elliptic]
+        ecc_anom = kepler_elliptic_array(e, mean_anom[elliptic])
+        a = pericenter[elliptic] / (1.0 - e)
+        positions[elliptic, 0] = a * (numpy.cos(ecc_anom) - e)
+        positions[elliptic, 1] = a * numpy.sqrt(1 - e * e) * numpy.sin(ecc_anom)
+    #Parabolic and hyperbolic orbits are rare, they use the scalar implementation
+    for i in numpy.flatnonzero(~elliptic):
+        position = kepler_pos(pericenter[i], ecc[i], mean_anom[i])
+        positions[i] = (position[0], position[1], position[2])
+    return positions
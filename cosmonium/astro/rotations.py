@@ -29,6 +29,7 @@ from .astro import calc_orientation_from_incl_an
 from . import units
 
 from math import asin, atan2, pi
+import numpy
 
 class ReferenceAxisBase(object):
     def get_user_parameters(self):
@@ -177,6 +178,8 @@ class UniformRotation(FixedRotation):
         self.set_period(period)
         self.epoch = epoch
         self.meridian_angle = meridian_angle
+        self.batch_time = None
+        self.batch_rotation = None
 
     def is_flipped(self):
         return self.period < 0
@@ -187,6 +190,7 @@ class UniformRotation(FixedRotation):
             self.mean_motion = 2 * pi / period
         else:
             self.mean_motion = 0
+        self.batch_time = None
 
     def get_period(self):
         return self.period
@@ -198,7 +202,26 @@ class UniformRotation(FixedRotation):
         group.add_parameter(AutoUserParameter(_("Epoch"), 'epoch', self, UserParameter.TYPE_FLOAT))
         return group
 
+    def update_user_parameters(self):
+        FixedRotation.update_user_parameters(self)
+        self.batch_time = None
+
+    @classmethod
+    def precompute_frame_rotations_at(cls, rotations, time):
+        mean_motions = numpy.array([rotation.mean_motion for rotation in rotations])
+        epochs = numpy.array([rotation.epoch for rotation in rotations])
+        meridian_angles = numpy.array([rotation.meridian_angle for rotation in rotations])
+        angles = (time - epochs) * mean_motions + meridian_angles
+        angles = numpy.where(mean_motions < 0, -angles, angles) * 0.5
+        for (rotation, c, s) in zip(rotations, numpy.cos(angles).tolist(), numpy.sin(angles).tolist()):
+            #Rotation around the Z axis
+            local = LQuaterniond(c, 0, 0, s)
+            rotation.batch_time = time
+            rotation.batch_rotation = local * rotation.get_frame_equatorial_orientation_at(time)
+
     def get_frame_rotation_at(self, time):
+        if time == self.batch_time:
+            return self.batch_rotation
         angle = (time - self.epoch) * self.mean_motion + self.meridian_angle
         local = LQuaterniond()
         if self.mean_motion < 0:
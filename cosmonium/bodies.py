@@ -48,9 +48,15 @@ class SurfaceFactory(object):
     def create(self, body):
         return None
 
+class BodyComponentsFactory(object):
+    def create(self, body):
+        pass
+
 class StellarBody(StellarObject):
     has_rotation_axis = True
     has_reference_axis = True
+    #Extend of the components of a deferred body, used until the components are created
+    deferred_extend = None
 
     def __init__(self, names, source_names, radius, oblateness=None, scale=None,
                  surface=None, surface_factory=None,
@@ -82,6 +88,7 @@ class StellarBody(StellarObject):
         if self.ring is not None:
             self.ring.owner = self
         self._extend = self.get_extend()
+        self.octree_leaf_changed()
 
     def get_or_create_system(self):
         if self.system is None:
@@ -102,6 +109,22 @@ class StellarBody(StellarObject):
     def create_surface(self):
         self.surface = self.surface_factory.create(self)
 
+    def set_components(self, surface, ring=None, atmosphere=None, clouds=None):
+        if surface is not None:
+            self.surface = surface
+            self.add_surface(surface)
+            self.auto_surface = False
+        self.ring = ring
+        self.atmosphere = atmosphere
+        self.clouds = clouds
+        if self.clouds is not None:
+            self.clouds.owner = self
+        if self.atmosphere is not None:
+            self.atmosphere.owner = self
+        if self.ring is not None:
+            self.ring.owner = self
+        self._extend = self.get_extend()
+
     def add_surface(self, surface):
         self.surfaces.append(surface)
         surface.owner = self
@@ -204,6 +227,8 @@ class StellarBody(StellarObject):
         return scale
 
     def get_extend(self):
+        if self.deferred_factory is not None and self.deferred_extend is not None:
+            return self.deferred_extend
         if self.ring is not None:
             return self.ring.outer_radius
         elif self.surface is not None:
@@ -324,6 +349,8 @@ class ReflectiveBody(StellarBody):
             component.start_shadows_update()
 
     def add_shadow_target(self, target):
+        #The surface of a deferred body, or an automatic surface, is only created with its components
+        if self.surface is None: return
         for component in target.get_components():
             self.surface.add_shadow_target(component)
 
@@ -32,3 +32,12 @@ def create_path_for(*path):
     if not os.path.isdir(final_path):
         os.makedirs(final_path)
     return final_path
+
+def replace_file(source, target):
+    #Atomically replace target by source, both must be on the same filesystem
+    if hasattr(os, 'replace'):
+        os.replace(source, target)
+    else:
+        if os.name == 'nt' and os.path.exists(target):
+            os.remove(target)
+        os.rename(source, target)
@@ -16,47 +16,260 @@
 #You should have received a copy of the GNU General Public License
 #along with Cosmonium.  If not, see <https://www.gnu.org/licenses/>.
 #
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+from panda3d.core import LPoint3d
+
 from .utils import int_to_color
 
+from bisect import bisect_left, insort
+from operator import itemgetter
+import heapq
+import numpy
+
+def name_ngrams(name, size=3):
+    padded = ' ' * (size - 1) + name + ' '
+    return set([padded[i:i+size] for i in range(len(padded) - size + 1)])
+
+def best_matches(matches, limit):
+    if limit is not None:
+        return heapq.nsmallest(limit, matches, key=itemgetter(0))
+    else:
+        return sorted(matches, key=itemgetter(0))
+
+def resolve_matches(matches):
+    result = []
+    for (rank, key, value) in matches:
+        if isinstance(value, StarCatalogLeaf):
+            value = value.get_object()
+        result.append((value.get_exact_name(key), value))
+    return result
+
+def prefix_range(buckets, prefix):
+    """Yield the keys starting with prefix, shortest first and in lexical order within each length.
+    buckets maps a length to the sorted list of the keys of that length, so that the caller can stop
+    as soon as it has enough keys without going through the whole range."""
+    if prefix != '':
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    for length in sorted(buckets.keys()):
+        if length < len(prefix): continue
+        keys = buckets[length]
+        start = bisect_left(keys, prefix)
+        if prefix != '':
+            end = bisect_left(keys, upper, start)
+        else:
+            end = len(keys)
+        for i in range(start, end):
+            yield keys[i]
+
+class NameIndex(object):
+    """Index of upper-case names, grouped by length and sorted to allow ranked prefix lookup using bisect.
+    New names are buffered and merged in the sorted keys on the next lookup, removed names are
+    only dropped from the sorted keys once they are a significant fraction of it.
+    A trigram index for substring and fuzzy lookups is maintained along with the keys."""
+    ngram_size = 3
+    insort_threshold = 64
+
+    def __init__(self):
+        self.entries = {}
+        #Sorted lists of keys, by key length
+        self.keys = {}
+        self.pending = []
+        #Names present in keys or in pending, including the removed names not yet compacted
+        self.indexed = set()
+        self.stale = set()
+        self.ngrams = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        return self.entries.get(key, default)
+
+    def items(self):
+        return self.entries.items()
+
+    def add(self, key, value):
+        if key not in self.indexed:
+            self.indexed.add(key)
+            self.pending.append(key)
+            self.add_ngrams(key)
+        self.stale.discard(key)
+        self.entries[key] = value
+
+    def remove(self, key):
+        if key in self.entries:
+            del self.entries[key]
+            self.stale.add(key)
+
+    def compact(self):
+        entries = self.entries
+        for (length, keys) in list(self.keys.items()):
+            keys = [key for key in keys if key in entries]
+            if keys:
+                self.keys[length] = keys
+            else:
+                del self.keys[length]
+        self.pending = [key for key in self.pending if key in entries]
+        for key in self.stale:
+            self.indexed.discard(key)
+            self.remove_ngrams(key)
+        self.stale = set()
+
+    def update(self):
+        if len(self.stale) * 4 > len(self.indexed):
+            self.compact()
+        if self.pending:
+            buckets = {}
+            for key in self.pending:
+                buckets.setdefault(len(key), []).append(key)
+            for (length, pending) in buckets.items():
+                keys = self.keys.get(length)
+                if keys is None:
+                    self.keys[length] = sorted(pending)
+                elif len(pending) < self.insort_threshold:
+                    for key in pending:
+                        insort(keys, key)
+                else:
+                    keys += pending
+                    keys.sort()
+            self.pending = []
+
+    def add_ngrams(self, key):
+        ngrams = self.ngrams
+        for ngram in name_ngrams(key, self.ngram_size):
+            keys = ngrams.get(ngram)
+            if keys is None:
+                ngrams[ngram] = keys = set()
+            keys.add(key)
+
+    def remove_ngrams(self, key):
+        ngrams = self.ngrams
+        for ngram in name_ngrams(key, self.ngram_size):
+            keys = ngrams.get(ngram)
+            if keys is None: continue
+            keys.discard(key)
+            if not keys:
+                del ngrams[ngram]
+
+    def startswith(self, prefix, limit=None, accept=None):
+        """Return the (rank, key, value) of the names starting with prefix, exact match first, then shortest names."""
+        self.update()
+        entries = self.entries
+        matches = []
+        for key in prefix_range(self.keys, prefix):
+            value = entries.get(key, None)
+            if (value is not None or key in entries) and (accept is None or accept(value)):
+                matches.append(((0 if key == prefix else 1, len(key), key), key, value))
+                if limit is not None and len(matches) >= limit: break
+        return best_matches(matches, limit)
+
+    def contains(self, text, limit=None, accept=None):
+        """Return the (rank, key, value) of the names containing text, earliest and shortest match first."""
+        if len(text) < self.ngram_size: return []
+        size = self.ngram_size
+        postings = []
+        for i in range(len(text) - size + 1):
+            keys = self.ngrams.get(text[i:i+size])
+            if keys is None: return []
+            postings.append(keys)
+        postings.sort(key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        entries = self.entries
+        matches = []
+        for key in candidates:
+            if not key in entries: continue
+            position = key.find(text)
+            if position < 0: continue
+            value = entries[key]
+            if accept is None or accept(value):
+                matches.append(((2, position, len(key), key), key, value))
+        return best_matches(matches, limit)
+
+    def fuzzy(self, text, limit=None, accept=None, min_similarity=0.5):
+        """Return the (rank, key, value) of the names sharing enough trigrams with text, most similar first."""
+        ngrams = name_ngrams(text, self.ngram_size)
+        counts = {}
+        for ngram in ngrams:
+            for key in self.ngrams.get(ngram, ()):
+                counts[key] = counts.get(key, 0) + 1
+        entries = self.entries
+        nb_ngrams = len(ngrams)
+        matches = []
+        for (key, count) in counts.items():
+            #Dice coefficient, a key of length n has at most n + 1 distinct trigrams
+            similarity = 2.0 * count / (nb_ngrams + len(key) + 1)
+            if similarity < min_similarity or not key in entries: continue
+            value = entries[key]
+            if accept is None or accept(value):
+                matches.append(((3, -similarity, len(key), key), key, value))
+        return best_matches(matches, limit)
+
+    def search(self, text, limit=None, accept=None):
+        """Ranked prefix matches followed by substring matches, or fuzzy matches if none is found."""
+        matches = self.startswith(text, limit, accept)
+        if limit is None or len(matches) < limit:
+            remaining = limit - len(matches) if limit is not None else None
+            found = set([match[1] for match in matches])
+            matches += [match for match in self.contains(text, None, accept) if not match[1] in found][:remaining]
+        if not matches:
+            matches = self.fuzzy(text, limit, accept)
+        return matches
+
 class ObjectsDB(object):
     def __init__(self):
-        self.db = {}
+        self.db = NameIndex()
 
     def add(self, body):
         for name in body.names:
-            self.db[name.upper()] = body
+            self.db.add(name.upper(), body)
 
     def get(self, name):
         return self.db.get(name.upper(), None)
 
     def remove(self, body):
         for name in body.names:
-            self.db.pop(name.upper(), None)
+            self.db.remove(name.upper())
+
+    def startswith(self, text, limit=None):
+        text = text.upper()
+        return [(value.get_exact_name(key), value) for (rank, key, value) in self.db.startswith(text, limit)]
 
-    def startswith(self, text):
+    def search(self, text, limit=None):
         text = text.upper()
-        result = []
-        for (key, value) in self.db.items():
-            if key.startswith(text):
-                result.append((value.get_exact_name(key), value))
-        return result
+        return [(value.get_exact_name(key), value) for (rank, key, value) in self.db.search(text, limit)]
 
 class GlobalObjectsDB(object):
     def __init__(self):
-        self.db = {}
+        self.db = NameIndex()
         self.oids = []
+        self.catalogs = []
+
+    def add_catalog(self, catalog):
+        self.catalogs.append(catalog)
 
     def add(self, body):
         body.oid = len(self.oids)
         body.oid_color = int_to_color(body.oid)
         self.oids.append(body)
         for name in body.names:
-            self.db[name.upper()] = body
+            self.db.add(name.upper(), body)
         for name in body.source_names:
-            self.db[name.upper()] = body
+            self.db.add(name.upper(), body)
 
     def get(self, name):
-        return self.db.get(name.upper(), None)
+        name_up = name.upper()
+        body = self.db.get(name_up, None)
+        if body is None:
+            for catalog in self.catalogs:
+                body = catalog.find_by_name(name_up)
+                if body is not None: break
+        return body
 
     def get_oid(self, oid):
         if oid < len(self.oids):
@@ -66,15 +279,210 @@ class GlobalObjectsDB(object):
 
     def remove(self, body):
         for name in body.names:
-            self.db.pop(name.upper(), None)
+            self.db.remove(name.upper())
+        for name in body.source_names:
+            self.db.remove(name.upper())
         self.oids[body.oid] = None
 
-    def startswith(self, text):
+    def startswith(self, text, limit=None):
+        text = text.upper()
+        matches = self.db.startswith(text, limit)
+        for catalog in self.catalogs:
+            matches += catalog.find_matches(text, limit, 'startswith')
+        return resolve_matches(best_matches(matches, limit))
+
+    def search(self, text, limit=None):
         text = text.upper()
-        result = []
-        for (key, value) in self.db.items():
-            if key.startswith(text):
-                result.append((value.get_exact_name(key), value))
-        return result
+        matches = self.db.search(text, limit)
+        for catalog in self.catalogs:
+            matches += catalog.find_matches(text, limit, 'search')
+        if len(matches) > 0:
+            #Only keep fuzzy matches if there is no better one
+            best_tier = min([match[0][0] for match in matches])
+            if best_tier < 3:
+                matches = [match for match in matches if match[0][0] < 3]
+        return resolve_matches(best_matches(matches, limit))
+
+class StarCatalogLeaf(object):
+    """Lightweight stand-in for a star of a StarCatalog, used as octree leaf until the star is actually needed.
+    The position, magnitude and extend are read from the arrays of the catalog."""
+    __slots__ = ('catalog', 'index', 'update_id')
+
+    def __init__(self, catalog, index):
+        self.catalog = catalog
+        self.index = index
+        self.update_id = 0
+
+    def get_object(self):
+        return self.catalog.get_star(self.index)
+
+    def get_created_object(self):
+        return self.catalog.stars.get(self.index)
+
+    def get_name(self):
+        return self.catalog.get_names(self.index)[0]
+
+    @property
+    def _global_position(self):
+        return LPoint3d(*self.catalog.positions[self.index])
+
+    @property
+    def abs_magnitude(self):
+        return float(self.catalog.abs_magnitudes[self.index])
+
+    @property
+    def _extend(self):
+        return float(self.catalog.extends[self.index])
+
+    def get_global_position(self):
+        return self._global_position
+
+    def get_abs_magnitude(self):
+        return self.abs_magnitude
+
+    def get_extend(self):
+        return self._extend
+
+class StarCatalog(object):
+    """Columnar storage of a star catalog.
+    The stars are stored as arrays and the actual star objects are only created on demand,
+    when they become visible or are searched by name."""
+    cat_prefix = None
+
+    def __init__(self, cat_numbers, positions, abs_magnitudes, spectral_types, extends, names=None):
+        self.cat_numbers = cat_numbers
+        self.positions = positions
+        self.abs_magnitudes = abs_magnitudes
+        self.spectral_types = spectral_types
+        self.extends = extends
+        if names is None:
+            names = {}
+        self.names = names
+        self.names_index = None
+        self.build_names_index()
+        self.indexes = None
+        self.unnamed_numbers = None
+        self.stars = {}
+        self.parent = None
+
+    def get_nb_stars(self):
+        return len(self.cat_numbers)
+
+    def set_parent(self, parent):
+        self.parent = parent
+
+    def get_names(self, index):
+        cat_no = int(self.cat_numbers[index])
+        names = self.names.get(cat_no)
+        if names is None:
+            names = [self.cat_prefix + str(cat_no)]
+        return names
+
+    def create_star(self, index):
+        return None
+
+    def get_star(self, index):
+        #The star is not added to the children of the universe, as done by add_child_star_fast() for the
+        #stars of the per-record loader : it is only reached through its leaf in the octree or by name.
+        #The universe does not need it as its 'star' and the Star class already has a halo.
+        star = self.stars.get(index)
+        if star is None:
+            star = self.create_star(index)
+            star.set_parent(self.parent)
+            self.stars[index] = star
+        return star
+
+    def create_leaves(self):
+        return [StarCatalogLeaf(self, index) for index in range(self.get_nb_stars())]
+
+    def find_index(self, cat_no):
+        if self.indexes is None:
+            #Built in reverse order so that the first star is kept if a catalog number is duplicated
+            nb_stars = self.get_nb_stars()
+            self.indexes = dict(zip(self.cat_numbers[::-1].tolist(), range(nb_stars - 1, -1, -1)))
+        return self.indexes.get(cat_no)
+
+    def build_names_index(self):
+        self.names_index = NameIndex()
+        for (cat_no, names) in self.names.items():
+            for name in names:
+                self.names_index.add(name.upper(), cat_no)
+
+    def find_by_name(self, name_up):
+        cat_no = self.names_index.get(name_up)
+        if cat_no is None and self.cat_prefix is not None and name_up.startswith(self.cat_prefix):
+            try:
+                cat_no = int(name_up[len(self.cat_prefix):])
+            except ValueError:
+                pass
+        if cat_no is None:
+            return None
+        index = self.find_index(cat_no)
+        if index is None:
+            return None
+        return self.get_star(index)
+
+    def is_pending(self, cat_no):
+        index = self.find_index(cat_no)
+        #Already created stars are already listed by the global DB
+        return index is not None and index not in self.stars
+
+    def get_unnamed_numbers(self):
+        if self.unnamed_numbers is None:
+            named = numpy.array(list(self.names.keys()), dtype=self.cat_numbers.dtype)
+            numbers = self.cat_numbers[numpy.isin(self.cat_numbers, named, invert=True)]
+            self.unnamed_numbers = numpy.unique(numbers[numbers >= 0])
+        return self.unnamed_numbers
+
+    def iter_unnamed_numbers(self, digits):
+        """Yield the catalog numbers without name whose decimal form starts with digits, shortest first.
+        The numbers of k digits starting with digits form a contiguous range found with a binary search."""
+        numbers = self.get_unnamed_numbers()
+        if len(numbers) == 0: return
+        if digits.startswith('0'):
+            if digits == '0' and numbers[0] == 0:
+                yield 0
+            return
+        max_length = len(str(int(numbers[-1])))
+        for length in range(max(len(digits), 1), max_length + 1):
+            scale = 10 ** (length - len(digits))
+            if digits != '':
+                (low, high) = (int(digits) * scale, (int(digits) + 1) * scale)
+            else:
+                (low, high) = (10 ** (length - 1) if length > 1 else 0, scale)
+            (start, end) = numpy.searchsorted(numbers, [low, high])
+            for i in range(start, end):
+                yield int(numbers[i])
+
+    def find_number_matches(self, text, limit):
+        """Return the (rank, key, leaf) of the stars without name whose catalog designation starts with text."""
+        prefix = self.cat_prefix
+        if prefix is None: return []
+        if text.startswith(prefix):
+            digits = text[len(prefix):]
+            if digits != '' and not digits.isdigit(): return []
+        elif prefix.startswith(text):
+            digits = ''
+        else:
+            return []
+        matches = []
+        for number in self.iter_unnamed_numbers(digits):
+            index = self.find_index(number)
+            if index in self.stars: continue
+            key = prefix + str(number)
+            matches.append(((0 if key == text else 1, len(key), key), key, StarCatalogLeaf(self, index)))
+            if limit is not None and len(matches) >= limit: break
+        return best_matches(matches, limit)
+
+    def find_matches(self, text, limit, lookup):
+        """Return the (rank, key, leaf) of the stars not yet created matching text.
+        The stars are only created by resolve_matches() for the matches actually kept."""
+        matches = getattr(self.names_index, lookup)(text, limit, self.is_pending)
+        matches = [(rank, key, StarCatalogLeaf(self, self.find_index(cat_no))) for (rank, key, cat_no) in matches]
+        return matches + self.find_number_matches(text, limit)
+
+    def startswith(self, text, limit=None):
+        matches = best_matches(self.find_matches(text, limit, 'startswith'), limit)
+        return resolve_matches(matches)
 
 objectsDB = GlobalObjectsDB()
@@ -24,7 +24,7 @@ from panda3d.core import LVector3d
 
 from ..universe import Universe
 from ..galaxies import Galaxy
-from ..celestia import config_parser
+from ..celestia import stream_parser
 from ..astro.orbits import FixedPosition
 from ..astro.rotations import FixedRotation
 from ..astro.frame import J2000EquatorialReferenceFrame
@@ -33,7 +33,6 @@ from ..dircontext import defaultDirContext
 from .. import utils
 
 import sys
-import io
 
 def names_list(name):
     return name.split(':')
@@ -109,8 +108,7 @@ def parse_file(filename, universe, context=defaultDirContext):
     if filepath is not None:
         print("Loading", filepath)
         base.splash.set_text("Loading %s" % filepath)
-        data = io.open(filepath, encoding='latin-1').read()
-        items = config_parser.parse(data)
+        items = stream_parser.load_file(filepath)
         if items is not None:
             instanciate(items, universe)
     else:
@@ -22,7 +22,7 @@ from __future__ import absolute_import
 
 from panda3d.core import LColor, LQuaterniond
 
-from . import config_parser
+from . import stream_parser
 from .celestia_utils import instanciate_elliptical_orbit, instanciate_custom_orbit, \
     instanciate_uniform_rotation, instanciate_precessing_rotation, instanciate_custom_rotation, \
     instanciate_reference_frame, \
@@ -32,7 +32,7 @@ from .shaders import LunarLambertLightingModel
 from ..celestia.atmosphere import CelestiaAtmosphere, CelestiaScattering
 from ..universe import Universe
 from ..systems import StellarSystem, SimpleSystem
-from ..bodies import ReflectiveBody, ReferencePoint
+from ..bodies import ReflectiveBody, ReferencePoint, BodyComponentsFactory
 from ..surfaces import FlatSurface
 from ..bodyelements import Ring, Clouds
 from ..appearances import Appearance
@@ -43,10 +43,11 @@ from ..astro.rotations import FixedRotation, create_uniform_rotation
 from ..astro import units
 from ..astro.frame import J2000EclipticReferenceFrame, RelativeReferenceFrame, EquatorialReferenceFrame
 from ..dircontext import defaultDirContext
+from ..utils import get_rss
+from .. import settings
 
 from time import time
 import sys
-import io
 
 def get_color(value):
     if len(value) == 4:
@@ -135,16 +136,85 @@ def instanciate_rings(data):
                 appearance=appearance,
                 shader=BasicShader())
 
-def instanciate_body(universe, names, is_planet, data, parent):
+component_keys = set(['Texture', 'NightTexture', 'BumpHeight', 'BumpMap', 'NormalMap',
+                      'SpecularPower', 'SpecularColor', 'SpecularTexture',
+                      'LunarLambert', 'Mesh', 'MeshCenter', 'Rings', 'Atmosphere'])
+
+def instanciate_body_components(data):
     appearance=Appearance()
-    point_color=None
-    radius=1.0
-    oblateness=None
-    scale=None
+    radius = data.get('Radius', 1.0)
     lunar_lambert = 0.0
     atmosphere = None
     clouds=None
     rings=None
+    model = None
+    shape_offset = None
+    bump_map = None
+    bump_height = 1.0
+    for (key, value) in data.items():
+        if key == 'Texture':
+            appearance.set_texture(value)
+        elif key == 'NightTexture':
+            appearance.set_emission_texture(value)
+            appearance.emissionColor = LColor(1, 1, 1, 1)
+            appearance.set_nightscale(0.02)
+        elif key == 'BumpHeight':
+            bump_height = value
+        elif key == 'BumpMap':
+            bump_map = value
+        elif key == 'NormalMap':
+            appearance.set_normal_map(value)
+        elif key == 'SpecularPower':
+            #Multiply by 4 as we use Blinn-Phong and not Phong specular
+            appearance.shininess = value * 4.0
+        elif key == 'SpecularColor':
+            appearance.specularColor = get_color(value)
+        elif key == 'SpecularTexture':
+            appearance.set_specular_map(value)
+        elif key == 'LunarLambert':
+            lunar_lambert = value
+        elif key == 'Mesh':
+            model = value
+        elif key == 'MeshCenter':
+            shape_offset = value
+        elif key == 'Rings':
+            rings = instanciate_rings(value)
+        elif key == 'Atmosphere':
+            (atmosphere, clouds) = instanciate_atmosphere(value)
+    if model != None and not (model.endswith('.cmod') or model.endswith('.cms')):
+        shape=MeshShape(model=model, radius=radius, offset=shape_offset)
+    else:
+        shape=SphereShape()
+    if bump_map is not None:
+        appearance.set_bump_map(bump_map, bump_height)
+    lighting_model = None
+    if lunar_lambert > 0.0:
+        lighting_model = LunarLambertLightingModel()
+    else:
+        lighting_model = LambertPhongLightingModel()
+    surface = FlatSurface(
+                          shape=shape,
+                          appearance=appearance,
+                          shader=BasicShader(lighting_model=lighting_model))
+    if atmosphere is not None:
+        atmosphere.add_shape_object(surface)
+        if clouds is not None:
+            atmosphere.add_shape_object(clouds)
+    return (surface, rings, atmosphere, clouds)
+
+class SscBodyComponentsFactory(BodyComponentsFactory):
+    def __init__(self, data):
+        self.data = data
+
+    def create(self, body):
+        (surface, rings, atmosphere, clouds) = instanciate_body_components(self.data)
+        body.set_components(surface, rings, atmosphere, clouds)
+
+def instanciate_body(universe, names, is_planet, data, parent):
+    point_color=None
+    radius=1.0
+    oblateness=None
+    scale=None
     orbit=None
     legacy_rotation = False
     rotation_period = None
@@ -153,11 +223,7 @@ def instanciate_body(universe, names, is_planet, data, parent):
     rotation_offset = 0.0
     rotation_epoch = units.J2000
     rotation = None
-    model = None
-    shape_offset = None
     albedo = 0.5
-    bump_map = None
-    bump_height = 1.0
     orbit_frame = None
     custom_orbit = False
     body_frame = None
@@ -173,37 +239,14 @@ def instanciate_body(universe, names, is_planet, data, parent):
     for (key, value) in data.items():
         if key == 'Radius':
             radius = value
-        elif key == 'Texture':
-            appearance.set_texture(value)
-        elif key == 'NightTexture':
-            appearance.set_emission_texture(value)
-            appearance.emissionColor = LColor(1, 1, 1, 1)
-            appearance.set_nightscale(0.02)
-        elif key == 'BumpHeight':
-            bump_height = value
-        elif key == 'BumpMap':
-            bump_map = value
-        elif key == 'NormalMap':
-            appearance.set_normal_map(value)
+        elif key in component_keys:
+            pass
         elif key == 'Color':
             point_color = get_color(value)
         elif key == 'BlendTexture':
             pass #= value
-        elif key == 'SpecularPower':
-            #Multiply by 4 as we use Blinn-Phong and not Phong specular
-            appearance.shininess = value * 4.0
         elif key == 'Albedo':
             albedo = value
-        elif key == 'SpecularColor':
-            appearance.specularColor = get_color(value)
-        elif key == 'SpecularTexture':
-            appearance.set_specular_map(value)
-        elif key == 'LunarLambert':
-            lunar_lambert = value
-        elif key == 'Mesh':
-            model = value
-        elif key == 'MeshCenter':
-            shape_offset = value
         elif key == 'Oblateness':
             oblateness = value
         elif key == 'SemiAxes':
@@ -216,10 +259,6 @@ def instanciate_body(universe, names, is_planet, data, parent):
             pass #= value
         elif key == 'HazeDensity':
             pass #= value
-        elif key == 'Rings':
-            rings = instanciate_rings(value)
-        elif key == 'Atmosphere':
-            (atmosphere, clouds) = instanciate_atmosphere(value)
         elif key == 'EllipticalOrbit':
             orbit = instanciate_elliptical_orbit(value, orbit_global_coord)
         elif key == 'CustomOrbit':
@@ -282,21 +321,10 @@ def instanciate_body(universe, names, is_planet, data, parent):
         rotation = FixedRotation(LQuaterniond(), frame=body_frame)
     elif not custom_rotation:
         rotation.set_frame(body_frame)
-    if model != None and not (model.endswith('.cmod') or model.endswith('.cms')):
-        shape=MeshShape(model=model, radius=radius, offset=shape_offset)
+    if settings.deferred_ssc_bodies:
+        (surface, rings, atmosphere, clouds) = (None, None, None, None)
     else:
-        shape=SphereShape()
-    if bump_map is not None:
-        appearance.set_bump_map(bump_map, bump_height)
-    lighting_model = None
-    if lunar_lambert > 0.0:
-        lighting_model = LunarLambertLightingModel()
-    else:
-        lighting_model = LambertPhongLightingModel()
-    surface = FlatSurface(
-                          shape=shape,
-                          appearance=appearance,
-                          shader=BasicShader(lighting_model=lighting_model))
+        (surface, rings, atmosphere, clouds) = instanciate_body_components(data)
     body = ReflectiveBody(names=names, source_names=[],
                           radius=radius,
                           surface=surface,
@@ -307,10 +335,11 @@ def instanciate_body(universe, names, is_planet, data, parent):
                           atmosphere=atmosphere,
                           clouds=clouds,
                           point_color=point_color)
-    if atmosphere is not None:
-        atmosphere.add_shape_object(surface)
-        if clouds is not None:
-            atmosphere.add_shape_object(clouds)
+    if settings.deferred_ssc_bodies:
+        body.deferred_factory = SscBodyComponentsFactory(data)
+        if 'Rings' in data:
+            body.deferred_extend = data['Rings'].get('Outer', 0)
+            body._extend = body.get_extend()
     body.albedo = albedo
     body.body_class = body_class
     return body
@@ -440,14 +469,15 @@ def parse_file(filename, universe, context=defaultDirContext):
     filepath = context.find_data(filename)
     if filepath is not None:
         start = time()
+        start_rss = get_rss()
         print("Loading", filepath)
         base.splash.set_text("Loading %s" % filepath)
-        data = io.open(filepath, encoding='latin-1').read()
-        items = config_parser.parse(data)
+        items = stream_parser.load_file(filepath)
         if items is not None:
             instanciate(items, universe)
         end = time()
-        print("Load time:", end - start)
+        print("Load time:", end - start, "RSS: %+.1f MB" % ((get_rss() - start_rss) / 1048576.0),
+              "(deferred bodies)" if settings.deferred_ssc_bodies else "")
     else:
         print("File not found", filename)
 
@@ -458,9 +488,39 @@ def load(config_parser, universe):
     else:
         parse_file(config_parser, universe)
 
+def benchmark(count, deferred):
+    import gc
+    settings.deferred_ssc_bodies = deferred
+    universe = Universe(None)
+    sol = StellarSystem('Sol', [], FixedOrbit())
+    universe.add_child_fast(sol)
+    items = list(stream_parser.iter_items(stream_parser.generate_ssc(count)))
+    for item in items:
+        item[-1].pop('Clickable', None)
+    gc.collect()
+    start = time()
+    start_rss = get_rss()
+    instanciate(items, universe)
+    load_time = time() - start
+    gc.collect()
+    rss = get_rss() - start_rss
+    print("%s: %d bodies in %.3fs, RSS %+.1f MB" % ("Deferred" if deferred else "Eager", count, load_time, rss / 1048576.0))
+    if deferred:
+        start = time()
+        for body in sol.children:
+            body.create_deferred()
+        print("Materialization of all bodies: %.3fs, RSS %+.1f MB" % (time() - start, (get_rss() - start_rss) / 1048576.0))
+
 if __name__ == '__main__':
-    universe=Universe()
-    sol=StellarSystem('Sol', FixedOrbit())
-    universe.add_child(sol)
-    if len(sys.argv) == 2:
+    if len(sys.argv) >= 2 and sys.argv[1] == '--benchmark':
+        import subprocess
+        count = sys.argv[2] if len(sys.argv) > 2 else '10000'
+        for mode in ('--eager', '--deferred'):
+            subprocess.call([sys.executable, '-m', 'cosmonium.celestia.ssc_parser', mode, count])
+    elif len(sys.argv) == 3 and sys.argv[1] in ('--eager', '--deferred'):
+        benchmark(int(sys.argv[2]), sys.argv[1] == '--deferred')
+    elif len(sys.argv) == 2:
+        universe = Universe(None)
+        sol = StellarSystem('Sol', [], FixedOrbit())
+        universe.add_child_fast(sol)
         parse_file(sys.argv[1], universe)
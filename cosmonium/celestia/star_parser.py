@@ -23,6 +23,7 @@ from panda3d.core import LVector3d
 
 from ..universe import Universe
 from ..bodies import Star
+from ..catalogs import StarCatalog
 from ..astro.spectraltype import spectralTypeStringDecoder, spectralTypeIntDecoder
 from ..astro.orbits import FixedPosition
 from ..astro.rotations import UnknownRotation
@@ -31,10 +32,12 @@ from ..astro.astro import app_to_abs_mag
 from ..astro import bayer
 from ..astro import units
 from ..dircontext import defaultDirContext
+from .. import settings
 
 from .bodies import celestiaStarSurfaceFactory
 
 from time import time
+import numpy
 import struct
 import sys
 import io
@@ -117,10 +120,76 @@ def do_load_bin(filepath, names, universe):
     end = time()
     print("Load time:", end - start)
 
+star_record_dtype = numpy.dtype([('catNo', '<i4'),
+                                 ('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                                 ('abs_magnitude', '<i2'),
+                                 ('spectral_type', '<i2')])
+
+class CelestiaStarCatalog(StarCatalog):
+    cat_prefix = "HIP "
+
+    def create_star(self, index):
+        position = LVector3d(*self.positions[index])
+        orbit = FixedPosition(position=position, frame=j2000BarycentricEclipticReferenceFrame)
+        star = Star(self.get_names(index), source_names=[],
+                    surface_factory=celestiaStarSurfaceFactory,
+                    spectral_type=spectralTypeIntDecoder.decode(int(self.spectral_types[index])),
+                    abs_magnitude=float(self.abs_magnitudes[index]),
+                    orbit=orbit,
+                    rotation=UnknownRotation())
+        return star
+
+def calc_stars_extend(spectral_types, abs_magnitudes):
+    #Vectorized version of the radius calculation done in Star
+    unique_types, inverse = numpy.unique(spectral_types, return_inverse=True)
+    temperatures = numpy.empty(len(unique_types))
+    white_dwarfs = numpy.zeros(len(unique_types), dtype=bool)
+    for (i, value) in enumerate(unique_types):
+        spectral_type = spectralTypeIntDecoder.decode(int(value))
+        temperatures[i] = spectral_type.temperature
+        white_dwarfs[i] = spectral_type.white_dwarf
+    temperature_ratios = units.sun_temperature / temperatures[inverse]
+    luminosity_ratios = numpy.power(10.0, 0.4 * (units.sun_abs_magnitude - abs_magnitudes))
+    extends = temperature_ratios * temperature_ratios * numpy.sqrt(luminosity_ratios) * units.sun_radius
+    extends[white_dwarfs[inverse]] = 7000.0
+    return extends
+
+def do_load_bin_columnar(filepath, names, universe):
+    start = time()
+    print("Loading", filepath)
+    base.splash.set_text("Loading %s" % filepath)
+    data = open(filepath, 'rb')
+    field=data.read(8+2+4)
+    data.close()
+    header, version, count = struct.unpack("<8shi", field)
+    if not header == b"CELSTARS":
+        print("Invalid header", header)
+        return
+    if not version == 0x0100:
+        print("Invalid version", version)
+        return
+    print("Found", count, "stars")
+    records = numpy.memmap(filepath, dtype=star_record_dtype, mode='r', offset=len(field), shape=(count,))
+    positions = numpy.empty((count, 3))
+    positions[:, 0] = records['x'] * units.Ly
+    positions[:, 1] = -records['z'] * units.Ly
+    positions[:, 2] = records['y'] * units.Ly
+    abs_magnitudes = records['abs_magnitude'] / 256.0
+    spectral_types = numpy.array(records['spectral_type'])
+    extends = calc_stars_extend(spectral_types, abs_magnitudes)
+    catalog = CelestiaStarCatalog(numpy.array(records['catNo']), positions, abs_magnitudes, spectral_types, extends, names)
+    del records
+    universe.add_star_catalog(catalog)
+    end = time()
+    print("Load time:", end - start)
+
 def load_bin(filename, names, universe, context=defaultDirContext):
     filepath = context.find_data(filename)
     if filepath is not None:
-        return do_load_bin(filepath, names, universe)
+        if settings.columnar_star_catalog:
+            return do_load_bin_columnar(filepath, names, universe)
+        else:
+            return do_load_bin(filepath, names, universe)
     else:
         print("File not found", filename)
         return {}
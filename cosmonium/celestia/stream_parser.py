@@ -0,0 +1,467 @@
+#
+#This file is part of Cosmonium.
+#
+#Copyright (C) 2018-2019 Laurent Deru.
+#
+#Cosmonium is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Cosmonium is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Cosmonium.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""Hand-written streaming parser for the Celestia SSC, STC and DSC catalogs.
+
+It implements the same grammar and produces the same items as the PLY parser in config_parser,
+but the items are yielded one by one as the file is tokenized. The parsed items are also stored
+in a cache keyed by the content of the catalog so that the next launches do not need to tokenize it.
+
+The parser can be benchmarked against the PLY parser with (from the top directory):
+
+    PYTHONPATH=third-party python -m cosmonium.celestia.stream_parser --benchmark [count]
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+from ..cache import create_path_for
+from .. import settings
+
+from functools import partial
+from itertools import chain
+import hashlib
+import pickle
+import gc
+import sys
+import string
+import os
+import re
+
+#The order of the tokens is the same as in config_parser to produce the same tokenization
+token_re = re.compile(r'[ \t\r\n]*('
+                      r'true|false|'
+                      r'[a-zA-Z_][a-zA-Z0-9_]*|'
+                      r'\".*?\"|'
+                      r'[\+-]?(?:\d*\.\d+(?:[eE][\+-]?\d+)?|[\+-]?[1-9]\d*[eE][\+-]?\d+)|'
+                      r'[\+-]?\d+|'
+                      r'\#.*|'
+                      r'[^ \t\r\n])')
+
+#A word is a single token if the tokenizer produces the same split on the classes of its characters,
+#only the true and false prefixes are lost in that translation and must be checked separately
+char_classes = {}
+for code in range(256):
+    char = chr(code)
+    if char in 'eE':
+        char_classes[code] = u'e'
+    elif char in string.ascii_letters or char == '_':
+        char_classes[code] = u'a'
+    elif char == '0':
+        char_classes[code] = u'0'
+    elif char in string.digits:
+        char_classes[code] = u'1'
+    elif char in '+-.()[]{} \t\r\n':
+        char_classes[code] = char
+    else:
+        char_classes[code] = u'?'
+
+word_re = re.compile(r'true|false|'
+                     r'[a-zA-Z_][a-zA-Z0-9_]*|'
+                     r'[\+-]?(?:\d*\.\d+(?:[eE][\+-]?\d+)?|[\+-]?[1-9]\d*[eE][\+-]?\d+)|'
+                     r'[\+-]?\d+|'
+                     r'[()\[\]{}]')
+
+name_start = frozenset(string.ascii_letters + '_')
+name_chars = frozenset(string.ascii_letters + string.digits + '_')
+number_start = frozenset(string.digits + '+-.')
+valid_single = frozenset(string.ascii_letters + string.digits + '_[]{}()')
+
+#Position of the disposition, type, name, parent and alias for each valid header of a definition
+headers = {
+    ('NAME', 'NAME', 'INT'): (0, 1, 2, None, None),
+    ('NAME', 'INT'): (None, 0, 1, None, None),
+    ('INT',): (None, None, 0, None, None),
+    ('NAME', 'NAME', 'INT', 'STRING'): (0, 1, 2, None, 3),
+    ('NAME', 'INT', 'STRING'): (None, 0, 1, None, 2),
+    ('INT', 'STRING'): (None, None, 0, None, 1),
+    ('NAME', 'NAME', 'STRING'): (0, 1, 2, None, None),
+    ('NAME', 'STRING'): (None, 0, 1, None, None),
+    ('STRING',): (None, None, 0, None, None),
+    ('NAME', 'NAME', 'STRING', 'STRING'): (0, 1, 2, 3, None),
+    ('NAME', 'STRING', 'STRING'): (None, 0, 1, 2, None),
+    ('STRING', 'STRING'): (None, None, 0, 1, None),
+    ('NAME',): (None, 0, None, None, None),
+}
+
+def has_bool_prefix(text):
+    for prefix in ('true', 'false'):
+        pos = text.find(prefix)
+        while pos >= 0:
+            end = pos + len(prefix)
+            if end < len(text) and text[end] in name_chars and (pos == 0 or text[pos - 1] not in name_chars):
+                return True
+            pos = text.find(prefix, end)
+    return False
+
+def is_token(token):
+    return len(token) > 1 and token[0] != '#' or token in valid_single
+
+def convert_number(token):
+    if '.' in token or 'e' in token or 'E' in token:
+        try:
+            return float(token)
+        except ValueError:
+            print("Invalid float value", token)
+            return 0
+    else:
+        return int(token)
+
+def token_kind(token):
+    first = token[0]
+    if first == '"':
+        return 'STRING'
+    elif first in number_start:
+        if '.' in token or 'e' in token or 'E' in token:
+            return 'FLOAT'
+        else:
+            return 'INT'
+    elif first in name_start:
+        if token == 'true' or token == 'false':
+            return 'BOOL'
+        else:
+            return 'NAME'
+    else:
+        return token
+
+class ParseError(Exception):
+    pass
+
+class StreamParser(object):
+    """Recursive descent parser working on the raw token strings.
+
+    The data is tokenized in chunks of whole lines, as no token can span several lines,
+    the tokens are only converted to their value when the grammar requires it."""
+    chunk_size = 1 << 18
+
+    def __init__(self, data):
+        self.data = data
+        self.chunk_start = 0
+        self.chunk_end = 0
+        self.tokens = []
+        self.tokens_iter = iter(self.tokens)
+        self.next_token = partial(next, chain.from_iterable(self.iter_chunks()), None)
+        self.depth = 0
+        self.errors = 0
+        self.words = {}
+
+    def iter_chunks(self):
+        data = self.data
+        size = len(data)
+        start = 0
+        while start < size:
+            end = data.find('\n', start + self.chunk_size)
+            if end < 0:
+                end = size
+            else:
+                end += 1
+            self.tokens = self.split_chunk(data[start:end])
+            if self.tokens is None:
+                tokens = token_re.findall(data, start, end)
+                self.tokens = [token for token in tokens if len(token) > 1 and token[0] != '#' or token in valid_single]
+                if len(self.tokens) != len(tokens):
+                    for token in tokens:
+                        if len(token) == 1 and token != '#' and token not in valid_single:
+                            print("Illegal character '%s'" % token)
+            self.chunk_start = start
+            self.chunk_end = end
+            self.tokens_iter = iter(self.tokens)
+            yield self.tokens_iter
+            start = end
+
+    def is_single_token(self, word):
+        valid = self.words.get(word)
+        if valid is None:
+            match = word_re.match(word)
+            valid = match is not None and match.end() == len(word)
+            self.words[word] = valid
+        return valid
+
+    def split_chunk(self, chunk):
+        #Fast path for the chunks without comments and with well formed strings,
+        #the words outside the strings are then the tokens if they can not be split further
+        if '#' in chunk: return None
+        parts = chunk.split('"')
+        if len(parts) % 2 == 0: return None
+        text = ' '.join(parts[0::2])
+        if has_bool_prefix(text): return None
+        for word in set(text.translate(char_classes).split()):
+            if not self.is_single_token(word): return None
+        tokens = []
+        for i in range(0, len(parts) - 1, 2):
+            value = parts[i + 1]
+            if '\n' in value: return None
+            tokens += parts[i].split()
+            tokens.append('"' + value + '"')
+        tokens += parts[-1].split()
+        return tokens
+
+    def get_line(self):
+        count = len(self.tokens) - self.tokens_iter.__length_hint__() - 1
+        for match in token_re.finditer(self.data, self.chunk_start, self.chunk_end):
+            if is_token(match.group(1)):
+                if count == 0:
+                    return self.data.count('\n', 0, match.start(1)) + 1
+                count -= 1
+        return None
+
+    def syntax_error(self, token):
+        if token is not None:
+            print("Syntax error at token", token_kind(token), "line", self.get_line(), ":", token)
+        else:
+            print("SYNTAX ERROR AT EOF")
+        self.errors += 1
+        raise ParseError(token)
+
+    def recover(self, token):
+        #Skip the remaining tokens of the faulty definition
+        depth = self.depth
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+        in_header = depth == 0 and token != '}'
+        while token is not None and (in_header or depth > 0):
+            token = self.next_token()
+            if token == '{':
+                depth += 1
+                in_header = False
+            elif token == '}':
+                depth -= 1
+        self.depth = 0
+
+    def parse_vector(self):
+        values = []
+        next_token = self.next_token
+        while True:
+            token = next_token()
+            if token is not None and token[0] in number_start:
+                values.append(convert_number(token))
+            elif token == ']':
+                return values
+            else:
+                self.syntax_error(token)
+
+    def parse_entries(self):
+        entries = {}
+        next_token = self.next_token
+        self.depth += 1
+        while True:
+            name = next_token()
+            if name == '}':
+                self.depth -= 1
+                return entries
+            if name is None or name[0] not in name_start or name == 'true' or name == 'false':
+                self.syntax_error(name)
+            value = next_token()
+            if value is None:
+                self.syntax_error(value)
+            first = value[0]
+            if first == '"':
+                entries[name] = value[1:-1]
+            elif first in number_start:
+                entries[name] = convert_number(value)
+            elif value == '{':
+                entries[name] = self.parse_entries()
+            elif value == '[':
+                entries[name] = self.parse_vector()
+            elif value == 'true':
+                entries[name] = True
+            elif value == 'false':
+                entries[name] = False
+            else:
+                self.syntax_error(value)
+
+    def parse_definition(self, token):
+        kinds = []
+        values = []
+        while token != '{':
+            if token is None or len(kinds) == 4:
+                self.syntax_error(token)
+            kind = token_kind(token)
+            if kind == 'STRING':
+                values.append(token[1:-1])
+            elif kind == 'INT':
+                values.append(int(token))
+            elif kind == 'NAME':
+                values.append(token)
+            else:
+                self.syntax_error(token)
+            kinds.append(kind)
+            token = self.next_token()
+        layout = headers.get(tuple(kinds))
+        if layout is None:
+            self.syntax_error(token)
+        (disposition, item_type, item_name, item_parent, item_alias) = \
+            [values[index] if index is not None else None for index in layout]
+        if disposition is None:
+            disposition = 'Add'
+        if item_type is None:
+            item_type = 'Body'
+        item_data = self.parse_entries()
+        return [disposition, item_type, item_name, item_parent, item_alias, item_data]
+
+    def iter_items(self):
+        while True:
+            token = self.next_token()
+            if token is None: break
+            try:
+                item = self.parse_definition(token)
+            except ParseError as e:
+                self.recover(e.args[0])
+                continue
+            yield item
+
+def iter_items(data):
+    return StreamParser(data).iter_items()
+
+def parse(data):
+    return list(iter_items(data))
+
+class CatalogCache(object):
+    """Cache of the parsed items of the catalogs, stored in the cache directory.
+
+    There is one cache file per catalog, it is valid as long as the hash of the catalog content matches."""
+    version = 1
+
+    def __init__(self, name='celestia'):
+        self.name = name
+
+    def get_filename(self, filepath):
+        key = hashlib.sha1(os.path.abspath(filepath).encode('utf-8')).hexdigest()
+        return os.path.join(create_path_for(self.name), key + '.dat')
+
+    def calc_hash(self, content):
+        return hashlib.sha1(content).hexdigest()
+
+    def load(self, filepath, content_hash):
+        cache_file = self.get_filename(filepath)
+        if not os.path.exists(cache_file): return None
+        #The items are only made of builtin types, there is no need to track them while loading
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            with open(cache_file, "rb") as f:
+                (version, cached_hash, items) = pickle.load(f)
+        except (IOError, ValueError, EOFError, pickle.UnpicklingError) as e:
+            print("Could not read catalog cache", cache_file, ':', e)
+            return None
+        finally:
+            if gc_enabled:
+                gc.enable()
+        if version != self.version or cached_hash != content_hash:
+            return None
+        return items
+
+    def store(self, filepath, content_hash, items):
+        cache_file = self.get_filename(filepath)
+        try:
+            with open(cache_file, "wb") as f:
+                pickle.dump((self.version, content_hash, items), f, pickle.HIGHEST_PROTOCOL)
+        except IOError as e:
+            print("Could not write catalog cache", cache_file, ':', e)
+
+    def cache_items(self, filepath, content_hash, items):
+        parsed = []
+        for item in items:
+            parsed.append(item)
+            yield item
+        self.store(filepath, content_hash, parsed)
+
+catalogCache = CatalogCache()
+
+def load_file(filepath):
+    """Return the items of the catalog, either from the cache or parsed incrementally from the file."""
+    with open(filepath, 'rb') as f:
+        content = f.read()
+    if not settings.stream_celestia_parser:
+        from . import config_parser
+        return config_parser.parse(content.decode('latin-1').replace('\r\n', '\n'))
+    if settings.cache_celestia_catalogs:
+        content_hash = catalogCache.calc_hash(content)
+        items = catalogCache.load(filepath, content_hash)
+        if items is not None:
+            return items
+        return catalogCache.cache_items(filepath, content_hash, iter_items(content.decode('latin-1')))
+    else:
+        return iter_items(content.decode('latin-1'))
+
+def generate_ssc(count):
+    lines = ['# Synthetic catalog of minor bodies\n\n']
+    for i in range(count):
+        lines.append('"%d Minor%d:A%04d XB" "Sol"\n'
+                     '{\n'
+                     '\tClass "asteroid"\n'
+                     '\tTexture "asteroid.jpg"\n'
+                     '\tMesh "asteroid.cms"\n'
+                     '\tRadius %g\n'
+                     '\tEllipticalOrbit\n'
+                     '\t{\n'
+                     '\t\tEpoch 2458600.5\n'
+                     '\t\tPeriod %g\n'
+                     '\t\tSemiMajorAxis %g\n'
+                     '\t\tEccentricity %g\n'
+                     '\t\tInclination %g\n'
+                     '\t\tAscendingNode %g\n'
+                     '\t\tArgOfPericenter %g\n'
+                     '\t\tMeanAnomaly %g\n'
+                     '\t}\n'
+                     '\tRotationPeriod %g\n'
+                     '\tAlbedo 0.09\n'
+                     '\tColor [ 0.8 0.8 1 ]\n'
+                     '\tClickable true\n'
+                     '}\n\n' % (i + 1, i + 1, i % 10000, 1.0 + i % 500 * 0.37,
+                                3.0 + i % 97 * 0.013, 2.0 + i % 89 * 0.011, i % 83 * 0.003,
+                                i % 31 * 0.7, i % 359 * 1.0, i % 353 * 1.0, i % 347 * 1.0,
+                                5.0 + i % 13))
+    return ''.join(lines)
+
+def benchmark(count):
+    from time import time
+    import tempfile
+    settings.cache_dir = tempfile.mkdtemp()
+    filepath = os.path.join(settings.cache_dir, 'benchmark.ssc')
+    with open(filepath, 'w') as f:
+        f.write(generate_ssc(count))
+    print("Synthetic SSC file with", count, "bodies,", os.path.getsize(filepath) // 1024, "KiB")
+    start = time()
+    from . import config_parser
+    print("PLY parser setup: %.3fs" % (time() - start))
+    data = open(filepath).read()
+    start = time()
+    ply_items = config_parser.parse(data)
+    ply_time = time() - start
+    print("PLY parser: %.3fs" % ply_time)
+    start = time()
+    stream_items = list(load_file(filepath))
+    stream_time = time() - start
+    print("Stream parser (cold cache): %.3fs (x%.1f)" % (stream_time, ply_time / stream_time))
+    start = time()
+    cached_items = load_file(filepath)
+    cache_time = time() - start
+    print("Stream parser (warm cache): %.3fs (x%.1f)" % (cache_time, ply_time / cache_time))
+    if ply_items != stream_items or ply_items != cached_items:
+        print("Parsed items differ !")
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == '--benchmark':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 100000)
+    elif len(sys.argv) == 2:
+        for item in iter_items(open(sys.argv[1]).read()):
+            print(item)
@@ -64,7 +64,8 @@ from .nav import FreeNav, WalkNav, ControlNav
 from .controllers import BodyController, SurfaceBodyMover
 from .ships import NoShip
 from .astro import units
-from .parsers.yamlparser import YamlModuleParser
+from .parsers.yamlparser import YamlModuleParser, yamlCache
+from .procedural import generator
 from .fonts import fontsManager
 from .pstats import pstat
 from . import utils
@@ -112,6 +113,9 @@ class CosmoniumBase(ShowBase):
         self.init_lang()
         self.print_info()
         self.panda_config()
+        if settings.cpu_generator:
+            #The generator workers are forked, they must be created before any thread is started
+            generator.start_worker_pool()
         ShowBase.__init__(self, windowType='none')
         if not self.app_config.test_start:
             create_main_window(self)
@@ -147,6 +151,9 @@ class CosmoniumBase(ShowBase):
         workers.asyncTextureLoader = workers.AsyncTextureLoader(self)
         workers.syncTextureLoader = workers.SyncTextureLoader()
 
+        if settings.frame_profiler:
+            pstats.profiler.enable(settings.frame_profiler_history, settings.frame_profiler_output)
+
     def load_lang(self, domain, locale_path):
         languages = None
         for envar in ('LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG'):
@@ -438,6 +445,7 @@ class Cosmonium(CosmoniumBase):
         self.init_universe()
 
         self.load_universe()
+        yamlCache.save()
 
         self.universe.recalc_recursive()
 
@@ -1001,6 +1009,7 @@ class Cosmonium(CosmoniumBase):
             dt = globalClock.getDt()
         else:
             dt = 0
+        pstats.profiler.next_frame()
 
         self.gui.update()
 
@@ -1009,10 +1018,12 @@ class Cosmonium(CosmoniumBase):
 
         self.update_octree()
         update = pstats.levelpstat('update', 'Bodies')
+        update_skipped = pstats.levelpstat('update_skipped', 'Bodies')
         obs = pstats.levelpstat('obs', 'Bodies')
         visibility = pstats.levelpstat('visibility', 'Bodies')
         instance = pstats.levelpstat('instance', 'Bodies')
         StellarObject.nb_update = 0
+        StellarObject.nb_update_skipped = 0
         StellarObject.nb_obs = 0
         StellarObject.nb_visibility = 0
         StellarObject.nb_instance = 0
@@ -1080,6 +1091,7 @@ class Cosmonium(CosmoniumBase):
         self.update_instances()
 
         update.set_level(StellarObject.nb_update)
+        update_skipped.set_level(StellarObject.nb_update_skipped)
         obs.set_level(StellarObject.nb_obs)
         visibility.set_level(StellarObject.nb_visibility)
         instance.set_level(StellarObject.nb_instance)
@@ -22,12 +22,89 @@ from __future__ import absolute_import
 
 from panda3d.core import ExecutionEnvironment
 
+import fnmatch
 import glob
 import os
 from copy import deepcopy
 
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
+
+class DirEntries(object):
+    """Content of a directory, the names are normalized with normcase for the lookups, like glob does."""
+    __slots__ = ('names', 'keys', 'files')
+
+    def __init__(self, path):
+        self.names = []
+        self.files = set()
+        if scandir is not None:
+            for entry in scandir(path):
+                self.names.append(entry.name)
+                try:
+                    if entry.is_file():
+                        self.files.add(os.path.normcase(entry.name))
+                except OSError:
+                    pass
+        else:
+            for name in os.listdir(path):
+                self.names.append(name)
+                if os.path.isfile(os.path.join(path, name)):
+                    self.files.add(os.path.normcase(name))
+        self.names.sort()
+        self.keys = set([os.path.normcase(name) for name in self.names])
+
+class DirIndex(object):
+    """Memory index of the content of the directories, each directory is scanned once when first needed."""
+    def __init__(self):
+        self.dirs = {}
+
+    def get_entries(self, path):
+        entries = self.dirs.get(path, False)
+        if entries is False:
+            try:
+                entries = DirEntries(path)
+            except OSError:
+                entries = None
+            self.dirs[path] = entries
+        return entries
+
+    def exists(self, filename):
+        (path, name) = os.path.split(filename)
+        entries = self.get_entries(path or os.curdir)
+        if entries is None: return False
+        return os.path.normcase(name) in entries.files
+
+    def find(self, pattern):
+        (path, name) = os.path.split(pattern)
+        if glob.has_magic(path):
+            files = glob.glob(pattern)
+            return files[0] if len(files) > 0 else None
+        entries = self.get_entries(path or os.curdir)
+        if entries is None: return None
+        if not glob.has_magic(name):
+            return pattern if os.path.normcase(name) in entries.keys else None
+        for entry in entries.names:
+            #Like glob, hidden files must be matched explicitly
+            if entry[0] == '.' and name[0] != '.': continue
+            if fnmatch.fnmatch(entry, name):
+                return os.path.join(path, entry)
+        return None
+
+    def invalidate(self, path=None):
+        if path is None:
+            self.dirs = {}
+        else:
+            self.dirs.pop(path, None)
+
+dirIndex = DirIndex()
+
 class DirContext(object):
-    def __init__(self, context=None):
+    def __init__(self, context=None, index=None):
+        if index is None:
+            index = context.index if context is not None else dirIndex
+        self.index = index
         if context is not None:
             self.category_paths = deepcopy(context.category_paths)
         else:
@@ -63,18 +140,22 @@ class DirContext(object):
     def find_file(self, category, pattern):
         if pattern is None: return None
         if os.path.isabs(pattern):
-            files = glob.glob(pattern)
-            if len(files) > 0:
-                return files[0]
+            return self.index.find(pattern)
         else:
             for res in self.category_paths[category]:
                 #print("Looking for", pattern, "in", res)
                 full_pattern =  os.path.join(res, pattern)
-                files = glob.glob(full_pattern)
-                if len(files) > 0:
-                    return files[0]
+                filename = self.index.find(full_pattern)
+                if filename is not None:
+                    return filename
         return None
 
+    def file_exists(self, filename):
+        return self.index.exists(filename)
+
+    def invalidate(self, path=None):
+        self.index.invalidate(path)
+
     def find_texture(self, pattern):
         return self.find_file('textures', pattern)
 
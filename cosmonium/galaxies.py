@@ -20,10 +20,10 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-from panda3d.core import TextureStage, Texture, TexGenAttrib, GeomVertexRewriter
-from panda3d.core import GeomVertexArrayFormat, InternalName, GeomVertexFormat, GeomVertexData, GeomVertexWriter, OmniBoundingVolume
+from panda3d.core import TextureStage, Texture, TexGenAttrib
+from panda3d.core import GeomVertexArrayFormat, InternalName, GeomVertexFormat, GeomVertexData, OmniBoundingVolume
 from panda3d.core import GeomPoints, Geom, GeomNode
-from panda3d.core import LVecBase3, LPoint3d, LPoint3, LColor, LVector3d
+from panda3d.core import LVecBase3, LColor, LVector3d
 from panda3d.core import NodePath, StackedPerlinNoise3
 
 from .appearances import AppearanceBase
@@ -39,11 +39,17 @@ from .bodies import DeepSpaceObject
 from .shaders import BasicShader, FlatLightingModel
 from .utils import mag_to_scale_nolimit
 from .astro import units
+from .cache import create_path_for, replace_file
 from . import settings
 
-from math import cos, sin, pi, log, tan, tanh, sqrt, exp, atan, atanh
-from random import random, gauss, choice, seed
+from math import pi, log, tan, tanh, sqrt
+from random import randint
+from collections import OrderedDict
+from zlib import crc32
 from cosmonium.utils import srgb_to_linear
+import hashlib
+import numpy
+import os
 
 class Galaxy(DeepSpaceObject):
     has_rotation_axis = False
@@ -126,12 +132,133 @@ class GalaxyAppearance(AppearanceBase):
                 AutoUserParameter("Color scale", "color_scale", self, UserParameter.TYPE_FLOAT, [0, 255]),
                 ]
 
+class GalaxyPointsCache(object):
+    """LRU cache of the generated galaxy point clouds, backed by a disk cache.
+    The disk cache is bounded by a budget in bytes, the least recently used files are removed first."""
+    #Fraction of the disk budget kept when the disk cache is trimmed, to avoid a trim after each new entry
+    disk_trim_ratio = 0.9
+
+    def __init__(self, max_entries=None, max_disk_size=None):
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.max_disk_size = max_disk_size
+        self.disk_size = None
+
+    def get_max_entries(self):
+        if self.max_entries is not None:
+            return self.max_entries
+        return settings.galaxy_cache_size
+
+    def get_max_disk_size(self):
+        if self.max_disk_size is not None:
+            return self.max_disk_size
+        return settings.galaxy_disk_cache_size
+
+    def get_path(self):
+        return create_path_for('galaxies')
+
+    def get_filename(self, key):
+        return os.path.join(self.get_path(), key + '.npz')
+
+    def load(self, key):
+        filename = self.get_filename(key)
+        if not os.path.exists(filename): return None
+        try:
+            with numpy.load(filename) as data:
+                entry = (data['points'], data['colors'], data['sizes'], float(data['size']))
+        except Exception as e:
+            #The file is corrupted or truncated, remove it so that it is generated and stored again
+            print("Could not load galaxy cache", filename, ':', e)
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            return None
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, entry):
+        filename = self.get_filename(key)
+        (points, colors, sizes, size) = entry
+        #Must be known before the new file is written, else it would be counted twice
+        disk_size = self.get_disk_size()
+        tmp_filename = filename + '.tmp'
+        try:
+            with open(tmp_filename, 'wb') as f:
+                numpy.savez(f, points=points, colors=colors, sizes=sizes, size=size)
+            replace_file(tmp_filename, filename)
+        except (IOError, OSError) as e:
+            print("Could not write galaxy cache", filename, ':', e)
+            return
+        self.disk_size = disk_size + os.path.getsize(filename)
+        if self.disk_size > self.get_max_disk_size():
+            self.trim_disk()
+
+    def list_files(self):
+        path = self.get_path()
+        files = []
+        for name in os.listdir(path):
+            if not name.endswith('.npz'): continue
+            filename = os.path.join(path, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+        return files
+
+    def get_disk_size(self):
+        if self.disk_size is None:
+            self.disk_size = sum(size for (mtime, size, filename) in self.list_files())
+        return self.disk_size
+
+    def trim_disk(self):
+        max_disk_size = self.get_max_disk_size() * self.disk_trim_ratio
+        files = sorted(self.list_files())
+        self.disk_size = sum(size for (mtime, size, filename) in files)
+        for (mtime, size, filename) in files:
+            if self.disk_size <= max_disk_size: break
+            try:
+                os.remove(filename)
+            except OSError as e:
+                print("Could not remove galaxy cache", filename, ':', e)
+                continue
+            self.disk_size -= size
+
+    def get(self, key, generator, persistent=True):
+        """Return the point cloud of key, generated if needed. Only the persistent entries are stored on disk."""
+        use_disk = persistent and settings.cache_galaxies
+        entry = self.entries.pop(key, None)
+        if entry is None and use_disk:
+            entry = self.load(key)
+        if entry is None:
+            entry = generator()
+            if use_disk:
+                self.store(key, entry)
+        self.entries[key] = entry
+        while len(self.entries) > self.get_max_entries():
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
+galaxyPointsCache = GalaxyPointsCache()
+
+def color_array(color):
+    return numpy.array(tuple(color), dtype=numpy.float32)
+
 class GalaxyShapeBase(Shape):
-    templates = {}
-    def __init__(self, radius=1.0, scale=None):
+    cache_version = 1
+    cache_attributes = []
+    def __init__(self, radius=1.0, scale=None, seed=None):
         Shape.__init__(self)
         self.radius = radius
-        self.seed = random()
+        self.seed = seed
+        self.random_seed = False
         if scale is None:
             self.radius = radius
             self.scale = LVecBase3(self.radius, self.radius, self.radius)
@@ -146,6 +273,25 @@ class GalaxyShapeBase(Shape):
     def shape_id(self):
         return ''
 
+    def get_seed(self):
+        #The seed is derived from the name of the galaxy so the same galaxy is generated on each run
+        if self.seed is None:
+            if self.owner is not None:
+                self.seed = crc32(self.owner.get_name().encode('utf-8')) & 0x7fffffff
+            else:
+                self.seed = randint(0, 0x7fffffff)
+                self.random_seed = True
+        return self.seed
+
+    def get_cache_key(self):
+        parameters = [self.__class__.__name__, self.cache_version, self.shape_id(), self.get_seed()]
+        for attribute in self.cache_attributes:
+            value = getattr(self, attribute)
+            if not isinstance(value, (int, float)):
+                value = tuple(value)
+            parameters.append(value)
+        return hashlib.sha1(repr(parameters).encode('utf-8')).hexdigest()
+
     def get_apparent_radius(self):
         return self.radius
 
@@ -155,37 +301,39 @@ class GalaxyShapeBase(Shape):
     def is_flat(self):
         return False
 
-    def create_points(self, radius=1.0):
+    def create_points(self, rng, radius=1.0):
+        """Generate the point cloud, returns the positions, colors and sizes as arrays"""
         return None
 
+    def generate_points(self):
+        rng = numpy.random.RandomState(self.get_seed())
+        (points, colors, sizes) = self.create_points(rng)
+        return (points.astype(numpy.float32), colors.astype(numpy.float32), sizes.astype(numpy.float32), self.size)
+
+    def get_points(self):
+        key = self.get_cache_key()
+        #A random seed will not be used again, the points are not worth storing on disk
+        (points, colors, sizes, size) = galaxyPointsCache.get(key, self.generate_points, not self.random_seed)
+        self.size = size
+        return (points, colors, sizes)
+
     def apply(self):
         self.instance.node().setBounds(OmniBoundingVolume())
         self.instance.node().setFinal(True)
 
     def create_instance(self):
-        shape_id = self.shape_id()
-        if shape_id in GalaxyShapeBase.templates:
-            template =  GalaxyShapeBase.templates[shape_id]
-        else:
-            seed(self.seed)
-            self.gnode = GeomNode('galaxy')
-            self.geom = self.makeGeom(*self.create_points())
-            self.gnode.addGeom(self.geom)
-            template = NodePath(self.gnode)
-            # Disable caching
-            #GalaxyShapeBase.templates[shape_id] = template
+        self.gnode = GeomNode('galaxy')
+        self.geom = self.makeGeom(*self.get_points())
+        self.gnode.addGeom(self.geom)
         self.instance = NodePath('galaxy')
-        template.instanceTo(self.instance)
+        NodePath(self.gnode).reparent_to(self.instance)
         self.apply()
-        self.update_geom(*self.create_points())
         return self.instance
 
     def update_shape(self):
-        seed(self.seed)
-        self.update_geom(*self.create_points())
+        self.update_geom(*self.get_points())
 
-    def makeGeom(self, points, colors, sizes):
-        #format = GeomVertexFormat.getV3c4()
+    def create_vertex_data(self):
         array = GeomVertexArrayFormat()
         array.addColumn(InternalName.get_vertex(), 3, Geom.NTFloat32, Geom.CPoint)
         array.addColumn(InternalName.get_color(), 4, Geom.NTFloat32, Geom.CColor)
@@ -193,38 +341,32 @@ class GalaxyShapeBase(Shape):
         format = GeomVertexFormat()
         format.addArray(array)
         format = GeomVertexFormat.registerFormat(format)
-        vdata = GeomVertexData('vdata', format, Geom.UH_static)
-        vdata.unclean_set_num_rows(len(points))
-        self.vwriter = GeomVertexWriter(vdata, InternalName.get_vertex())
-        self.colorwriter = GeomVertexWriter(vdata, InternalName.get_color())
-        self.sizewriter = GeomVertexWriter(vdata, InternalName.get_size())
-        geompoints = GeomPoints(Geom.UH_static)
-        geompoints.reserve_num_vertices(len(points))
-        index = 0
-        for (point, color, size) in zip(points, colors, sizes):
-            self.vwriter.addData3f(*point)
-            self.colorwriter.addData4f(*color)
-            self.sizewriter.addData1f(size)
-            geompoints.addVertex(index)
-            #geompoints.closePrimitive()
-            index += 1
-        geom = Geom(vdata)
-        geom.addPrimitive(geompoints)
+        return GeomVertexData('vdata', format, Geom.UH_static)
+
+    def upload(self, geom, points, colors, sizes):
+        nb_points = len(points)
+        data = numpy.empty((nb_points, 8), dtype=numpy.float32)
+        data[:, 0:3] = points
+        data[:, 3:7] = colors
+        data[:, 7] = sizes
+        vdata = geom.modify_vertex_data()
+        vdata.unclean_set_num_rows(nb_points)
+        if nb_points > 0:
+            vdata.modify_array_handle(0).copy_data_from(data)
+        geom.modify_primitive(0).set_nonindexed_vertices(0, nb_points)
+
+    def makeGeom(self, points, colors, sizes):
+        geom = Geom(self.create_vertex_data())
+        geom.addPrimitive(GeomPoints(Geom.UH_static))
+        self.upload(geom, points, colors, sizes)
         return geom
 
     def update_geom(self, points, colors, sizes):
         geom = self.instance.children[0].node().modify_geom(0)
-        vdata = geom.modify_vertex_data()
-        vdata.unclean_set_num_rows(len(points))
-        vwriter = GeomVertexRewriter(vdata, InternalName.get_vertex())
-        colorwriter = GeomVertexWriter(vdata, InternalName.get_color())
-        sizewriter = GeomVertexWriter(vdata, InternalName.get_size())
-        for (point, color, size) in zip(points, colors, sizes):
-            vwriter.addData3f(*point)
-            colorwriter.addData4f(*color)
-            sizewriter.addData1f(size)
+        self.upload(geom, points, colors, sizes)
 
 class EllipticalGalaxyShape(GalaxyShapeBase):
+    cache_attributes = ['factor', 'nb_points', 'spread', 'zspread', 'sprite_size', 'sersic', 'color']
     def __init__(self, factor, radius=1.0, scale=None, nb_points=4000, spread=0.4, zspread=0.2, sprite_size=400, sersic=4.0):
         GalaxyShapeBase.__init__(self, radius, scale)
         self.factor = factor
@@ -238,27 +380,16 @@ class EllipticalGalaxyShape(GalaxyShapeBase):
     def shape_id(self):
         return 'elliptical-%g' % self.factor
 
-    def create_points(self, radius=1.0):
-        points = []
-        colors = []
-        sizes = []
+    def create_points(self, rng, radius=1.0):
         nb_points = self.nb_points
-        sprite_size = self.sprite_size
-        half_sprite_size = self.sprite_size / 2.0
-        color = self.color
-        spread = self.spread
-        spreadf = self.spread * self.factor
-        zspreadf = self.zspread * self.factor
-        sersic_inv = 1. / self.sersic
-        for i in range(nb_points):
-            x = gauss(0.0, spread)
-            y = gauss(0.0, spreadf)
-            z = gauss(0.0, zspreadf)
-            point = LPoint3d(x * radius, y * radius, z * radius)
-            points.append(point)
-            colors.append(color * (0.9 - pow(point.length(), sersic_inv)))
-            size = sprite_size + gauss(0, half_sprite_size)
-            sizes.append(size)
+        points = numpy.empty((nb_points, 3))
+        points[:, 0] = rng.normal(0.0, self.spread, nb_points)
+        points[:, 1] = rng.normal(0.0, self.spread * self.factor, nb_points)
+        points[:, 2] = rng.normal(0.0, self.zspread * self.factor, nb_points)
+        points *= radius
+        distances = numpy.linalg.norm(points, axis=1)
+        colors = color_array(self.color)[numpy.newaxis, :] * (0.9 - distances ** (1. / self.sersic))[:, numpy.newaxis]
+        sizes = self.sprite_size + rng.normal(0, self.sprite_size / 2.0, nb_points)
         return (points, colors, sizes)
 
     def get_user_parameters(self):
@@ -272,6 +403,7 @@ class EllipticalGalaxyShape(GalaxyShapeBase):
 
 class IrregularGalaxyShape(GalaxyShapeBase):
     noise = None
+    cache_attributes = ['nb_points', 'spread', 'zspread', 'sprite_size', 'sersic', 'color1', 'color2']
     def __init__(self, radius=1.0, scale=None, nb_points=4000, spread=0.4, zspread=0.2, sprite_size=400, sersic=4.0):
         GalaxyShapeBase.__init__(self, radius, scale)
         self.nb_points = nb_points
@@ -285,32 +417,31 @@ class IrregularGalaxyShape(GalaxyShapeBase):
     def shape_id(self):
         return 'irregular'
 
-    def create_points(self, radius=1.0):
+    def create_points(self, rng, radius=1.0):
         if IrregularGalaxyShape.noise is None:
             IrregularGalaxyShape.noise = StackedPerlinNoise3(1, 1, 1, 8, 4, 0.7)
-        points = []
-        colors = []
-        sizes = []
+        noise = self.noise
         nb_points = self.nb_points
-        sprite_size = self.sprite_size
-        colors_list = [self.color1, self.color2]
-        spread = self.spread
-        zspread = self.zspread
-        sersic_inv = 1. / self.sersic
+        accepted = []
         count = 0
+        #The candidates are generated by batches and filtered using the noise
         while count < nb_points:
-            p = LPoint3(gauss(0.0, spread), gauss(0.0, spread), gauss(0.0, zspread))
-            value = self.noise(p) * 0.5 + 0.5
-            if value < 0.5:
-                points.append(p * radius)
-                color = choice(colors_list)
-                color = color * (1 - 0.9 * pow(p.length(), sersic_inv))
-                color[3] = 1.0
-                colors.append(color)
-                size = sprite_size + gauss(0, sprite_size)
-                sizes.append(size)
-                count += 1
-        return (points, colors, sizes)
+            batch_size = max(2 * (nb_points - count), 16)
+            candidates = numpy.empty((batch_size, 3))
+            candidates[:, 0] = rng.normal(0.0, self.spread, batch_size)
+            candidates[:, 1] = rng.normal(0.0, self.spread, batch_size)
+            candidates[:, 2] = rng.normal(0.0, self.zspread, batch_size)
+            values = numpy.array([noise(x, y, z) for (x, y, z) in candidates.tolist()]) * 0.5 + 0.5
+            candidates = candidates[values < 0.5][:nb_points - count]
+            accepted.append(candidates)
+            count += len(candidates)
+        points = numpy.concatenate(accepted)
+        distances = numpy.linalg.norm(points, axis=1)
+        colors_list = numpy.array([color_array(self.color1), color_array(self.color2)])
+        colors = colors_list[rng.randint(0, 2, nb_points)] * (1 - 0.9 * distances ** (1. / self.sersic))[:, numpy.newaxis]
+        colors[:, 3] = 1.0
+        sizes = self.sprite_size + rng.normal(0, self.sprite_size, nb_points)
+        return (points * radius, colors, sizes)
 
     def get_user_parameters(self):
         return [
@@ -323,6 +454,9 @@ class IrregularGalaxyShape(GalaxyShapeBase):
                 ]
 
 class SpiralGalaxyShapeBase(GalaxyShapeBase):
+    arm_spread = 5
+    cache_attributes = ['nb_points_bulge', 'nb_points_arms', 'spread', 'zspread', 'max_angle', 'sprite_size',
+                        'sersic_bulge', 'sersic_disk', 'bulge_color', 'arms_color', 'arm_spread']
     def __init__(self, radius=1.0, scale=None, nb_points_bulge=200, nb_points_arms=1000, spread=0.4, zspread=0.01, sprite_size=400, max_angle=2 * pi, sersic_bulge=4.0, sersic_disk=1.0):
         GalaxyShapeBase.__init__(self, radius, scale)
         self.nb_points_bulge = nb_points_bulge
@@ -339,93 +473,78 @@ class SpiralGalaxyShapeBase(GalaxyShapeBase):
     def is_flat(self):
         return True
 
-    def create_bulge(self, count, radius, spread, zspread, points, colors, sizes):
-        sprite_size = self.sprite_size
-        bulge_color = self.bulge_color
-        sersic_inv = 1. / self.sersic_bulge
-        for i in range(count):
-            x = gauss(0.0, spread)
-            y = gauss(0.0, spread)
-            z = gauss(0.0, zspread)
-            point = LPoint3d(x * radius, y * radius, z * radius)
-            points.append(point)
-            color = bulge_color * (1 - pow(point.length(), sersic_inv)) * 2
-            color[3] = 1.0
-            colors.append(color)
-            size = sprite_size + gauss(0, sprite_size)
-            sizes.append(size)
-
-    def create_spiral(self, count,radius, spread, zspread, points, colors, sizes):
-        func = self.shape_func
-        sprite_size = self.sprite_size
-        arm_color = self.arms_color
-        sersic_inv = 1. / self.sersic_disk
-        distance = 0
+    def create_bulge(self, rng, count, radius, spread, zspread):
+        #The bulge size can be negative, the distribution is symmetrical
+        spread = abs(spread)
+        zspread = abs(zspread)
+        points = numpy.empty((count, 3))
+        points[:, 0] = rng.normal(0.0, spread, count)
+        points[:, 1] = rng.normal(0.0, spread, count)
+        points[:, 2] = rng.normal(0.0, zspread, count)
+        points *= radius
+        distances = numpy.linalg.norm(points, axis=1)
+        colors = color_array(self.bulge_color)[numpy.newaxis, :] * ((1 - distances ** (1. / self.sersic_bulge)) * 2)[:, numpy.newaxis]
+        colors[:, 3] = 1.0
+        sizes = self.sprite_size + rng.normal(0, self.sprite_size, count)
+        return (points, colors, sizes)
+
+    def create_spiral(self, rng, count, radius, spread, zspread):
+        points = []
         for i in (-1.0, 1.0):
-            for c in range(count):
-                t = sqrt(random())
-                angle = t * self.max_angle
-                shape = func(angle)
-                x = i * cos(angle) * shape + gauss(0.0, spread)
-                y = i * sin(angle) * shape + gauss(0.0, spread)
-                z = gauss(0.0, zspread)
-                point = LPoint3d(x * radius, y * radius, z * radius)
-                points.append(point)
-                distance = max(distance, point.length())
-                color = arm_color * (1 - 0.9 * pow(distance, sersic_inv))
-                color[3] = 1.0
-                colors.append(color)
-                size = sprite_size + gauss(0, sprite_size)
-                sizes.append(size)
-        self.size = distance
-
-    def create_spiral_distance(self, count, radius, spread, zspread, points, colors, sizes):
-        sprite_size = self.sprite_size
-        arm_color = self.arms_color
-        disk_color = self.bulge_color
+            angles = numpy.sqrt(rng.random_sample(count)) * self.max_angle
+            shapes = numpy.array([self.shape_func(angle) for angle in angles.tolist()])
+            arm = numpy.empty((count, 3))
+            arm[:, 0] = i * numpy.cos(angles) * shapes + rng.normal(0.0, spread, count)
+            arm[:, 1] = i * numpy.sin(angles) * shapes + rng.normal(0.0, spread, count)
+            arm[:, 2] = rng.normal(0.0, zspread, count)
+            points.append(arm)
+        points = numpy.concatenate(points) * radius
+        #The color depends on the farthest point generated so far
+        distances = numpy.maximum.accumulate(numpy.linalg.norm(points, axis=1))
+        colors = color_array(self.arms_color)[numpy.newaxis, :] * (1 - 0.9 * distances ** (1. / self.sersic_disk))[:, numpy.newaxis]
+        colors[:, 3] = 1.0
+        sizes = self.sprite_size + rng.normal(0, self.sprite_size, len(points))
+        self.size = distances[-1] if len(distances) > 0 else 0.0
+        return (points, colors, sizes)
+
+    def create_spiral_distance(self, rng, count, radius, spread, zspread):
+        count *= 2
         bulge_size = self.bulge_size()
-        sersic_inv = 1. / self.sersic_disk
-        distance = 0
-        for c in range(count * 2):
-            r = sqrt(random() + bulge_size*bulge_size)
-            theta = random() * 2 * pi
-            x = r * cos(theta)
-            y = r * sin(theta)
-            z = gauss(0.0, zspread)
-            coef = 0.0
-            for c in (0, 1.):
-                arm_angle = self.inv_shape_func(r) * max(self.max_angle, 0.001) / (2 * pi)
-                mtheta = c * pi + theta
-                delta = abs(mtheta - arm_angle)
-                for i in range(int(self.max_angle / (2 * pi)) + 1):
-                    delta = min(delta, abs(mtheta - arm_angle - (i + 1) * 2 * pi), abs(mtheta - arm_angle + (i  + 1) * 2 * pi))
-                coef = max(pow(max(1 - delta / pi, 0.0), self.arm_spread), coef)
-            point = LPoint3d(x * radius, y * radius, z * radius)
-            points.append(point)
-            distance = max(distance, point.length())
-            color = disk_color * (1 - coef) + arm_color * coef
-            color = color * (1 - 0.9 * pow(r, sersic_inv))
-            color[3] = 1.0
-            colors.append(color)
-            size = sprite_size + gauss(0, sprite_size)
-            sizes.append(size)
-        self.size = distance
-
-    def create_points(self, radius=1.0):
-        points = []
-        colors = []
-        sizes = []
-        nb_points_bulge = self.nb_points_bulge
-        nb_points_arms = self.nb_points_arms
+        r = numpy.sqrt(rng.random_sample(count) + bulge_size * bulge_size)
+        theta = rng.random_sample(count) * 2 * pi
+        points = numpy.empty((count, 3))
+        points[:, 0] = r * numpy.cos(theta)
+        points[:, 1] = r * numpy.sin(theta)
+        points[:, 2] = rng.normal(0.0, zspread, count)
+        points *= radius
+        arm_angle = self.inv_shape_func(r) * max(self.max_angle, 0.001) / (2 * pi)
+        coef = numpy.zeros(count)
+        for c in (0, 1.):
+            mtheta = c * pi + theta
+            delta = numpy.abs(mtheta - arm_angle)
+            for i in range(int(self.max_angle / (2 * pi)) + 1):
+                delta = numpy.minimum(delta, numpy.minimum(numpy.abs(mtheta - arm_angle - (i + 1) * 2 * pi), numpy.abs(mtheta - arm_angle + (i  + 1) * 2 * pi)))
+            coef = numpy.maximum(numpy.maximum(1 - delta / pi, 0.0) ** self.arm_spread, coef)
+        coef = coef[:, numpy.newaxis]
+        colors = color_array(self.bulge_color)[numpy.newaxis, :] * (1 - coef) + color_array(self.arms_color)[numpy.newaxis, :] * coef
+        colors *= (1 - 0.9 * r ** (1. / self.sersic_disk))[:, numpy.newaxis]
+        colors[:, 3] = 1.0
+        sizes = self.sprite_size + rng.normal(0, self.sprite_size, count)
+        self.size = numpy.linalg.norm(points, axis=1).max() if count > 0 else 0.0
+        return (points, colors, sizes)
+
+    def create_disk(self, rng, count, radius, spread, zspread):
+        return self.create_spiral_distance(rng, count, radius, spread, zspread)
+
+    def create_points(self, rng, radius=1.0):
         spread = self.bulge_size() / 2
         zspread = spread / 2.0
-        self.create_bulge(nb_points_bulge, radius, spread, zspread, points, colors, sizes)
-        if True:
-            self.create_spiral_distance(nb_points_arms, radius, self.spread, self.zspread, points, colors, sizes)
-        else:
-            self.create_spiral(nb_points_arms, radius, self.spread, self.zspread, points, colors, sizes)
-        self.nb_points = nb_points_bulge + nb_points_arms
-        return (points, colors, sizes)
+        (bulge_points, bulge_colors, bulge_sizes) = self.create_bulge(rng, self.nb_points_bulge, radius, spread, zspread)
+        (disk_points, disk_colors, disk_sizes) = self.create_disk(rng, self.nb_points_arms, radius, self.spread, self.zspread)
+        self.nb_points = self.nb_points_bulge + self.nb_points_arms
+        return (numpy.concatenate([bulge_points, disk_points]),
+                numpy.concatenate([bulge_colors, disk_colors]),
+                numpy.concatenate([bulge_sizes, disk_sizes]))
 
     def get_user_parameters(self):
         return [
@@ -439,6 +558,7 @@ class SpiralGalaxyShapeBase(GalaxyShapeBase):
                 ]
 
 class FullSpiralGalaxyShape(SpiralGalaxyShapeBase):
+    cache_attributes = SpiralGalaxyShapeBase.cache_attributes + ['N', 'B']
     def __init__(self, N, B, radius=1.0, scale=None, nb_points_bulge=200, nb_points_arms=1000, spread=0.4, zspread=0.2, point_size=400, max_angle=2 * pi, sersic_bulge=4.0, sersic_disk=1.0):
         SpiralGalaxyShapeBase.__init__(self, radius, scale, nb_points_bulge, nb_points_arms, spread, zspread, point_size, max_angle, sersic_bulge, sersic_disk)
         self.N = N
@@ -454,7 +574,7 @@ class FullSpiralGalaxyShape(SpiralGalaxyShapeBase):
         return 1.0 / log(self.B * max(0.00001, tan(angle / (2 * self.N))))
 
     def inv_shape_func(self, distance):
-        return atan(exp(1.0 / distance) / self.B) * 2 * self.N
+        return numpy.arctan(numpy.exp(1.0 / distance) / self.B) * 2 * self.N
 
     def get_user_parameters(self):
         params = SpiralGalaxyShapeBase.get_user_parameters(self)
@@ -464,6 +584,7 @@ class FullSpiralGalaxyShape(SpiralGalaxyShapeBase):
         return params
 
 class FullRingGalaxyShape(SpiralGalaxyShapeBase):
+    cache_attributes = SpiralGalaxyShapeBase.cache_attributes + ['N', 'B']
     def __init__(self, N, B, radius=1.0, scale=None, nb_points_bulge=200, nb_points_arms=1000, spread=0.4, zspread=0.2, point_size=400, max_angle=2 * pi, sersic_bulge=4.0, sersic_disk=1.0):
         SpiralGalaxyShapeBase.__init__(self, radius, scale, nb_points_bulge, nb_points_arms, spread, zspread, point_size, max_angle, sersic_bulge, sersic_disk)
         self.N = N
@@ -479,7 +600,7 @@ class FullRingGalaxyShape(SpiralGalaxyShapeBase):
         return 1.0 / log(self.B * max(0.00001, tanh(angle / (2 * self.N))))
 
     def inv_shape_func(self, distance):
-        return atanh(exp(1.0 / distance) / self.B) * 2 * self.N
+        return numpy.arctanh(numpy.exp(1.0 / distance) / self.B) * 2 * self.N
 
     def get_user_parameters(self):
         params = SpiralGalaxyShapeBase.get_user_parameters(self)
@@ -490,6 +611,7 @@ class FullRingGalaxyShape(SpiralGalaxyShapeBase):
 
 class SpiralGalaxyShape(SpiralGalaxyShapeBase):
     bar_radius = 0.5
+    cache_attributes = SpiralGalaxyShapeBase.cache_attributes + ['pitch']
     def __init__(self, pitch, radius=1.0, scale=None, nb_points_bulge=200, nb_points_arms=1000, spread=0.4, zspread=0.2, point_size=400, max_angle=2 * pi, sersic_bulge=4.0, sersic_disk=1.0):
         SpiralGalaxyShapeBase.__init__(self, radius, scale, nb_points_bulge, nb_points_arms, spread, zspread, point_size, max_angle, sersic_bulge, sersic_disk)
         self.pitch = pitch
@@ -519,7 +641,7 @@ class SpiralGalaxyShape(SpiralGalaxyShapeBase):
 
     def inv_shape_func(self, distance):
         pitch = self.pitch
-        return pitch * exp((1 - self.bar_radius / distance) / (pitch * tan(pitch)))
+        return pitch * numpy.exp((1 - self.bar_radius / distance) / (pitch * tan(pitch)))
 
     def get_user_parameters(self):
         params = SpiralGalaxyShapeBase.get_user_parameters(self)
@@ -538,23 +660,24 @@ class LenticularGalaxyShape(SpiralGalaxyShapeBase):
     def bulge_size(self):
         return self.bulge_radius
 
-    def create_spiral(self, count, radius, spread, zspread, points, colors, sizes):
-        sprite_size = self.sprite_size
-        disk_color = self.yellow_color
-        sersic_inv = 1. / self.sersic_disk
-        for r in range(count * 2):
-            distance = self.bulge_radius + abs(gauss(0, (1 - self.bulge_radius)))
-            angle = random() * 2.0 * pi
-            x = distance * cos(angle) + gauss(0.0, spread)
-            y = distance * sin(angle) + gauss(0.0, spread)
-            z = gauss(0.0, zspread)
-            point = LPoint3d(x * radius, y * radius, z * radius)
-            points.append(point)
-            color = disk_color * (1 - 0.9 * pow(point, sersic_inv))
-            color[3] = 1.0
-            colors.append(color)
-            size = sprite_size + gauss(0, sprite_size)
-            sizes.append(size)
+    def create_spiral(self, rng, count, radius, spread, zspread):
+        count *= 2
+        distances = self.bulge_radius + numpy.abs(rng.normal(0, (1 - self.bulge_radius), count))
+        angles = rng.random_sample(count) * 2.0 * pi
+        points = numpy.empty((count, 3))
+        points[:, 0] = distances * numpy.cos(angles) + rng.normal(0.0, spread, count)
+        points[:, 1] = distances * numpy.sin(angles) + rng.normal(0.0, spread, count)
+        points[:, 2] = rng.normal(0.0, zspread, count)
+        points *= radius
+        lengths = numpy.linalg.norm(points, axis=1)
+        colors = color_array(self.yellow_color)[numpy.newaxis, :] * (1 - 0.9 * lengths ** (1. / self.sersic_disk))[:, numpy.newaxis]
+        colors[:, 3] = 1.0
+        sizes = self.sprite_size + rng.normal(0, self.sprite_size, count)
+        return (points, colors, sizes)
+
+    def create_disk(self, rng, count, radius, spread, zspread):
+        #A lenticular galaxy has no arms
+        return self.create_spiral(rng, count, radius, spread, zspread)
 
 class GalaxyPointControl(PointControl):
     use_vertex = True
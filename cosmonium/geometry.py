@@ -24,13 +24,14 @@ from __future__ import print_function
 from panda3d.core import Geom, GeomNode, GeomPatches, GeomPoints, GeomVertexData, GeomVertexArrayFormat, InternalName,\
     LVector3d, GlobPattern, BoundingBox, LPoint3, BoundingSphere
 from panda3d.core import GeomVertexFormat, GeomTriangles, GeomVertexWriter, ColorAttrib
-from panda3d.core import NodePath, VBase3, Vec3, LPoint3d, LPoint2d, BitMask32, LVector3
+from panda3d.core import NodePath, VBase3, Vec3, LPoint3d, LPoint2d, BitMask32
 from panda3d.egg import EggData, EggVertexPool, EggVertex, EggPolygon, loadEggData
 
 from .pstats import named_pstat
 from . import settings
 
 from math import sin, cos, pi, atan2, sqrt, asin
+import numpy
 
 def empty_node(prefix, color=False):
     path = NodePath(prefix + '_path')
@@ -715,6 +716,71 @@ def make_primitives_skirt(prim, inner, nb_vertices):
                 prim.addVertices(skirt + 1, v + 1, v + nb_vertices + 1)
                 prim.addVertices(skirt, v + 1, skirt + 1)
 
+def make_patch_primitives(inner, nb_vertices, ratio):
+    """Returns the triangles of a patch, the primitive is shared by all the patches with the same configuration"""
+    key = (inner, tuple(ratio), settings.use_patch_adaptation, settings.use_patch_skirts)
+    prim = patch_primitives_cache.get(key)
+    if prim is None:
+        prim = GeomTriangles(Geom.UHStatic)
+        if settings.use_patch_adaptation:
+            make_adapted_square_primitives(prim, inner, nb_vertices, ratio)
+            if settings.use_patch_skirts:
+                make_adapted_square_primitives_skirt(prim, inner, nb_vertices, ratio)
+        else:
+            make_square_primitives(prim, inner, nb_vertices)
+            if settings.use_patch_skirts:
+                make_primitives_skirt(prim, inner, nb_vertices)
+        prim.closePrimitive()
+        patch_primitives_cache[key] = prim
+    return prim
+
+patch_primitives_cache = {}
+
+def make_patch_grid(inner, nb_vertices):
+    """Returns the (i, j) grid coordinates of the vertices of a patch and whether the vertex belongs to the skirt"""
+    i, j = numpy.meshgrid(numpy.arange(nb_vertices), numpy.arange(nb_vertices), indexing='ij')
+    i = i.ravel()
+    j = j.ravel()
+    skirt = numpy.zeros(len(i), dtype=bool)
+    if settings.use_patch_skirts:
+        b = numpy.arange(nb_vertices)
+        zeros = numpy.zeros(nb_vertices, dtype=b.dtype)
+        full = numpy.full(nb_vertices, inner, dtype=b.dtype)
+        i = numpy.concatenate([i, zeros, full, b, b])
+        j = numpy.concatenate([j, b, b, zeros, full])
+        skirt = numpy.concatenate([skirt, numpy.ones(nb_vertices * 4, dtype=bool)])
+    return (i, j, skirt)
+
+def normalize_rows(vectors):
+    return vectors / numpy.linalg.norm(vectors, axis=1)[:, numpy.newaxis]
+
+def make_patch_geom(inner, nb_vertices, ratio, points, uvs, normals, tangents, binormals,
+                    inv_u=False, inv_v=False, swap_uv=False):
+    if inv_u:
+        uvs[:, 0] = 1.0 - uvs[:, 0]
+        tangents = -tangents
+    if inv_v:
+        uvs[:, 1] = 1.0 - uvs[:, 1]
+        binormals = -binormals
+    if swap_uv:
+        uvs = uvs[:, ::-1]
+        tangents, binormals = binormals, tangents
+    (path, node) = empty_node('uv')
+    #The columns are in the same order as in empty_geom()
+    data = numpy.hstack([points, uvs, normals, tangents, binormals]).astype(numpy.float32)
+    (gvw, gcw, gtw, gnw, gtanw, gbiw, prim, geom) = empty_geom('cube', len(data), 0, tanbin=True)
+    geom.modify_vertex_data().modify_array_handle(0).copy_data_from(data)
+    geom.addPrimitive(make_patch_primitives(inner, nb_vertices, ratio))
+    node.add_geom(geom)
+    return path
+
+def calc_patch_offsets(skirt, offset, dx, dy, inner):
+    if offset is None:
+        offset = 0
+    offsets = numpy.full(len(skirt), float(offset))
+    offsets[skirt] += sqrt(dx * dx + dy * dy) / inner
+    return offsets
+
 def Tile(size, inner, outer=None, inv_u=False, inv_v=False, swap_uv=False):
     (nb_vertices, inner, outer, ratio) = make_config(inner, outer)
     (path, node) = empty_node('uv')
@@ -919,128 +985,25 @@ def SquaredDistanceSquarePatch(height, inner, outer,
                 inv_u=False, inv_v=False, swap_uv=False,
                 x_inverted=False, y_inverted=False, xy_swap=False, offset=None):
     (nb_vertices, inner, outer, ratio) = make_config(inner, outer)
-    (path, node) = empty_node('uv')
-    nb_points = nb_vertices * nb_vertices
-    nb_primitives = inner * inner
-    if settings.use_patch_skirts:
-        nb_points += nb_vertices * 4
-        nb_primitives += inner * 4
-    (gvw, gcw, gtw, gnw, gtanw, gbiw, prim, geom) = empty_geom('cube', nb_points, nb_primitives, tanbin=True)
-    node.add_geom(geom)
-
-    if offset is not None:
-        normal = SquaredDistanceSquarePatchNormal(x0, y0, x1, y1, x_inverted, y_inverted, xy_swap)
+    normal = numpy.array(SquaredDistanceSquarePatchNormal(x0, y0, x1, y1, x_inverted, y_inverted, xy_swap))
 
     (x0, y0, x1, y1, dx, dy) = convert_xy(x0, y0, x1, y1, x_inverted, y_inverted, xy_swap)
 
-    for i in range(0, nb_vertices):
-        for j in range(0, nb_vertices):
-            u = float(i) / inner
-            v = float(j) / inner
-            x = x0 + i * dx / inner
-            y = y0 + j * dy / inner
-            x = 2.0 * x - 1.0
-            y = 2.0 * y - 1.0
-            z = 1.0
-            x2 = x * x
-            y2 = y * y
-            z2 = z * z
-            xp = x * sqrt(1.0 - y2 * 0.5 - z2 * 0.5 + y2 * z2 / 3.0)
-            yp = y * sqrt(1.0 - z2 * 0.5 - x2 * 0.5 + z2 * x2 / 3.0)
-            zp = z * sqrt(1.0 - x2 * 0.5 - y2 * 0.5 + x2 * y2 / 3.0)
-            if inv_u:
-                u = 1.0 - u
-            if inv_v:
-                v = 1.0 - v
-            if swap_uv:
-                u, v = v, u
-            gtw.add_data2f(u, v)
-            if offset is not None:
-                gvw.add_data3f(xp * height - normal[0] * offset,
-                               yp * height - normal[1] * offset,
-                               zp * height - normal[2] * offset)
-            else:
-                gvw.add_data3f(xp * height, yp * height, zp * height)
-            gnw.add_data3f(xp, yp, zp)
-            tan = LVector3(1.0, x * y * (z2 / 3.0 - 0.5), x * z * (y2 / 3.0 - 0.5))
-            tan.normalize()
-            bin = LVector3(x * y * (z2 / 3.0 - 0.5), 1.0, y * z * (x2 / 3.0 - 0.5))
-            bin.normalize()
-            if inv_u: tan = -tan
-            if inv_v: bin = -bin
-            if swap_uv:
-                tan, bin = bin, tan
-            gtanw.add_data3(tan)
-            gbiw.add_data3(bin)
-
-    if settings.use_patch_skirts:
-        if offset is None:
-            offset = 0
-        offset = offset + sqrt(dx * dx + dy * dy) / inner
-        for a in range(0, 4):
-            for b in range(0, nb_vertices):
-                if a == 0:
-                    i = 0
-                    j = b
-                elif a == 1:
-                    i = inner
-                    j = b
-                elif a == 2:
-                    i = b
-                    j = 0
-                elif a == 3:
-                    i = b
-                    j = inner
-                u = float(i) / inner
-                v = float(j) / inner
-                x = x0 + i * dx / inner
-                y = y0 + j * dy / inner
-                x = 2.0 * x - 1.0
-                y = 2.0 * y - 1.0
-                z = 1.0
-                x2 = x * x
-                y2 = y * y
-                z2 = z * z
-                xp = x * sqrt(1.0 - y2 * 0.5 - z2 * 0.5 + y2 * z2 / 3.0)
-                yp = y * sqrt(1.0 - z2 * 0.5 - x2 * 0.5 + z2 * x2 / 3.0)
-                zp = z * sqrt(1.0 - x2 * 0.5 - y2 * 0.5 + x2 * y2 / 3.0)
-                if inv_u:
-                    u = 1.0 - u
-                if inv_v:
-                    v = 1.0 - v
-                if swap_uv:
-                    u, v = v, u
-                gtw.add_data2f(u, v)
-                if offset is not None:
-                    gvw.add_data3f(xp * height - normal[0] * offset,
-                                   yp * height - normal[1] * offset,
-                                   zp * height - normal[2] * offset)
-                else:
-                    gvw.add_data3f(xp * height, yp * height, zp * height)
-                gnw.add_data3f(xp, yp, zp)
-                tan = LVector3(1.0, x * y * (z2 / 3.0 - 0.5), x * z * (y2 / 3.0 - 0.5))
-                tan.normalize()
-                bin = LVector3(x * y * (z2 / 3.0 - 0.5), 1.0, y * z * (x2 / 3.0 - 0.5))
-                bin.normalize()
-                if inv_u: tan = -tan
-                if inv_v: bin = -bin
-                if swap_uv:
-                    tan, bin = bin, tan
-                gtanw.add_data3(tan)
-                gbiw.add_data3(bin)
-
-    if settings.use_patch_adaptation:
-        make_adapted_square_primitives(prim, inner, nb_vertices, ratio)
-        if settings.use_patch_skirts:
-            make_adapted_square_primitives_skirt(prim, inner, nb_vertices, ratio)
-    else:
-        make_square_primitives(prim, inner, nb_vertices)
-        if settings.use_patch_skirts:
-            make_primitives_skirt(prim, inner, nb_vertices)
-    prim.closePrimitive()
-    geom.addPrimitive(prim)
-
-    return path
+    (i, j, skirt) = make_patch_grid(inner, nb_vertices)
+    offsets = calc_patch_offsets(skirt, offset, dx, dy, inner)
+    uvs = numpy.column_stack([i / inner, j / inner])
+    x = 2.0 * (x0 + i * dx / inner) - 1.0
+    y = 2.0 * (y0 + j * dy / inner) - 1.0
+    x2 = x * x
+    y2 = y * y
+    normals = numpy.column_stack([x * numpy.sqrt(1.0 - y2 * 0.5 - 0.5 + y2 / 3.0),
+                                  y * numpy.sqrt(1.0 - 0.5 - x2 * 0.5 + x2 / 3.0),
+                                  numpy.sqrt(1.0 - x2 * 0.5 - y2 * 0.5 + x2 * y2 / 3.0)])
+    points = normals * height - normal[numpy.newaxis, :] * offsets[:, numpy.newaxis]
+    ones = numpy.ones(len(x))
+    tangents = normalize_rows(numpy.column_stack([ones, x * y * (1.0 / 3.0 - 0.5), x * (y2 / 3.0 - 0.5)]))
+    binormals = normalize_rows(numpy.column_stack([x * y * (1.0 / 3.0 - 0.5), ones, y * (x2 / 3.0 - 0.5)]))
+    return make_patch_geom(inner, nb_vertices, ratio, points, uvs, normals, tangents, binormals, inv_u, inv_v, swap_uv)
 
 def SquaredDistanceSquarePatchPoint(radius,
                                     u, v,
@@ -1105,116 +1068,20 @@ def NormalizedSquarePatch(height, inner, outer,
                           global_texture=False, inv_u=False, inv_v=False, swap_uv=False,
                           x_inverted=False, y_inverted=False, xy_swap=False, offset=None):
     (nb_vertices, inner, outer, ratio) = make_config(inner, outer)
-    (path, node) = empty_node('uv')
-    nb_points = nb_vertices * nb_vertices
-    nb_primitives = inner * inner
-    if settings.use_patch_skirts:
-        nb_points += nb_vertices * 4
-        nb_primitives += inner * 4
-    (gvw, gcw, gtw, gnw, gtanw, gbiw, prim, geom) = empty_geom('cube', nb_points, nb_primitives, tanbin=True)
-    node.add_geom(geom)
-
-    if offset is not None:
-        normal = NormalizedSquarePatchNormal(x0, y0, x1, y1, x_inverted, y_inverted, xy_swap)
+    normal = numpy.array(NormalizedSquarePatchNormal(x0, y0, x1, y1, x_inverted, y_inverted, xy_swap))
 
     (x0, y0, x1, y1, dx, dy) = convert_xy(x0, y0, x1, y1, x_inverted, y_inverted, xy_swap)
 
-    for i in range(0, nb_vertices):
-        for j in range(0, nb_vertices):
-            x = x0 + i * dx / inner
-            y = y0 + j * dy / inner
-            x = 2.0 * x - 1.0
-            y = 2.0 * y - 1.0
-            vec = LVector3d(x, y, 1.0)
-            vec.normalize()
-            u = float(i) / inner
-            v = float(j) / inner
-            if inv_u:
-                u = 1.0 - u
-            if inv_v:
-                v = 1.0 - v
-            if swap_uv:
-                u, v = v, u
-            gtw.add_data2f(u, v)
-            nvec = vec
-            vec = vec * height
-            if offset is not None:
-                vec = vec - normal * offset
-            gvw.add_data3f(*vec)
-            gnw.add_data3f(nvec.x, nvec.y, nvec.z)
-            tan = LVector3(1.0 + y*y, -x*y, -x)
-            tan.normalize()
-            bin = LVector3(x * y, 1.0 + x*x, -y)
-            bin.normalize()
-            if inv_u: tan = -tan
-            if inv_v: bin = -bin
-            if swap_uv:
-                tan, bin = bin, tan
-            gtanw.add_data3(tan)
-            gbiw.add_data3(bin)
-
-    if settings.use_patch_skirts:
-        if offset is None:
-            offset = 0
-        offset = offset + sqrt(dx * dx + dy * dy) / inner
-        for a in range(0, 4):
-            for b in range(0, nb_vertices):
-                if a == 0:
-                    i = 0
-                    j = b
-                elif a == 1:
-                    i = inner
-                    j = b
-                elif a == 2:
-                    i = b
-                    j = 0
-                elif a == 3:
-                    i = b
-                    j = inner
-                x = x0 + i * dx / inner
-                y = y0 + j * dy / inner
-                x = 2.0 * x - 1.0
-                y = 2.0 * y - 1.0
-                vec = LVector3d(x, y, 1.0)
-                vec.normalize()
-                u = float(i) / inner
-                v = float(j) / inner
-                if inv_u:
-                    u = 1.0 - u
-                if inv_v:
-                    v = 1.0 - v
-                if swap_uv:
-                    u, v = v, u
-                gtw.add_data2f(u, v)
-                nvec = vec
-                vec = vec * height
-                if offset is not None:
-                    vec = vec - normal * offset
-                gvw.add_data3f(*vec)
-                gnw.add_data3f(nvec.x, nvec.y, nvec.z)
-                tan = LVector3(1.0 + y*y, -x*y, -x)
-                tan.normalize()
-                bin = LVector3(x * y, 1.0 + x*x, -y)
-                bin.normalize()
-                if inv_u: tan = -tan
-                if inv_v: bin = -bin
-                if swap_uv:
-                    tan, bin = bin, tan
-                gtanw.add_data3(tan)
-                gbiw.add_data3(bin)
-
-    if settings.use_patch_adaptation:
-        make_adapted_square_primitives(prim, inner, nb_vertices, ratio)
-        if settings.use_patch_skirts:
-            make_adapted_square_primitives_skirt(prim, inner, nb_vertices, ratio)
-    else:
-        make_square_primitives(prim, inner, nb_vertices)
-        if settings.use_patch_skirts:
-            make_primitives_skirt(prim, inner, nb_vertices)
-    prim.closePrimitive()
-    geom.addPrimitive(prim)
-
-    return path
+    (i, j, skirt) = make_patch_grid(inner, nb_vertices)
+    offsets = calc_patch_offsets(skirt, offset, dx, dy, inner)
+    uvs = numpy.column_stack([i / inner, j / inner])
+    x = 2.0 * (x0 + i * dx / inner) - 1.0
+    y = 2.0 * (y0 + j * dy / inner) - 1.0
+    normals = normalize_rows(numpy.column_stack([x, y, numpy.ones(len(x))]))
+    points = normals * height - normal[numpy.newaxis, :] * offsets[:, numpy.newaxis]
+    tangents = normalize_rows(numpy.column_stack([1.0 + y * y, -x * y, -x]))
+    binormals = normalize_rows(numpy.column_stack([x * y, 1.0 + x * x, -y]))
+    return make_patch_geom(inner, nb_vertices, ratio, points, uvs, normals, tangents, binormals, inv_u, inv_v, swap_uv)
 
 def NormalizedSquarePatchPoint(radius,
                                u, v,
@@ -25,11 +25,59 @@ from .patchedshapes import PatchLodControl
 from .textures import TexCoord, AutoTextureSource, TextureBase, HeightMapTexture
 from .interpolator import BilinearInterpolator
 from .dircontext import defaultDirContext
+from . import settings
 
 import traceback
 import numpy
 import sys
 
+def texture_to_heights(texture, signed=False):
+    """
+    Decode the RAM image of the heightmap texture into a float32 array of heights, indexed by [y, x].
+    """
+    data = texture.getRamImage()
+    #TODO: should be completed and refactored
+    component_type = texture.getComponentType()
+    if component_type == Texture.T_float:
+        buffer_type = numpy.float32
+        scale = 1.0
+    elif component_type == Texture.T_unsigned_byte:
+        if signed:
+            buffer_type = numpy.int8
+            scale = 128.0
+        else:
+            buffer_type = numpy.uint8
+            scale = 255.0
+    elif component_type == Texture.T_unsigned_short:
+        if signed:
+            buffer_type = numpy.int16
+            scale = 32768.0
+        else:
+            buffer_type = numpy.uint16
+            scale = 65535.0
+    if sys.version_info[0] < 3:
+        buf = data.getData()
+        np_buffer = numpy.fromstring(buf, dtype=buffer_type)
+    else:
+        np_buffer = numpy.frombuffer(data, buffer_type)
+    nb_components = texture.getNumComponents()
+    np_buffer = np_buffer.reshape((texture.getYSize(), texture.getXSize(), nb_components))
+    #RAM images are stored in BGR(A) order
+    if nb_components >= 3:
+        channels = (2, 1, 0, 3)
+    else:
+        channels = (0, 1, 2, 3)
+    if settings.encode_float and nb_components == 4:
+        heights = np_buffer[:, :, channels[0]].astype(numpy.float32)
+        heights += np_buffer[:, :, channels[1]] / 255.0
+        heights += np_buffer[:, :, channels[2]] / 65025.0
+        heights += np_buffer[:, :, channels[3]] / 16581375.0
+    else:
+        heights = np_buffer[:, :, channels[0]].astype(numpy.float32)
+    if scale != 1.0:
+        heights /= scale
+    return heights
+
 #TODO: HeightmapPatch has common code with Heightmap and TextureHeightmapBase, this should be refactored
 #TODO: Texture data should be refactored like appearance to be fully independent from the source
 
@@ -63,8 +111,9 @@ class HeightmapPatch:
         self.patch = None
         self.heightmap_ready = False
         self.texture = None
-        self.texture_peeker = None
+        self.heights = None
         self.callback = None
+        self.pending_callbacks = []
         self.cloned = False
         self.texture_offset = LVector2()
         self.texture_scale = LVector2(1, 1)
@@ -119,7 +168,7 @@ class HeightmapPatch:
         self.cloned = True
         self.lod = heightmap_patch.lod
         self.texture = heightmap_patch.texture
-        self.texture_peeker = heightmap_patch.texture_peeker
+        self.heights = heightmap_patch.heights
         self.heightmap_ready = heightmap_patch.heightmap_ready
         self.min_height = heightmap_patch.min_height
         self.max_height = heightmap_patch.max_height
@@ -149,21 +198,35 @@ class HeightmapPatch:
         pass
 
     def get_height(self, x, y):
-        if self.texture_peeker is None:
-            print("No peeker", self.patch.str_id(), self.patch.instance_ready)
+        if self.heights is None:
+            print("No height data", self.patch.str_id(), self.patch.instance_ready)
             traceback.print_stack()
             return 0.0
         new_x = x * self.texture_scale[0] + self.texture_offset[0] * self.width
         new_y = y * self.texture_scale[1] + self.texture_offset[1] * self.height
         new_x = min(new_x, self.width - 1)
         new_y = min(new_y, self.height - 1)
-        height = self.parent.interpolator.get_value(self.texture_peeker, new_x, new_y)
+        height = self.parent.interpolator.get_value(self.heights, new_x, new_y)
         #TODO: This should be done in PatchedHeightmap.get_height()
         return height * self.parent.height_scale# + self.parent.offset
 
+    def get_heights(self, xs, ys):
+        if self.heights is None:
+            print("No height data", self.patch.str_id(), self.patch.instance_ready)
+            return numpy.zeros(len(xs))
+        new_x = numpy.asarray(xs, dtype=numpy.float64) * self.texture_scale[0] + self.texture_offset[0] * self.width
+        new_y = numpy.asarray(ys, dtype=numpy.float64) * self.texture_scale[1] + self.texture_offset[1] * self.height
+        new_x = numpy.minimum(new_x, self.width - 1)
+        new_y = numpy.minimum(new_y, self.height - 1)
+        heights = self.parent.interpolator.get_values(self.heights, new_x, new_y)
+        return heights * self.parent.height_scale
+
     def get_height_uv(self, u, v):
         return self.get_height(u * self.width, v * self.height)
 
+    def get_heights_uv(self, us, vs):
+        return self.get_heights(numpy.asarray(us) * self.width, numpy.asarray(vs) * self.height)
+
     def load(self, patch, callback, cb_args=()):
         if self.texture is None:
             self.texture = Texture()
@@ -179,40 +242,11 @@ class HeightmapPatch:
         if texture is not None:
             self.texture = texture
             #print("READY", self.patch.str_id(), texture, self.texture)
-            self.texture_peeker = texture.peek()
-#           if self.texture_peeker is None:
-#               print("NOT READY !!!")
             self.heightmap_ready = True
-            data = self.texture.getRamImage()
-            #TODO: should be completed and refactored
-            signed = False
-            component_type = texture.getComponentType()
-            if component_type == Texture.T_float:
-                buffer_type = numpy.float32
-                scale = 1.0
-            elif component_type == Texture.T_unsigned_byte:
-                if signed:
-                    buffer_type = numpy.int8
-                    scale = 128.0
-                else:
-                    buffer_type = numpy.uint8
-                    scale = 255.0
-            elif component_type == Texture.T_unsigned_short:
-                if signed:
-                    buffer_type = numpy.int16
-                    scale = 32768.0
-                else:
-                    buffer_type = numpy.uint16
-                    scale = 65535.0
-            if sys.version_info[0] < 3:
-                buf = data.getData()
-                np_buffer = numpy.fromstring(buf, dtype=buffer_type)
-            else:
-                np_buffer = numpy.frombuffer(data, buffer_type)
-            np_buffer.shape = (self.texture.getYSize(), self.texture.getXSize(), self.texture.getNumComponents())
-            self.min_height = np_buffer.min() / scale
-            self.max_height = np_buffer.max() / scale
-            self.mean_height = np_buffer.mean() / scale
+            self.heights = texture_to_heights(texture)
+            self.min_height = float(self.heights.min())
+            self.max_height = float(self.heights.max())
+            self.mean_height = float(self.heights.mean())
         else:
             if self.parent_heightmap is not None:
                 self.calc_sub_patch()
@@ -225,6 +259,16 @@ class HeightmapPatch:
                 self.heightmap_ready_cb(texture, None, None)
         if callback is not None:
             callback(self, *cb_args)
+        pending_callbacks = self.pending_callbacks
+        self.pending_callbacks = []
+        for (callback, cb_args) in pending_callbacks:
+            callback(self, *cb_args)
+
+    def rebind(self, patch, callback, cb_args):
+        #The patch was removed and created again while the heightmap was being generated
+        self.patch = patch
+        if callback is not None:
+            self.pending_callbacks.append((callback, cb_args))
 
     def do_load(self, patch, callback, cb_args):
         pass
@@ -315,9 +359,15 @@ class Heightmap(object):
     def get_height(self, x, y):
         return None
 
+    def get_heights(self, xs, ys):
+        return None
+
     def get_height_uv(self, u, v):
         return self.get_height(u * self.width, v * self.height)
 
+    def get_heights_uv(self, us, vs):
+        return self.get_heights(numpy.asarray(us) * self.width, numpy.asarray(vs) * self.height)
+
     def get_heightmap(self, patch):
         return self
 
@@ -328,12 +378,14 @@ class TextureHeightmapBase(Heightmap):
     def __init__(self, name, width, height, height_scale, u_scale, v_scale, median, interpolator):
         Heightmap.__init__(self, name, width, height, height_scale, u_scale, v_scale, median, interpolator)
         self.texture = None
+        self.heights = None
         self.texture_offset = LVector2()
         self.texture_scale = LVector2(1, 1)
         self.tex_id = str(width) + ':' + str(height)
 
     def reset(self):
         self.texture = None
+        self.heights = None
 
     def get_texture_offset(self, patch):
         return self.texture_offset
@@ -347,17 +399,28 @@ class TextureHeightmapBase(Heightmap):
         pass
 
     def get_height(self, x, y):
-        if self.texture_peeker is None:
-            print("No peeker")
+        if self.heights is None:
+            print("No height data")
             traceback.print_stack()
             return 0.0
         new_x = x * self.texture_scale[0] + self.texture_offset[0] * self.width
         new_y = y * self.texture_scale[1] + self.texture_offset[1] * self.height
         new_x = min(new_x, self.width - 1)
         new_y = min(new_y, self.height - 1)
-        height = self.interpolator.get_value(self.texture_peeker, new_x, new_y)
+        height = self.interpolator.get_value(self.heights, new_x, new_y)
         return height * self.height_scale# + self.offset
 
+    def get_heights(self, xs, ys):
+        if self.heights is None:
+            print("No height data")
+            return numpy.zeros(len(xs))
+        new_x = numpy.asarray(xs, dtype=numpy.float64) * self.texture_scale[0] + self.texture_offset[0] * self.width
+        new_y = numpy.asarray(ys, dtype=numpy.float64) * self.texture_scale[1] + self.texture_offset[1] * self.height
+        new_x = numpy.minimum(new_x, self.width - 1)
+        new_y = numpy.minimum(new_y, self.height - 1)
+        heights = self.interpolator.get_values(self.heights, new_x, new_y)
+        return heights * self.height_scale
+
     def create_heightmap(self, shape, callback=None, cb_args=()):
         return self.load(shape, callback, cb_args)
 
@@ -374,20 +437,11 @@ class TextureHeightmapBase(Heightmap):
 
     def heightmap_ready_cb(self, texture, callback, cb_args):
         #print("READY", self.patch.str_id())
-        self.texture_peeker = self.texture.peek()
-#         if self.texture_peeker is None:
-#             print("NOT READY !!!")
         self.heightmap_ready = True
-        data = self.texture.getRamImage()
-        if sys.version_info[0] < 3:
-            buf = data.getData()
-            np_buffer = numpy.fromstring(buf, dtype=numpy.float32)
-        else:
-            np_buffer = numpy.frombuffer(data, numpy.float32)
-        np_buffer.shape = (self.texture.getYSize(), self.texture.getXSize(), self.texture.getNumComponents())
-        self.min_height = np_buffer.min()
-        self.max_height = np_buffer.max()
-        self.mean_height = np_buffer.mean()
+        self.heights = texture_to_heights(self.texture)
+        self.min_height = float(self.heights.min())
+        self.max_height = float(self.heights.max())
+        self.mean_height = float(self.heights.mean())
         if callback is not None:
             callback(self, *cb_args)
 
@@ -476,8 +530,11 @@ class PatchedHeightmap(Heightmap):
         else:
             #print("CACHE", patch.str_id())
             heightmap = self.map_patch[patch.str_id()]
-            if heightmap.is_ready() and callback is not None:
-                callback(heightmap, *cb_args)
+            if heightmap.is_ready():
+                if callback is not None:
+                    callback(heightmap, *cb_args)
+            elif heightmap.patch is not patch:
+                heightmap.rebind(patch, callback, cb_args)
             else:
                 print("PATCH NOT READY?", heightmap.heightmap_ready, callback)
 
@@ -485,6 +542,11 @@ class PatchedHeightmap(Heightmap):
         heightmap = self.map_patch[patch.str_id()]
         heightmap.apply(patch)
 
+    def remove_heightmap(self, patch):
+        heightmap = self.map_patch.get(patch.str_id(), None)
+        if heightmap is not None and heightmap.patch is patch:
+            del self.map_patch[patch.str_id()]
+
 class StackedHeightmapPatch(HeightmapPatch):
     def __init__(self, patches, *args, **kwargs):
         HeightmapPatch.__init__(self, *args, **kwargs)
@@ -506,6 +568,12 @@ class StackedHeightmapPatch(HeightmapPatch):
             height += patch.get_height(x, y)
         return height
 
+    def get_heights(self, xs, ys):
+        heights = numpy.zeros(len(xs))
+        for patch in self.patches:
+            heights += patch.get_heights(xs, ys)
+        return heights
+
     def sub_callback(self, patch):
         self.count += 1
         if self.count == len(self.patches):
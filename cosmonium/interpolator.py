@@ -21,51 +21,83 @@ from __future__ import print_function
 from __future__ import absolute_import
 from __future__ import division
 
-from panda3d.core import LColor, Texture
+from panda3d.core import Texture
 
 from .heightmapshaders import HeightmapDataSource
-from . import settings
 
 from math import floor
+import numpy
+
+def nearest_value(data, x, y):
+    height, width = data.shape
+    i = min(max(int(floor(x)), 0), width - 1)
+    j = min(max(int(floor(y)), 0), height - 1)
+    return data.item(j, i)
+
+def nearest_values(data, xs, ys):
+    height, width = data.shape
+    i = numpy.clip(numpy.floor(xs), 0, width - 1).astype(numpy.intp)
+    j = numpy.clip(numpy.floor(ys), 0, height - 1).astype(numpy.intp)
+    return data[j, i].astype(numpy.float64)
+
+def bilinear_value(data, x, y):
+    height, width = data.shape
+    x -= 0.5
+    y -= 0.5
+    i0 = int(floor(x))
+    j0 = int(floor(y))
+    f_x = x - i0
+    f_y = y - j0
+    if 0 <= i0 < width - 1:
+        i1 = i0 + 1
+    else:
+        i0 = i1 = 0 if i0 < 0 else width - 1
+    if 0 <= j0 < height - 1:
+        j1 = j0 + 1
+    else:
+        j0 = j1 = 0 if j0 < 0 else height - 1
+    p00 = data.item(j0, i0)
+    p01 = data.item(j0, i1)
+    p10 = data.item(j1, i0)
+    p11 = data.item(j1, i1)
+    a = p00 + (p01 - p00) * f_x
+    b = p10 + (p11 - p10) * f_x
+    return a + (b - a) * f_y
+
+def bilinear_values(data, xs, ys):
+    height, width = data.shape
+    xs = numpy.asarray(xs, dtype=numpy.float64) - 0.5
+    ys = numpy.asarray(ys, dtype=numpy.float64) - 0.5
+    x0 = numpy.floor(xs)
+    y0 = numpy.floor(ys)
+    f_x = xs - x0
+    f_y = ys - y0
+    i0 = numpy.clip(x0, 0, width - 1).astype(numpy.intp)
+    i1 = numpy.clip(x0 + 1, 0, width - 1).astype(numpy.intp)
+    j0 = numpy.clip(y0, 0, height - 1).astype(numpy.intp)
+    j1 = numpy.clip(y0 + 1, 0, height - 1).astype(numpy.intp)
+    p00 = data[j0, i0]
+    p01 = data[j0, i1]
+    p10 = data[j1, i0]
+    p11 = data[j1, i1]
+    a = p00 + (p01 - p00) * f_x
+    b = p10 + (p11 - p10) * f_x
+    return a + (b - a) * f_y
 
 class TexInterpolator(object):
+    """
+    Interpolates the height data of a heightmap, stored as a 2D float32 array indexed by [y, x].
+    Coordinates are expressed in texels, values outside the array are clamped to its border.
+    """
     def __init__(self):
         pass
 
-    def get_single_value(self, peeker, x, y, clamp=True):
-        x /= peeker.get_x_size()
-        y /= peeker.get_y_size()
-        if clamp:
-            x = min(max(x, 0.0), 1.0)
-            y = min(max(y, 0.0), 1.0)
-        value = LColor()
-        peeker.lookup(value, x, y)
-        if settings.encode_float:
-            value = value[0] + value[1] / 255.0 + value[2] / 65025.0 + value[3] / 16581375.0
-        else:
-            value = value[0]
-        return value
-
-    def get_bilinear_value(self, peeker, x, y, clamp=True):
-        x /= peeker.get_x_size()
-        y /= peeker.get_y_size()
-        if clamp:
-            x = min(max(x, 0.0), 1.0)
-            y = min(max(y, 0.0), 1.0)
-        value = LColor()
-        result = peeker.lookup_bilinear(value, x, y)
-        if not result:
-            print("Invalid offsets", x, y)
-            return 0.0
-        if settings.encode_float:
-            value = value[0] + value[1] / 255.0 + value[2] / 65025.0 + value[3] / 16581375.0
-        else:
-            value = value[0]
-        return value
-
-    def get_value(self, peeker, x, y):
+    def get_value(self, data, x, y):
         return None
 
+    def get_values(self, data, xs, ys):
+        return numpy.array([self.get_value(data, x, y) for (x, y) in zip(xs, ys)], dtype=numpy.float64)
+
     def configure_texture(self, texture):
         pass
 
@@ -73,8 +105,11 @@ class TexInterpolator(object):
         return None
 
 class NearestInterpolator(TexInterpolator):
-    def get_value(self, peeker, x, y):
-        return self.get_single_value(peeker, x, y)
+    def get_value(self, data, x, y):
+        return nearest_value(data, x, y)
+
+    def get_values(self, data, xs, ys):
+        return nearest_values(data, xs, ys)
 
     def configure_texture(self, texture):
         texture.setMinfilter(Texture.FT_nearest)
@@ -84,8 +119,11 @@ class NearestInterpolator(TexInterpolator):
         return HeightmapDataSource.F_none
 
 class BilinearInterpolator(TexInterpolator):
-    def get_value(self, peeker, x, y):
-        return self.get_bilinear_value(peeker, x, y)
+    def get_value(self, data, x, y):
+        return bilinear_value(data, x, y)
+
+    def get_values(self, data, xs, ys):
+        return bilinear_values(data, xs, ys)
 
     def configure_texture(self, texture):
         texture.setMinfilter(Texture.FT_linear)
@@ -95,8 +133,11 @@ class BilinearInterpolator(TexInterpolator):
         return HeightmapDataSource.F_none
 
 class ImprovedBilinearInterpolator(TexInterpolator):
-    def get_value(self, peeker, x, y):
-        return self.get_bilinear_value(peeker, x, y)
+    def get_value(self, data, x, y):
+        return bilinear_value(data, x, y)
+
+    def get_values(self, data, xs, ys):
+        return bilinear_values(data, xs, ys)
 
     def configure_texture(self, texture):
         texture.setMinfilter(Texture.FT_nearest)
@@ -106,19 +147,20 @@ class ImprovedBilinearInterpolator(TexInterpolator):
         return HeightmapDataSource.F_improved_bilinear
 
 class QuinticInterpolator(TexInterpolator):
-    def get_value(self, peeker, x, y):
-        x += 0.5
-        y += 0.5
-
-        i_x = floor(x)
-        i_y = floor(y)
+    def quintic(self, x, floor_func):
+        x = x + 0.5
+        i_x = floor_func(x)
         f_x = x - i_x
-        f_y = y - i_y
-
         f_x = f_x*f_x*f_x*(f_x*(f_x*6.0-15.0)+10.0)
-        f_y = f_y*f_y*f_y*(f_y*(f_y*6.0-15.0)+10.0)
+        return i_x + f_x - 0.5
 
-        return self.get_bilinear_value(peeker, i_x + f_x - 0.5, i_y + f_y - 0.5)
+    def get_value(self, data, x, y):
+        return bilinear_value(data, self.quintic(x, floor), self.quintic(y, floor))
+
+    def get_values(self, data, xs, ys):
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        ys = numpy.asarray(ys, dtype=numpy.float64)
+        return bilinear_values(data, self.quintic(xs, numpy.floor), self.quintic(ys, numpy.floor))
 
     def configure_texture(self, texture):
         texture.setMinfilter(Texture.FT_linear)
@@ -144,15 +186,15 @@ class BSplineInterpolator(TexInterpolator):
         w3 = 1./6. * alpha3
         return (w0, w1, w2, w3)
 
-    def get_value(self, peeker, x, y):
-        tc_x = floor(x - 0.5) + 0.5
-        tc_y = floor(y - 0.5) + 0.5
+    def bspline_offsets(self, x, y, floor_func):
+        tc_x = floor_func(x - 0.5) + 0.5
+        tc_y = floor_func(y - 0.5) + 0.5
 
         alpha_x = x - tc_x
         alpha_y = y - tc_y
         cubic_x = self.cubic(alpha_x)
         cubic_y = self.cubic(alpha_y)
-    
+
         s_x = cubic_x[0] + cubic_x[1]
         s_y = cubic_x[2] + cubic_x[3]
         s_z = cubic_y[0] + cubic_y[1]
@@ -164,15 +206,29 @@ class BSplineInterpolator(TexInterpolator):
 
         sx = s_x / (s_x + s_y)
         sy = s_z / (s_z + s_w)
-
-        p00 = self.get_bilinear_value(peeker, offset_x, offset_z)
-        p01 = self.get_bilinear_value(peeker, offset_y, offset_z)
-        p10 = self.get_bilinear_value(peeker, offset_x, offset_w)
-        p11 = self.get_bilinear_value(peeker, offset_y, offset_w)
-
-        def mix(x, y, a):
-            return x * (1.0 - a) + y * a
-
-        a = mix(p01, p00, sx)
-        b = mix(p11, p10, sx)
-        return mix(b, a, sy)
+        return (offset_x, offset_y, offset_z, offset_w, sx, sy)
+
+    def mix(self, x, y, a):
+        return x * (1.0 - a) + y * a
+
+    def get_value(self, data, x, y):
+        (offset_x, offset_y, offset_z, offset_w, sx, sy) = self.bspline_offsets(x, y, floor)
+        p00 = bilinear_value(data, offset_x, offset_z)
+        p01 = bilinear_value(data, offset_y, offset_z)
+        p10 = bilinear_value(data, offset_x, offset_w)
+        p11 = bilinear_value(data, offset_y, offset_w)
+        a = self.mix(p01, p00, sx)
+        b = self.mix(p11, p10, sx)
+        return self.mix(b, a, sy)
+
+    def get_values(self, data, xs, ys):
+        xs = numpy.asarray(xs, dtype=numpy.float64)
+        ys = numpy.asarray(ys, dtype=numpy.float64)
+        (offset_x, offset_y, offset_z, offset_w, sx, sy) = self.bspline_offsets(xs, ys, numpy.floor)
+        p00 = bilinear_values(data, offset_x, offset_z)
+        p01 = bilinear_values(data, offset_y, offset_z)
+        p10 = bilinear_values(data, offset_x, offset_w)
+        p11 = bilinear_values(data, offset_y, offset_w)
+        a = self.mix(p01, p00, sx)
+        b = self.mix(p11, p10, sx)
+        return self.mix(b, a, sy)
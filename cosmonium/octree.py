@@ -19,13 +19,20 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
+from . import settings
+
 try:
     from cosmonium_engine import OctreeNode, OctreeLeaf, InfiniteFrustum, VisibleObjectsTraverser
     hasOctreeLeaf = True
+    CoherentVisibleObjectsTraverser = None
     print("Using C++ Engine")
 except ImportError as e:
     print("WARNING: Could not load Octree C implementation, fallback on python implementation")
     print("\t", e)
-    from .pyengine.pyoctree import OctreeNode, OctreeLeaf, VisibleObjectsTraverser
+    if settings.octree_array_leaves:
+        from .pyengine.pyoctree import ArrayOctreeNode as OctreeNode
+    else:
+        from .pyengine.pyoctree import OctreeNode
+    from .pyengine.pyoctree import OctreeLeaf, VisibleObjectsTraverser, CoherentVisibleObjectsTraverser
     from .pyengine.pyfrustum import InfiniteFrustum
     hasOctreeLeaf = False
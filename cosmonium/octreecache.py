@@ -0,0 +1,151 @@
+#
+#This file is part of Cosmonium.
+#
+#Copyright (C) 2018-2019 Laurent Deru.
+#
+#Cosmonium is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Cosmonium is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Cosmonium.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+from panda3d.core import LPoint3d
+
+from . import cache
+
+import hashlib
+import numpy
+import os
+
+octree_cell_dtype = numpy.dtype([('parent', '<i4'),
+                                 ('index', '<i4'),
+                                 ('level', '<i4'),
+                                 ('center', '<f8', (3,)),
+                                 ('width', '<f8'),
+                                 ('threshold', '<f8'),
+                                 ('max_magnitude', '<f8'),
+                                 ('has_children', '?'),
+                                 ('leaves_start', '<i8'),
+                                 ('leaves_count', '<i4')])
+
+class OctreeCache(object):
+    """Store the structure of a built octree in the cache directory.
+    The cells are stored as a flat array in pre-order and the leaves as indexes in the list of
+    objects used to build the octree. The entry is keyed by a hash of the content of the leaves.
+    Only the max_entries most recently used octrees are kept."""
+    version = 1
+    max_entries = 4
+
+    def __init__(self, name='octree'):
+        self.name = name
+        self.path = None
+
+    def get_path(self):
+        if self.path is None:
+            self.path = cache.create_path_for(self.name)
+        return self.path
+
+    def calc_key(self, root, positions, magnitudes, extends):
+        key = hashlib.sha1()
+        key.update(str((self.version, root.__class__.__name__, root.max_leaves, root.max_level, root.child_threshold,
+                        tuple(root.center), root.width, root.threshold)).encode('ascii'))
+        key.update(numpy.ascontiguousarray(positions, dtype='<f8').tobytes())
+        key.update(numpy.ascontiguousarray(magnitudes, dtype='<f8').tobytes())
+        key.update(numpy.ascontiguousarray(extends, dtype='<f8').tobytes())
+        return key.hexdigest()
+
+    def get_filenames(self, key):
+        path = self.get_path()
+        return (os.path.join(path, key + '-cells.npy'), os.path.join(path, key + '-leaves.npy'))
+
+    def load(self, root, key, objects):
+        (cells_filename, leaves_filename) = self.get_filenames(key)
+        if not os.path.exists(cells_filename) or not os.path.exists(leaves_filename):
+            return False
+        try:
+            cells = numpy.load(cells_filename, mmap_mode='r')
+            leaves = numpy.load(leaves_filename, mmap_mode='r')
+        except (IOError, ValueError) as e:
+            print("Could not load octree cache", e)
+            return False
+        if cells.dtype != octree_cell_dtype or len(cells) == 0:
+            print("Invalid octree cache")
+            return False
+        try:
+            os.utime(cells_filename, None)
+        except OSError:
+            pass
+        node_class = root.__class__
+        nodes = []
+        for cell in cells:
+            parent = int(cell['parent'])
+            if parent < 0:
+                node = root
+            else:
+                node = node_class(int(cell['level']), LPoint3d(*cell['center']), float(cell['width']), float(cell['threshold']), int(cell['index']))
+                nodes[parent].children[node.index] = node
+            node.max_magnitude = float(cell['max_magnitude'])
+            node.has_children = bool(cell['has_children'])
+            start = int(cell['leaves_start'])
+            count = int(cell['leaves_count'])
+            node.leaves = [objects[i] for i in leaves[start:start + count].tolist()]
+            nodes.append(node)
+        return True
+
+    def export_cell(self, node, parent, cells, leaves, objects_ids):
+        cell_id = len(cells)
+        cells.append((parent, node.index, node.level, tuple(node.center), node.width, node.threshold,
+                      node.max_magnitude, node.has_children, len(leaves), len(node.leaves)))
+        for leaf in node.leaves:
+            leaves.append(objects_ids[id(leaf)])
+        for child in node.children:
+            if child is not None:
+                self.export_cell(child, cell_id, cells, leaves, objects_ids)
+
+    def store(self, root, key, objects):
+        objects_ids = {}
+        for (i, obj) in enumerate(objects):
+            objects_ids[id(obj)] = i
+        cells = []
+        leaves = []
+        self.export_cell(root, -1, cells, leaves, objects_ids)
+        (cells_filename, leaves_filename) = self.get_filenames(key)
+        try:
+            numpy.save(leaves_filename, numpy.array(leaves, dtype='<i4'))
+            numpy.save(cells_filename, numpy.array(cells, dtype=octree_cell_dtype))
+        except IOError as e:
+            print("Could not store octree cache", e)
+        self.trim(self.max_entries)
+
+    def trim(self, max_entries):
+        #Remove the least recently used octrees, the cells file is touched when the octree is loaded
+        path = self.get_path()
+        keys = []
+        for entry in os.listdir(path):
+            if entry.endswith('-cells.npy'):
+                try:
+                    mtime = os.path.getmtime(os.path.join(path, entry))
+                except OSError:
+                    continue
+                keys.append((mtime, entry[:-len('-cells.npy')]))
+        keys.sort(reverse=True)
+        for (mtime, key) in keys[max_entries:]:
+            for filename in self.get_filenames(key):
+                try:
+                    os.remove(filename)
+                except OSError as e:
+                    print("Could not remove octree cache", filename, ':', e)
+
+    def clear(self):
+        self.trim(0)
@@ -256,12 +256,14 @@ class ConfigParser(YamlParser):
         settings.debug_jump = data.get('instant-jump', settings.debug_jump)
         settings.sync_data_load = data.get('aync-data-load', settings.sync_data_load)
         settings.sync_texture_load = data.get('sync-texture-load', settings.sync_texture_load)
+        settings.loader_threads = data.get('loader-threads', settings.loader_threads)
 
     def encode_debug(self):
         data = {}
         data['instant-jump'] = settings.debug_jump
         data['sync-data-load'] = settings.sync_data_load
         data['sync-texture-load'] = settings.sync_texture_load
+        data['loader-threads'] = settings.loader_threads
         return data
 
     def decode_screenshots(self, data):
@@ -282,11 +284,13 @@ class ConfigParser(YamlParser):
     def decode_patches(self, data):
         settings.cull_far_patches = data.get('cull-far-patches', settings.cull_far_patches)
         settings.cull_far_patches_threshold = data.get('cull-far-patches-threshold', settings.cull_far_patches_threshold)
+        settings.texture_cache_size = data.get('texture-cache-size', settings.texture_cache_size)
 
     def encode_patches(self):
         data = {}
         data['cull-far-patches'] = settings.cull_far_patches
         data['cull-far-patches-threshold'] = settings.cull_far_patches_threshold
+        data['texture-cache-size'] = settings.texture_cache_size
         return data
 
     def decode(self, data):
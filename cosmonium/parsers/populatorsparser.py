@@ -39,7 +39,11 @@ class PlacerYamlParser(YamlModuleParser):
         extra = {}
         (placer_type, placer_data) = self.get_type_and_data(data, default)
         if placer_type == 'random':
-            placer = RandomObjectPlacer()
+            seed = placer_data.get('seed', 0)
+            min_scale = placer_data.get('min-scale', 0.1)
+            max_scale = placer_data.get('max-scale', 0.5)
+            max_slope = placer_data.get('max-slope', None)
+            placer = RandomObjectPlacer(seed, min_scale, max_scale, max_slope)
         else:
             print("Unknown placer", placer_type)
         return placer
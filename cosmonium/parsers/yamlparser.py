@@ -21,13 +21,16 @@ from __future__ import print_function
 from __future__ import absolute_import
 
 from ..dircontext import defaultDirContext, DirContext
-from ..cache import create_path_for
+from ..cache import create_path_for, replace_file
 from ..import settings
 
 import os
 import hashlib
 import pickle
+import mmap
 import io
+import re
+from time import time
 
 import ruamel.yaml
 
@@ -109,6 +112,175 @@ class YamlParser(object):
                 object_data = data
         return (object_type, object_data)
 
+class YamlCache(object):
+    """Consolidated cache of the parsed YAML files.
+
+    The cache is made of an index and a single blob file containing the pickled content of each file,
+    the blobs are keyed by the hash of the content of the YAML file. The index is loaded once and
+    the blob file is memory mapped, so a warm start needs only one read.
+    Each blob file written gets a new name, referenced by the index, and both are written to temporary
+    files first, so an interrupted save leaves the previous cache usable."""
+    version = 2
+
+    def __init__(self, name='yaml'):
+        self.name = name
+        self.loaded = False
+        self.files = {}
+        self.blobs = {}
+        self.new_blobs = {}
+        self.blob_name = None
+        self.blob_map = None
+        self.blob_file = None
+        self.dirty = False
+
+    def get_path(self):
+        return create_path_for('config')
+
+    def get_index_filename(self):
+        return os.path.join(self.get_path(), self.name + '-index.dat')
+
+    def calc_hash(self, content):
+        return hashlib.sha1(content).hexdigest()
+
+    def load_index(self):
+        self.loaded = True
+        index_file = self.get_index_filename()
+        if not os.path.exists(index_file): return
+        try:
+            with open(index_file, "rb") as f:
+                index = pickle.load(f)
+            if index.get('version') != self.version:
+                print("Incompatible YAML cache version", index.get('version'))
+                return
+            blob_file = os.path.join(self.get_path(), index['blob-name'])
+            self.blob_file = open(blob_file, "rb")
+            if os.path.getsize(blob_file) > 0:
+                self.blob_map = mmap.mmap(self.blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.files = index['files']
+            self.blobs = index['blobs']
+            self.blob_name = index['blob-name']
+        except Exception as e:
+            print("Could not read YAML cache", index_file, ':', e)
+            self.close()
+            self.files = {}
+            self.blobs = {}
+            self.blob_name = None
+
+    def close(self):
+        if self.blob_map is not None:
+            self.blob_map.close()
+            self.blob_map = None
+        if self.blob_file is not None:
+            self.blob_file.close()
+            self.blob_file = None
+
+    def get_blob(self, content_hash):
+        blob = self.new_blobs.get(content_hash)
+        if blob is not None:
+            return blob
+        if self.blob_map is None or content_hash not in self.blobs: return None
+        (offset, length) = self.blobs[content_hash]
+        return self.blob_map[offset:offset + length]
+
+    def load(self, filepath, content_hash):
+        if not self.loaded:
+            self.load_index()
+        blob = self.get_blob(content_hash)
+        if blob is None: return None
+        try:
+            start = time()
+            data = pickle.loads(blob)
+            self.record(filepath, content_hash, load_time=time() - start)
+            return data
+        except Exception as e:
+            print("Could not read cache for", filepath, ':', e)
+            return None
+
+    def store(self, filepath, content_hash, data, parse_time):
+        if not self.loaded:
+            self.load_index()
+        try:
+            self.new_blobs[content_hash] = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError) as e:
+            print("Could not cache", filepath, ':', e)
+            return
+        self.record(filepath, content_hash, parse_time=parse_time)
+
+    def record(self, filepath, content_hash, parse_time=None, load_time=None):
+        entry = self.files.get(filepath)
+        if entry is None or entry['hash'] != content_hash:
+            entry = {'hash': content_hash, 'parse-time': None, 'load-time': None}
+            self.files[filepath] = entry
+        if parse_time is not None:
+            entry['parse-time'] = parse_time
+        if load_time is not None:
+            entry['load-time'] = load_time
+        self.dirty = True
+
+    def write_file(self, filename, content):
+        tmp_filename = filename + '.tmp'
+        try:
+            with open(tmp_filename, "wb") as f:
+                f.write(content)
+            replace_file(tmp_filename, filename)
+        except (IOError, OSError) as e:
+            print("Could not write YAML cache", filename, ':', e)
+            return False
+        return True
+
+    def save_index(self, files, blobs, blob_name):
+        index = {'version': self.version, 'files': files, 'blobs': blobs, 'blob-name': blob_name}
+        return self.write_file(self.get_index_filename(), pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+
+    def remove_unused_files(self):
+        #Remove the blob files no longer referenced and the per-file caches of the previous versions
+        blob_file_re = re.compile(re.escape(self.name) + r'-blobs(-[0-9a-f]+)?\.dat(\.tmp)?$')
+        legacy_file_re = re.compile(r'[0-9a-f]{32}\.dat$')
+        path = self.get_path()
+        for entry in os.listdir(path):
+            if entry == self.blob_name: continue
+            if blob_file_re.match(entry) or legacy_file_re.match(entry):
+                try:
+                    os.remove(os.path.join(path, entry))
+                except OSError as e:
+                    print("Could not remove", entry, ':', e)
+
+    def get_timings(self):
+        return dict((filepath, (entry['parse-time'], entry['load-time'])) for (filepath, entry) in self.files.items())
+
+    def save(self):
+        if not self.dirty: return
+        if len(self.new_blobs) == 0 and self.blob_name is not None:
+            #Only the timings have changed, the blob file is still valid
+            self.save_index(self.files, self.blobs, self.blob_name)
+            self.dirty = False
+            return
+        #Only the blobs still referenced by a file are kept
+        content = []
+        blobs = {}
+        offset = 0
+        for content_hash in sorted(set(entry['hash'] for entry in self.files.values())):
+            blob = self.get_blob(content_hash)
+            if blob is None: continue
+            blob = bytes(blob)
+            blobs[content_hash] = (offset, len(blob))
+            content.append(blob)
+            offset += len(blob)
+        files = dict((filepath, entry) for (filepath, entry) in self.files.items() if entry['hash'] in blobs)
+        #The new blob file is written under a new name before the index referencing it is replaced
+        blob_name = '%s-blobs-%s.dat' % (self.name, self.calc_hash(repr(sorted(blobs.items())).encode('ascii'))[:16])
+        self.close()
+        if self.write_file(os.path.join(self.get_path(), blob_name), b''.join(content)):
+            if self.save_index(files, blobs, blob_name):
+                self.blob_name = blob_name
+                self.remove_unused_files()
+        self.files = files
+        self.new_blobs = {}
+        self.dirty = False
+        self.loaded = False
+
+yamlCache = YamlCache()
+
 class YamlModuleParser(YamlParser):
     context = defaultDirContext
     translation = None
@@ -153,34 +325,15 @@ class YamlModuleParser(YamlParser):
             new_context.add_path(category, os.path.join(path, category))
         return new_context
 
-    def load_from_cache(self, filename, filepath):
-        data = None
-        config_path = create_path_for('config')
-        md5 = hashlib.md5(filepath.encode()).hexdigest()
-        cache_file = os.path.join(config_path, md5 + ".dat")
-        if os.path.exists(cache_file):
-            file_timestamp = os.path.getmtime(filepath)
-            cache_timestamp = os.path.getmtime(cache_file)
-            if cache_timestamp > file_timestamp:
-                print("Loading %s (cached)" % filepath)
-                base.splash.set_text("Loading %s (cached)" % filepath)
-                try:
-                    with open(cache_file, "rb") as f:
-                        data = pickle.load(f)
-                except (IOError, ValueError) as e:
-                    print("Could not read cache for", filename, cache_file, ':', e)
+    def load_from_cache(self, filename, filepath, content_hash):
+        data = yamlCache.load(filepath, content_hash)
+        if data is not None:
+            print("Loading %s (cached)" % filepath)
+            base.splash.set_text("Loading %s (cached)" % filepath)
         return data
 
-    def store_to_cache(self, data, filename, filepath):
-        config_path = create_path_for('config')
-        md5 = hashlib.md5(filepath.encode()).hexdigest()
-        cache_file = os.path.join(config_path, md5 + ".dat")
-        try:
-            with open(cache_file, "wb") as f:
-                print("Caching into", cache_file)
-                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
-        except IOError as e:
-            print("Could not write cache for", filename, cache_file, ':', e)
+    def store_to_cache(self, data, filename, filepath, content_hash, parse_time):
+        yamlCache.store(filepath, content_hash, data, parse_time)
 
     def load_and_parse(self, filename, parent=None, context=None):
         data = None
@@ -190,18 +343,22 @@ class YamlModuleParser(YamlParser):
         if filepath is not None:
             saved_context = YamlModuleParser.context
             YamlModuleParser.context = self.create_new_context(context, filepath)
-            if settings.cache_yaml:
-                data = self.load_from_cache(filename, filepath)
-            if data is None:
-                print("Loading %s" % filepath)
-                base.splash.set_text("Loading %s" % filepath)
-                try:
-                    text = io.open(filepath, encoding='utf8').read()
-                    data = self.parse(text, filepath)
-                except IOError as e:
-                    print("Could not read", filename, filepath, ':', e)
-                if settings.cache_yaml and data is not None:
-                    self.store_to_cache(data, filename, filepath)
+            try:
+                content = io.open(filepath, 'rb').read()
+            except IOError as e:
+                print("Could not read", filename, filepath, ':', e)
+                content = None
+            if content is not None:
+                if settings.cache_yaml:
+                    content_hash = yamlCache.calc_hash(content)
+                    data = self.load_from_cache(filename, filepath, content_hash)
+                if data is None:
+                    print("Loading %s" % filepath)
+                    base.splash.set_text("Loading %s" % filepath)
+                    start = time()
+                    data = self.parse(content.decode('utf8'), filepath)
+                    if settings.cache_yaml and data is not None:
+                        self.store_to_cache(data, filename, filepath, content_hash, time() - start)
             if data is not None:
                 if parent is not None:
                     data = self.decode(data, parent)
@@ -91,6 +91,7 @@ class PatchBase(Shape):
         self.instanciate_pending = False
         self.shown = False
         self.visible = False
+        self.removed = False
         self.apparent_size = None
         self.patch_in_view = False
         self.last_split = 0
@@ -131,6 +132,7 @@ class PatchBase(Shape):
             child.parent = None
             child.remove_instance()
             child.shown = False
+            child.removed = True
         self.children = []
 
     def can_show_children(self):
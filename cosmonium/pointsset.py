@@ -20,16 +20,21 @@
 from __future__ import print_function
 from __future__ import absolute_import
 
-from panda3d.core import GeomVertexArrayFormat, InternalName, GeomVertexFormat, GeomVertexData, GeomVertexWriter
+from panda3d.core import GeomVertexArrayFormat, InternalName, GeomVertexFormat, GeomVertexData
 from panda3d.core import GeomPoints, Geom, GeomNode
 from panda3d.core import NodePath, OmniBoundingVolume, DrawMask
 from .foundation import VisibleObject
 from .appearances import ModelAppearance
 from .shaders import BasicShader, FlatLightingModel, StaticSizePointControl
 from .sprites import SimplePoint, RoundDiskPointSprite
+from .pstats import named_pstat
+
+import numpy
 
 class PointsSet(VisibleObject):
     tex = None
+    initial_capacity = 1024
+
     def __init__(self, use_sprites=True, use_sizes=True, points_size=2, sprite=None, background=None, shader=None):
         self.gnode = GeomNode('starfield')
         self.use_sprites = use_sprites
@@ -40,6 +45,14 @@ class PointsSet(VisibleObject):
             shader = BasicShader(lighting_model=FlatLightingModel(), vertex_oids=True)
         self.shader = shader
 
+        #The points are stored in an interleaved float32 buffer using the same layout as the vertex data
+        self.nb_columns = 3 + 4
+        if self.use_sizes:
+            self.nb_columns += 1
+        if self.use_oids:
+            self.nb_columns += 4
+        self.data = numpy.zeros((self.initial_capacity, self.nb_columns), dtype=numpy.float32)
+        self.vdata = None
         self.reset()
 
         self.geom = self.makeGeom([], [], [], [])
@@ -74,21 +87,68 @@ class PointsSet(VisibleObject):
         pass
 
     def reset(self):
-        self.points = []
-        self.colors = []
-        self.sizes = []
-        self.oids = []
+        self.nb_points = 0
+        #Values of the points added one by one, converted in one go when the buffer is updated
+        self.rows = []
+
+    def reserve(self, nb_points):
+        capacity = len(self.data)
+        if self.nb_points + nb_points <= capacity: return
+        while self.nb_points + nb_points > capacity:
+            capacity *= 2
+        data = numpy.zeros((capacity, self.nb_columns), dtype=numpy.float32)
+        data[:self.nb_points] = self.data[:self.nb_points]
+        self.data = data
 
     def add_point(self, position, color, size, oid):
-        self.points.append(position)
-        self.colors.append(color)
-        self.sizes.append(size)
-        self.oids.append(oid)
+        if self.use_sizes and self.use_oids:
+            self.rows.extend((position[0], position[1], position[2],
+                              color[0], color[1], color[2], color[3],
+                              size,
+                              oid[0], oid[1], oid[2], oid[3]))
+        elif self.use_sizes:
+            self.rows.extend((position[0], position[1], position[2],
+                              color[0], color[1], color[2], color[3],
+                              size))
+        elif self.use_oids:
+            self.rows.extend((position[0], position[1], position[2],
+                              color[0], color[1], color[2], color[3],
+                              oid[0], oid[1], oid[2], oid[3]))
+        else:
+            self.rows.extend((position[0], position[1], position[2],
+                              color[0], color[1], color[2], color[3]))
+
+    def flush_rows(self):
+        if len(self.rows) == 0: return
+        rows = numpy.array(self.rows, dtype=numpy.float32).reshape(-1, self.nb_columns)
+        self.rows = []
+        nb_points = len(rows)
+        self.reserve(nb_points)
+        self.data[self.nb_points:self.nb_points + nb_points] = rows
+        self.nb_points += nb_points
+
+    def add_points(self, positions, colors, sizes, oids):
+        """Add the points given as arrays of n rows, the sizes and oids are ignored if they are not used."""
+        self.flush_rows()
+        nb_points = len(positions)
+        self.reserve(nb_points)
+        data = self.data[self.nb_points:self.nb_points + nb_points]
+        data[:, 0:3] = positions
+        data[:, 3:7] = colors
+        column = 7
+        if self.use_sizes:
+            data[:, column] = sizes
+            column += 1
+        if self.use_oids:
+            data[:, column:column + 4] = oids
+        self.nb_points += nb_points
 
+    @named_pstat("points_update")
     def update(self):
-        self.update_arrays(self.points, self.colors, self.sizes, self.oids)
+        self.flush_rows()
+        self.upload(self.data, self.nb_points)
 
-    def makeGeom(self, points, colors, sizes, oids):
+    def create_vertex_data(self):
         array = GeomVertexArrayFormat()
         array.addColumn(InternalName.get_vertex(), 3, Geom.NTFloat32, Geom.CPoint)
         array.addColumn(InternalName.get_color(), 4, Geom.NTFloat32, Geom.CColor)
@@ -100,33 +160,27 @@ class PointsSet(VisibleObject):
         format = GeomVertexFormat()
         format.addArray(array)
         format = GeomVertexFormat.registerFormat(format)
-        vdata = GeomVertexData('vdata', format, Geom.UH_static)
-        vdata.unclean_set_num_rows(len(points))
-        self.vwriter = GeomVertexWriter(vdata, InternalName.get_vertex())
-        self.colorwriter = GeomVertexWriter(vdata, InternalName.get_color())
-        if self.use_sizes:
-            self.sizewriter = GeomVertexWriter(vdata, InternalName.get_size())
-        if self.use_oids:
-            self.oidwriter = GeomVertexWriter(vdata, oids_column_name)
-        geompoints = GeomPoints(Geom.UH_static)
-        geompoints.reserve_num_vertices(len(points))
-        index = 0
-        for (point, color, size, oid) in zip(points, colors, sizes, oids):
-            self.vwriter.addData3f(*point)
-            #self.colorwriter.addData3f(color[0], color[1], color[2])
-            self.colorwriter.addData4(color)
-            if self.use_sizes:
-                self.sizewriter.addData1f(size)
-            if self.use_oids:
-                self.oidwriter.addData4(oid)
-            geompoints.addVertex(index)
-            geompoints.closePrimitive()
-            index += 1
-        geom = Geom(vdata)
+        self.vdata = GeomVertexData('vdata', format, Geom.UH_stream)
+
+    def upload(self, data, nb_points):
+        self.vdata.unclean_set_num_rows(nb_points)
+        if nb_points > 0:
+            self.vdata.modify_array_handle(0).copy_data_from(data[:nb_points])
+        geompoints = self.geom.modify_primitive(0)
+        geompoints.set_nonindexed_vertices(0, nb_points)
+
+    def makeGeom(self, points, colors, sizes, oids):
+        if self.vdata is None:
+            self.create_vertex_data()
+        geompoints = GeomPoints(Geom.UH_stream)
+        geom = Geom(self.vdata)
         geom.addPrimitive(geompoints)
+        self.geom = geom
+        self.update_arrays(points, colors, sizes, oids)
         return geom
 
     def update_arrays(self, points, colors, sizes, oids):
-        self.gnode.removeAllGeoms()
-        self.geom = self.makeGeom(points, colors, sizes, oids)
-        self.gnode.addGeom(self.geom)
+        self.reset()
+        if len(points) > 0:
+            self.add_points(points, colors, sizes, oids)
+        self.update()
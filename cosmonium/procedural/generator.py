@@ -25,8 +25,19 @@ from panda3d.core import FrameBufferProperties, GraphicsPipe, WindowProperties
 from direct.task import Task
 
 from ..shaders import ShaderProgram
+from ..textures import TexCoord
+from .numpynoise import generate_noise_tile, cpu_supported
 from .. import settings
 
+from collections import deque
+from math import ceil, sqrt
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import traceback
+import numpy
+import sys
+import os
+
 class GeneratorVertexShader(ShaderProgram):
     def __init__(self):
         ShaderProgram.__init__(self, 'vertex')
@@ -45,6 +56,66 @@ class GeneratorVertexShader(ShaderProgram):
         code.append("gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;")
         code.append("texcoord = p3d_MultiTexCoord0;")
 
+def make_buffer_properties(texture_format):
+    props = FrameBufferProperties()
+    props.set_srgb_color(False)
+    if texture_format == Texture.F_rgb:
+        props.set_float_color(False)
+        props.set_rgba_bits(8, 8, 8, 0)
+    elif texture_format == Texture.F_rgba:
+        props.set_float_color(False)
+        props.set_rgba_bits(8, 8, 8, 8)
+    elif texture_format == Texture.F_r32:
+        props.set_float_color(True)
+        props.set_rgba_bits(32, 0, 0, 0)
+    elif texture_format == Texture.F_rgb32:
+        props.set_float_color(True)
+        props.set_rgba_bits(32, 32, 32, 0)
+    elif texture_format == Texture.F_rgba32:
+        props.set_float_color(True)
+        props.set_rgba_bits(32, 32, 32, 32)
+    return props
+
+def make_tile_quad(parent, width, height):
+    cm = CardMaker("plane")
+    cm.set_frame(0, width, 0, height)
+    x_margin = 1.0 / width / 2.0
+    y_margin = 1.0 / height / 2.0
+    cm.set_uv_range((-x_margin, -y_margin), (1 + x_margin, 1 + y_margin))
+    quad = parent.attach_new_node(cm.generate())
+    quad.look_at(0, 0, -1)
+    return quad
+
+class TexGeneratorRequest(object):
+    """A texture to generate. When the request is made for a patch, the nearest visible patches are generated first
+    and the request is dropped if the patch is removed before the generation."""
+    __slots__ = ['shader', 'face', 'texture', 'callback', 'cb_args', 'patch', 'cancel_cb']
+
+    def __init__(self, shader, face, texture, callback, cb_args, patch, cancel_cb):
+        self.shader = shader
+        self.face = face
+        self.texture = texture
+        self.callback = callback
+        self.cb_args = cb_args
+        self.patch = patch
+        self.cancel_cb = cancel_cb
+
+    def get_priority(self):
+        if self.patch is None:
+            return (False, 0.0)
+        return (not self.patch.visible, self.patch.distance)
+
+    def is_stale(self):
+        return self.patch is not None and self.patch.removed
+
+    def cancel(self):
+        if self.cancel_cb is not None:
+            self.cancel_cb()
+
+    def done(self):
+        if self.callback is not None:
+            self.callback(self.texture, *self.cb_args)
+
 class TexGenerator(object):
     def __init__(self):
         self.root = None
@@ -52,30 +123,14 @@ class TexGenerator(object):
         self.buffer = None
         self.busy = False
         self.first = True
-        self.queue = []
-        self.processed = []
+        self.queue = deque()
+        self.processed = deque()
 
     def make_buffer(self, width, height, texture_format):
         self.width = width
         self.height = height
         self.root = NodePath("root")
-        props = FrameBufferProperties()
-        props.set_srgb_color(False)
-        if texture_format == Texture.F_rgb:
-            props.set_float_color(False)
-            props.set_rgba_bits(8, 8, 8, 0)
-        elif texture_format == Texture.F_rgba:
-            props.set_float_color(False)
-            props.set_rgba_bits(8, 8, 8, 8)
-        elif texture_format == Texture.F_r32:
-            props.set_float_color(True)
-            props.set_rgba_bits(32, 0, 0, 0)
-        elif texture_format == Texture.F_rgb32:
-            props.set_float_color(True)
-            props.set_rgba_bits(32, 32, 32, 0)
-        elif texture_format == Texture.F_rgba32:
-            props.set_float_color(True)
-            props.set_rgba_bits(32, 32, 32, 32)
+        props = make_buffer_properties(texture_format)
         self.buffer = base.win.make_texture_buffer("generatorBuffer", width, height, to_ram=True, fbp=props)
         #print(self.buffer.get_fb_properties(), self.buffer.get_texture())
         self.buffer.setOneShot(True)
@@ -88,13 +143,7 @@ class TexGenerator(object):
         lens.set_film_size(width, height)
         cam.node().set_lens(lens)          
         #plane with the texture
-        cm = CardMaker("plane")
-        cm.set_frame(0, width, 0, height)
-        x_margin = 1.0 / width / 2.0
-        y_margin = 1.0 / height / 2.0
-        cm.set_uv_range((-x_margin, -y_margin), (1 + x_margin, 1 + y_margin))
-        self.quad = self.root.attach_new_node(cm.generate())
-        self.quad.look_at(0, 0, -1)
+        self.quad = make_tile_quad(self.root, width, height)
         taskMgr.add(self.check_generation, 'check_generation', sort = -10000)
         taskMgr.add(self.callback, 'callback', sort = -9999)
         print("Created offscreen buffer, size: %dx%d" % (width, height), "format:", Texture.formatFormat(texture_format))
@@ -107,28 +156,29 @@ class TexGenerator(object):
 
     def callback(self, task):
         if len(self.processed) > 0:
-            (shader, face, texture, callback, cb_args) = self.processed[0]
-            if texture.has_ram_image():
-                if callback is not None:
-                    #print(texture)
-                    #print(self.buffer.get_fb_properties(), self.buffer.get_texture())
-                    callback(texture, *cb_args)
-                self.processed.pop(0)
+            request = self.processed[0]
+            if request.texture.has_ram_image():
+                #print(request.texture)
+                #print(self.buffer.get_fb_properties(), self.buffer.get_texture())
+                request.done()
+                self.processed.popleft()
         return Task.cont
 
     def check_generation(self, task):
         if self.buffer is None:
             return Task.cont
         if self.first and len(self.queue) > 0:
-            (shader, face, texture, callback, cb_args) = self.queue[0]
-            if not texture.has_ram_image():
+            request = self.queue[0]
+            if not request.texture.has_ram_image():
                 #print("FIRST")
                 self.buffer.setOneShot(True)
             else:
                 self.first = False
             return Task.cont
         if len(self.queue) > 0:
-            self.processed.append(self.queue.pop(0))
+            self.processed.append(self.queue.popleft())
+            while len(self.queue) > 0 and self.queue[0].is_stale():
+                self.queue.popleft().cancel()
             if len(self.queue) > 0:
                 self.schedule_next()
             else:
@@ -144,22 +194,23 @@ class TexGenerator(object):
         self.buffer.add_render_texture(texture, GraphicsOutput.RTM_copy_ram)
 
     def schedule_next(self):
-        (shader, face, texture, callback, cb_args) = self.queue[0]
-        self.prepare(shader, face, texture)
+        request = self.queue[0]
+        self.prepare(request.shader, request.face, request.texture)
 
-    def schedule(self, item):
-        self.queue.append(item)
+    def schedule(self, request):
+        self.queue.append(request)
         if not self.busy:
             #print("SCHEDULE")
-            (shader, face, texture, callback, cb_args) = item
-            self.prepare(shader, face, texture)
+            self.prepare(request.shader, request.face, request.texture)
             self.busy = True
 
-    def generate(self, shader, face, texture, callback=None, cb_args=()):
+    def generate(self, shader, face, texture, callback=None, cb_args=(), patch=None, cancel_cb=None):
         #print("ADD")
         if texture.has_ram_image() and callback is not None:
             print("Texture already has data")
-        self.schedule((shader, face, texture, callback, cb_args))
+        request = TexGeneratorRequest(shader, face, texture, callback, cb_args, patch, cancel_cb)
+        self.schedule(request)
+        return request
 
 class GeneratorPool(object):
     def __init__(self, number):
@@ -172,9 +223,340 @@ class GeneratorPool(object):
         for generator in self.generators:
             generator.make_buffer(width, height, texture_format)
 
-    def generate(self, shader, face, texture, callback=None, cb_args=()):
+    def generate(self, shader, face, texture, callback=None, cb_args=(), patch=None, cancel_cb=None):
         lowest = self.generators[0]
         for generator in self.generators[1:]:
             if len(generator.queue) < len(lowest.queue):
                 lowest = generator
-        lowest.generate(shader, face, texture, callback, cb_args)
+        return lowest.generate(shader, face, texture, callback, cb_args, patch, cancel_cb)
+
+class BatchTexGenerator(object):
+    """Generate up to batch_size tiles in a single pass. The tiles are rendered side by side in an atlas
+    which is then split into the requested textures. The pending requests are ordered by patch distance
+    at each frame and the requests of the removed patches are dropped."""
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.root = None
+        self.quads = []
+        self.buffer = None
+        self.atlas = None
+        self.queue = []
+        self.batch = []
+
+    def make_buffer(self, width, height, texture_format):
+        self.width = width
+        self.height = height
+        max_size = base.win.gsg.get_max_texture_dimension()
+        self.columns = int(ceil(sqrt(self.batch_size)))
+        if max_size > 0:
+            self.columns = max(1, min(self.columns, max_size // width))
+        self.rows = int(ceil(self.batch_size / float(self.columns)))
+        if max_size > 0:
+            self.rows = max(1, min(self.rows, max_size // height))
+        self.batch_size = min(self.batch_size, self.columns * self.rows)
+        atlas_width = self.columns * width
+        atlas_height = self.rows * height
+        self.root = NodePath("root")
+        props = make_buffer_properties(texture_format)
+        self.buffer = base.win.make_texture_buffer("batchGeneratorBuffer", atlas_width, atlas_height, to_ram=True, fbp=props)
+        self.buffer.set_one_shot(True)
+        self.atlas = self.buffer.get_texture()
+        cam = base.makeCamera(win=self.buffer)
+        cam.reparent_to(self.root)
+        cam.set_pos(atlas_width / 2, atlas_height / 2, 100)
+        cam.set_p(-90)
+        lens = OrthographicLens()
+        lens.set_film_size(atlas_width, atlas_height)
+        cam.node().set_lens(lens)
+        for i in range(self.batch_size):
+            slot = self.root.attach_new_node("slot")
+            slot.set_pos((i % self.columns) * width, (i // self.columns) * height, 0)
+            self.quads.append(make_tile_quad(slot, width, height))
+        taskMgr.add(self.check_generation, 'check_batch_generation', sort = -10000)
+        print("Created offscreen atlas buffer, size: %dx%d (%d tiles of %dx%d)" % (atlas_width, atlas_height, self.batch_size, width, height),
+              "format:", Texture.formatFormat(texture_format))
+
+    def remove(self):
+        if self.buffer is not None:
+            self.buffer.set_active(False)
+            base.graphicsEngine.removeWindow(self.buffer)
+            self.buffer = None
+
+    def split_batch(self):
+        data = self.atlas.get_ram_image()
+        if sys.version_info[0] < 3:
+            atlas = numpy.fromstring(data.get_data(), dtype=numpy.uint8)
+        else:
+            atlas = numpy.frombuffer(data, dtype=numpy.uint8)
+        texel_size = self.atlas.get_num_components() * self.atlas.get_component_width()
+        atlas = atlas.reshape((self.rows * self.height, self.columns * self.width, texel_size))
+        for (i, request) in enumerate(self.batch):
+            x = (i % self.columns) * self.width
+            y = (i // self.columns) * self.height
+            tile = atlas[y:y + self.height, x:x + self.width]
+            request.texture.setup_2d_texture(self.width, self.height, self.atlas.get_component_type(), self.atlas.get_format())
+            request.texture.set_ram_image(tile.tobytes())
+        #Without RAM image, the next rendered batch can be detected
+        self.atlas.clear_ram_image()
+        batch = self.batch
+        self.batch = []
+        for request in batch:
+            request.done()
+
+    def prepare_batch(self):
+        queue = []
+        for request in self.queue:
+            if request.is_stale():
+                request.cancel()
+            else:
+                queue.append(request)
+        queue.sort(key=TexGeneratorRequest.get_priority)
+        self.batch = queue[:self.batch_size]
+        self.queue = queue[self.batch_size:]
+        for (i, quad) in enumerate(self.quads):
+            if i < len(self.batch):
+                request = self.batch[i]
+                quad.set_shader(request.shader.shader)
+                request.shader.update(quad, face=request.face)
+                quad.show()
+            else:
+                quad.hide()
+        self.buffer.set_one_shot(True)
+
+    def check_generation(self, task):
+        if self.buffer is None:
+            return Task.cont
+        if len(self.batch) > 0:
+            if not self.atlas.has_ram_image():
+                #The batch was not rendered yet, e.g. the first frame of the buffer
+                self.buffer.set_one_shot(True)
+                return Task.cont
+            self.split_batch()
+        if len(self.queue) > 0:
+            self.prepare_batch()
+        return Task.cont
+
+    def generate(self, shader, face, texture, callback=None, cb_args=(), patch=None, cancel_cb=None):
+        request = TexGeneratorRequest(shader, face, texture, callback, cb_args, patch, cancel_cb)
+        self.queue.append(request)
+        return request
+
+def create_patch_generator(width, height, texture_format):
+    if settings.batch_generator:
+        generator = BatchTexGenerator(settings.generator_batch_size)
+    else:
+        generator = GeneratorPool(settings.patch_pool_size)
+    generator.make_buffer(width, height, texture_format)
+    return generator
+
+def create_worker_pool(number=None, use_threads=False):
+    if number is None:
+        number = settings.cpu_generator_workers
+    if number is None:
+        number = multiprocessing.cpu_count()
+    if use_threads:
+        return ThreadPool(number)
+    try:
+        context = multiprocessing.get_context('fork')
+    except (AttributeError, ValueError):
+        context = None
+    if context is not None:
+        return context.Pool(number)
+    elif os.name == 'posix':
+        return multiprocessing.Pool(number)
+    else:
+        #Without fork the workers would re-run the main script, use threads instead
+        return ThreadPool(number)
+
+worker_pool = None
+
+def start_worker_pool():
+    """Create the pool of worker processes. The workers are forked, so the pool must be created at startup,
+    before the loader threads and the graphics engine are started."""
+    global worker_pool
+    if worker_pool is None:
+        worker_pool = create_worker_pool()
+    return worker_pool
+
+def get_worker_pool():
+    global worker_pool
+    if worker_pool is None:
+        #Forking a process already running threads could deadlock the workers on a lock held by another thread
+        print("Worker pool not created at startup, using threads instead")
+        worker_pool = create_worker_pool(use_threads=True)
+    return worker_pool
+
+def use_cpu_generator(noise):
+    return settings.cpu_generator and not settings.encode_float and cpu_supported(noise)
+
+class CpuTexGenerator(object):
+    """Generate the noise textures on the CPU, the noise graph is evaluated with NumPy by a pool of worker processes.
+    The generated textures match the ones generated on the GPU up to the float precision, except for the iq noises whose hash depends on the GPU sin()."""
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.pending = []
+        self.task = None
+
+    def make_buffer(self, width, height, texture_format):
+        self.width = width
+        self.height = height
+        if self.task is None:
+            self.task = taskMgr.add(self.check_generation, 'check_cpu_generation', sort = -10000)
+
+    def remove(self):
+        if self.task is not None:
+            taskMgr.remove(self.task)
+            self.task = None
+        self.pending = []
+
+    def check_generation(self, task):
+        if len(self.pending) == 0:
+            return Task.cont
+        pending = []
+        for entry in self.pending:
+            (result, texture, callback, cb_args) = entry
+            if not result.ready():
+                pending.append(entry)
+                continue
+            try:
+                heights = result.get()
+            except Exception:
+                print("Noise generation failed")
+                traceback.print_exc()
+                texture = None
+            else:
+                texture.setup_2d_texture(self.width, self.height, Texture.T_float, Texture.F_r32)
+                texture.set_ram_image(heights.tobytes())
+            if callback is not None:
+                callback(texture, *cb_args)
+        self.pending = pending
+        return Task.cont
+
+    def generate(self, shader, face, texture, callback=None, cb_args=(), patch=None, cancel_cb=None):
+        if shader.coord == TexCoord.NormalizedCube or shader.coord == TexCoord.SqrtCube:
+            rot = shader.get_rot_for_face(face)
+            face_rot = [[rot.get_cell(i, j) for j in range(3)] for i in range(3)]
+        else:
+            face_rot = None
+        args = (shader.noise_source, shader.coord, self.width, self.height,
+                tuple(shader.offset), tuple(shader.scale), face_rot,
+                shader.global_frequency, tuple(shader.global_offset), shader.global_scale)
+        result = get_worker_pool().apply_async(generate_noise_tile, args)
+        self.pending.append((result, texture, callback, cb_args))
+
+if __name__ == '__main__':
+    from time import time
+    from panda3d.core import load_prc_file_data
+    from .shadernoise import NoiseShader, FloatTarget, FbmNoise, RidgedNoise, NoiseWarp
+    from .shadernoise import GpuNoiseLibPerlin3D, GpuNoiseLibCellular3D, SteGuPerlin3D, SteGuCellular3D, SteGuCellularDiff3D
+    from .shadernoise import QuilezPerlin3D, QuilezGradientNoise3D, SinCosNoise
+
+    def test_noises():
+        return [('gpunoise:perlin', GpuNoiseLibPerlin3D()),
+                ('gpunoise:cellular', GpuNoiseLibCellular3D()),
+                ('stegu:perlin', SteGuPerlin3D()),
+                ('stegu:cellular', SteGuCellular3D(False)),
+                ('stegu:cellulardiff', SteGuCellularDiff3D(True)),
+                ('iq:perlin', QuilezPerlin3D()),
+                ('iq:gradient', QuilezGradientNoise3D()),
+                ('sincos', SinCosNoise()),
+                ('fbm', FbmNoise(RidgedNoise(SteGuPerlin3D()), octaves=8, frequency=4.0)),
+                ('warp', NoiseWarp(FbmNoise(SteGuPerlin3D(), octaves=4), SteGuPerlin3D(), 0.5)),
+                ]
+
+    test_coords = [(TexCoord.Cylindrical, (0.25, 0.25, 0.0), (0.25, 0.25, 1.0), 0),
+                   (TexCoord.NormalizedCube, (0.5, 0.0, 0.0), (0.5, 0.5, 1.0), 2),
+                   (TexCoord.SqrtCube, (0.0, 0.0, 0.0), (1.0, 1.0, 1.0), 4),
+                   (TexCoord.Flat, (10.0, 3.0, 1.5), (4.0, 4.0, 1.0), 0)]
+
+    def compare(size):
+        """Generate the test noises both on the GPU and on the CPU and print the differences."""
+        from direct.showbase.ShowBase import ShowBase
+        from ..heightmap import texture_to_heights
+        from .. import opengl
+        start_worker_pool()
+        load_prc_file_data("", "window-type offscreen\naudio-library-name null")
+        base = ShowBase()
+        gsg = base.win.gsg
+        opengl.check_glsl_version(gsg.get_driver_shader_version_major() * 100 + gsg.get_driver_shader_version_minor())
+        gpu_generator = TexGenerator()
+        gpu_generator.make_buffer(size, size, Texture.F_r32)
+        cpu_generator = CpuTexGenerator()
+        cpu_generator.make_buffer(size, size, Texture.F_r32)
+        for (name, noise) in test_noises():
+            for (coord, offset, scale, face) in test_coords:
+                shader = NoiseShader(coord=coord, noise_source=noise, noise_target=FloatTarget(), offset=offset, scale=scale)
+                shader.create_and_register_shader(None, None)
+                results = {}
+                for (generator_name, generator) in (('gpu', gpu_generator), ('cpu', cpu_generator)):
+                    generator.generate(shader, face, Texture(), lambda texture, key: results.__setitem__(key, texture_to_heights(texture)), (generator_name,))
+                while len(results) < 2:
+                    base.taskMgr.step()
+                delta = numpy.abs(results['gpu'] - results['cpu'])
+                print("%-20s %-16s max error %.2e, mean error %.2e, %5.1f%% above 1e-3" % (name, NoiseShader.coord_map[coord], delta.max(), delta.mean(), (delta > 1e-3).mean() * 100))
+
+    def benchmark(nb_tiles, size):
+        """Generate tiles of fbm noise on the CPU, serially and with the worker pool."""
+        noise = FbmNoise(RidgedNoise(SteGuPerlin3D()), octaves=8, frequency=4.0)
+        coord = TexCoord.NormalizedCube
+        jobs = []
+        for i in range(nb_tiles):
+            lod = 1 << (i % 4)
+            jobs.append((noise, coord, size, size, ((i % lod) / float(lod), (i // lod % lod) / float(lod), 0.0), (1.0 / lod, 1.0 / lod, 1.0), numpy.identity(3).tolist()))
+        start = time()
+        for job in jobs:
+            generate_noise_tile(*job)
+        serial = time() - start
+        pool = start_worker_pool()
+        nb_workers = settings.cpu_generator_workers or multiprocessing.cpu_count()
+        pool.apply(generate_noise_tile, jobs[0])
+        start = time()
+        results = [pool.apply_async(generate_noise_tile, job) for job in jobs]
+        for result in results:
+            result.get()
+        parallel = time() - start
+        print("%d tiles of %dx%d: serial %.3fs (%.1f tiles/s), %d workers %.3fs (%.1f tiles/s)" % (nb_tiles, size, size, serial, nb_tiles / serial, nb_workers, parallel, nb_tiles / parallel))
+
+    def batch(nb_tiles, size):
+        """Generate the same tiles with the generator pool and with the batch generator, compare the results and the number of frames."""
+        from direct.showbase.ShowBase import ShowBase
+        from ..heightmap import texture_to_heights
+        from .. import opengl
+        load_prc_file_data("", "window-type offscreen\naudio-library-name null")
+        base = ShowBase()
+        gsg = base.win.gsg
+        opengl.check_glsl_version(gsg.get_driver_shader_version_major() * 100 + gsg.get_driver_shader_version_minor())
+        noise = FbmNoise(RidgedNoise(SteGuPerlin3D()), octaves=8, frequency=4.0)
+        shaders = []
+        for i in range(nb_tiles):
+            lod = 1 << (i % 4)
+            offset = ((i % lod) / float(lod), (i // lod % lod) / float(lod), 0.0)
+            shader = NoiseShader(coord=TexCoord.NormalizedCube, noise_source=noise, noise_target=FloatTarget(), offset=offset, scale=(1.0 / lod, 1.0 / lod, 1.0))
+            shader.create_and_register_shader(None, None)
+            shaders.append(shader)
+        results = {}
+        for (name, generator) in (('pool', GeneratorPool(settings.patch_pool_size)), ('batch', BatchTexGenerator(settings.generator_batch_size))):
+            generator.make_buffer(size, size, Texture.F_r32)
+            heights = {}
+            for (i, shader) in enumerate(shaders):
+                generator.generate(shader, i % 6, Texture(), lambda texture, i: heights.__setitem__(i, texture_to_heights(texture)), (i,))
+            frames = 0
+            start = time()
+            while len(heights) < nb_tiles:
+                base.taskMgr.step()
+                frames += 1
+            duration = time() - start
+            results[name] = heights
+            print("%-6s %d tiles of %dx%d: %d frames, %.3fs (%.1f tiles/s)" % (name, nb_tiles, size, size, frames, duration, nb_tiles / duration))
+        delta = max(numpy.abs(results['pool'][i] - results['batch'][i]).max() for i in range(nb_tiles))
+        print("Max difference %.2e" % delta)
+
+    if len(sys.argv) >= 2 and sys.argv[1] == '--compare':
+        compare(int(sys.argv[2]) if len(sys.argv) > 2 else 64)
+    elif len(sys.argv) >= 2 and sys.argv[1] == '--benchmark':
+        benchmark(int(sys.argv[2]) if len(sys.argv) > 2 else 64, int(sys.argv[3]) if len(sys.argv) > 3 else 66)
+    elif len(sys.argv) >= 2 and sys.argv[1] == '--batch':
+        batch(int(sys.argv[2]) if len(sys.argv) > 2 else 64, int(sys.argv[3]) if len(sys.argv) > 3 else 66)
+    else:
+        print("Usage: %s --compare [size] | --benchmark [tiles] [size] | --batch [tiles] [size]" % sys.argv[0])
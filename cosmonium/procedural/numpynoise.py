@@ -0,0 +1,311 @@
+#
+#This file is part of Cosmonium.
+#
+#Copyright (C) 2018-2019 Laurent Deru.
+#
+#Cosmonium is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Cosmonium is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Cosmonium.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+"""
+NumPy ports of the GLSL noise functions used by the procedural noise graph.
+
+The points are float32 arrays of shape (3, n) and the functions return float32 arrays of shape (n,).
+All the computations are done in single precision, in the same order as the shaders, so that the hash
+functions, which rely on the rounding of large float values, give the same results as on the GPU.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+from ..textures import TexCoord
+
+from weakref import WeakKeyDictionary
+import numpy
+
+f32 = numpy.float32
+
+def fract(x):
+    return x - numpy.floor(x)
+
+def mix(a, b, t):
+    return a + (b - a) * t
+
+def interpolation_c1(x):
+    return x * x * (f32(3.0) - f32(2.0) * x)
+
+def interpolation_c2(x):
+    return x * x * x * (x * (x * f32(6.0) - f32(15.0)) + f32(10.0))
+
+def falloff_xsq_c2(xsq):
+    xsq = f32(1.0) - xsq
+    return xsq * xsq * xsq
+
+#gpu-noise-lib
+
+def fast32_hash_3d(gridcell):
+    """Generates 3 random numbers for each of the 8 cell corners, the corners are ordered as (x0, y0), (x1, y0), (x0, y1), (x1, y1).
+    Returns the hashes of the lower z corners and the hashes of the upper z corners, as arrays of shape (3, 4, n)."""
+    offset = numpy.array([50.0, 161.0, 50.0, 161.0], dtype=f32)[:, None]
+    domain = f32(69.0)
+    somelargefloats = numpy.array([635.298681, 682.357502, 668.926525], dtype=f32)[:, None]
+    zinc = numpy.array([48.500388, 65.294118, 63.934599], dtype=f32)[:, None]
+    gridcell = gridcell - numpy.floor(gridcell * (f32(1.0) / domain)) * domain
+    gridcell_inc1 = (gridcell <= domain - f32(1.5)) * (gridcell + f32(1.0))
+    P = numpy.stack((gridcell[0], gridcell[1], gridcell_inc1[0], gridcell_inc1[1])) + offset
+    P *= P
+    P = P[[0, 2, 0, 2]] * P[[1, 1, 3, 3]]
+    lowz_mod = f32(1.0) / (somelargefloats + gridcell[2] * zinc)
+    highz_mod = f32(1.0) / (somelargefloats + gridcell_inc1[2] * zinc)
+    lowz_hash = fract(P[None, :, :] * lowz_mod[:, None, :])
+    highz_hash = fract(P[None, :, :] * highz_mod[:, None, :])
+    return (lowz_hash, highz_hash)
+
+def fast32_hash_3d_cell(gridcell):
+    """Generates 4 different random numbers for the single given cell point, as an array of shape (4, n)."""
+    offset = numpy.array([50.0, 161.0], dtype=f32)[:, None]
+    domain = f32(69.0)
+    somelargefloats = numpy.array([635.298681, 682.357502, 668.926525, 588.255119], dtype=f32)[:, None]
+    zinc = numpy.array([48.500388, 65.294118, 63.934599, 63.279683], dtype=f32)[:, None]
+    gridcell = gridcell - numpy.floor(gridcell * (f32(1.0) / domain)) * domain
+    xy = gridcell[:2] + offset
+    xy *= xy
+    return fract((xy[0] * xy[1]) * (f32(1.0) / (somelargefloats + gridcell[2] * zinc)))
+
+def gnl_perlin3d(P):
+    Pi = numpy.floor(P)
+    Pf = P - Pi
+    Pf_min1 = Pf - f32(1.0)
+    (lowz_hash, highz_hash) = fast32_hash_3d(Pi)
+    grad_0 = lowz_hash - f32(0.49999)
+    grad_1 = highz_hash - f32(0.49999)
+    corner_x = numpy.stack((Pf[0], Pf_min1[0], Pf[0], Pf_min1[0]))
+    corner_y = numpy.stack((Pf[1], Pf[1], Pf_min1[1], Pf_min1[1]))
+    grad_results_0 = (f32(1.0) / numpy.sqrt(grad_0[0] * grad_0[0] + grad_0[1] * grad_0[1] + grad_0[2] * grad_0[2])) * (corner_x * grad_0[0] + corner_y * grad_0[1] + Pf[2] * grad_0[2])
+    grad_results_1 = (f32(1.0) / numpy.sqrt(grad_1[0] * grad_1[0] + grad_1[1] * grad_1[1] + grad_1[2] * grad_1[2])) * (corner_x * grad_1[0] + corner_y * grad_1[1] + Pf_min1[2] * grad_1[2])
+    blend = interpolation_c2(Pf)
+    res0 = mix(grad_results_0, grad_results_1, blend[2])
+    inv_blend = f32(1.0) - blend
+    weights = numpy.stack((inv_blend[0] * inv_blend[1], blend[0] * inv_blend[1], inv_blend[0] * blend[1], blend[0] * blend[1]))
+    final = (res0 * weights).sum(axis=0, dtype=f32)
+    return final * f32(1.1547005383792515290182975610039)
+
+def cellular_weight_samples(samples):
+    samples = samples * f32(2.0) - f32(1.0)
+    return (samples * samples * samples) - numpy.sign(samples)
+
+def gnl_cellular3d(P):
+    Pi = numpy.floor(P)
+    Pf = P - Pi
+    (lowz_hash, highz_hash) = fast32_hash_3d(Pi)
+    jitter_window = f32(0.166666666)
+    corner_x = numpy.array([0.0, 1.0, 0.0, 1.0], dtype=f32)[:, None]
+    corner_y = numpy.array([0.0, 0.0, 1.0, 1.0], dtype=f32)[:, None]
+    d = None
+    for (hashes, corner_z) in ((lowz_hash, f32(0.0)), (highz_hash, f32(1.0))):
+        dx = Pf[0] - (cellular_weight_samples(hashes[0]) * jitter_window + corner_x)
+        dy = Pf[1] - (cellular_weight_samples(hashes[1]) * jitter_window + corner_y)
+        dz = Pf[2] - (cellular_weight_samples(hashes[2]) * jitter_window + corner_z)
+        distances = (dx * dx + dy * dy + dz * dz).min(axis=0)
+        d = distances if d is None else numpy.minimum(d, distances)
+    return d * f32(9.0 / 12.0)
+
+def gnl_polkadot3d(P, radius_low, radius_high):
+    Pi = numpy.floor(P)
+    Pf = P - Pi
+    hash = fast32_hash_3d_cell(Pi)
+    radius_low = f32(radius_low)
+    radius_high = f32(radius_high)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        radius = numpy.maximum(f32(0.0), radius_low + hash[3] * (radius_high - radius_low))
+        value = radius / max(radius_high, radius_low)
+        radius = f32(2.0) / radius
+        Pf = Pf * radius
+        Pf -= (radius - f32(1.0))
+        Pf += hash[:3] * (radius - f32(2.0))
+        return falloff_xsq_c2(numpy.minimum((Pf * Pf).sum(axis=0, dtype=f32), f32(1.0))) * value
+
+#Stefan Gustavson noise
+
+def mod289(x):
+    return x - numpy.floor(x * f32(1.0 / 289.0)) * f32(289.0)
+
+def mod7(x):
+    return x - numpy.floor(x * f32(1.0 / 7.0)) * f32(7.0)
+
+def permute(x):
+    return mod289((f32(34.0) * x + f32(1.0)) * x)
+
+def stegu_snoise(v):
+    i = numpy.floor(v + (v[0] + v[1] + v[2]) * f32(1.0 / 3.0))
+    x0 = v - i + (i[0] + i[1] + i[2]) * f32(1.0 / 6.0)
+    g = (x0 >= x0[[1, 2, 0]]).astype(f32)
+    l = f32(1.0) - g
+    i1 = numpy.minimum(g, l[[2, 0, 1]])
+    i2 = numpy.maximum(g, l[[2, 0, 1]])
+    x1 = x0 - i1 + f32(1.0 / 6.0)
+    x2 = x0 - i2 + f32(1.0 / 3.0)
+    x3 = x0 - f32(0.5)
+    i = mod289(i)
+    zero = numpy.zeros_like(i1[0])
+    one = numpy.ones_like(i1[0])
+    p = permute(i[2] + numpy.stack((zero, i1[2], i2[2], one)))
+    p = permute(p + i[1] + numpy.stack((zero, i1[1], i2[1], one)))
+    p = permute(p + i[0] + numpy.stack((zero, i1[0], i2[0], one)))
+    n_ = f32(0.142857142857)
+    ns = (n_ * f32(2.0), n_ * f32(0.5) - f32(1.0), n_)
+    j = p - f32(49.0) * numpy.floor(p * ns[2] * ns[2])
+    x_ = numpy.floor(j * ns[2])
+    y_ = numpy.floor(j - f32(7.0) * x_)
+    x = x_ * ns[0] + ns[1]
+    y = y_ * ns[0] + ns[1]
+    h = f32(1.0) - numpy.abs(x) - numpy.abs(y)
+    sh = -(h <= f32(0.0)).astype(f32)
+    gx = x + (numpy.floor(x) * f32(2.0) + f32(1.0)) * sh
+    gy = y + (numpy.floor(y) * f32(2.0) + f32(1.0)) * sh
+    gz = h
+    norm = f32(1.79284291400159) - f32(0.85373472095314) * (gx * gx + gy * gy + gz * gz)
+    corners = numpy.stack((x0, x1, x2, x3), axis=1)
+    m = numpy.maximum(f32(0.6) - (corners * corners).sum(axis=0, dtype=f32), f32(0.0))
+    m = m * m
+    projections = (gx * norm) * corners[0] + (gy * norm) * corners[1] + (gz * norm) * corners[2]
+    return f32(42.0) * (m * m * projections).sum(axis=0, dtype=f32)
+
+def stegu_cellular_distances(Pi, Pf, offsets, jitter):
+    K = f32(0.142857142857)
+    Ko = f32(0.428571428571)
+    K2 = f32(0.020408163265306)
+    Kz = f32(0.166666666667)
+    Kzo = f32(0.416666666667)
+    distances = []
+    for i in offsets:
+        px = permute(Pi[0] + f32(i))
+        for j in offsets:
+            py = permute(px + Pi[1] + f32(j))
+            for k in offsets:
+                p = permute(py + Pi[2] + f32(k))
+                ox = fract(p * K) - Ko
+                oy = mod7(numpy.floor(p * K)) * K - Ko
+                oz = numpy.floor(p * K2) * Kz - Kzo
+                dx = Pf[0] + f32(-i) + jitter * ox
+                dy = Pf[1] + f32(-j) + jitter * oy
+                dz = Pf[2] + f32(-k) + jitter * oz
+                distances.append(dx * dx + dy * dy + dz * dz)
+    distances = numpy.partition(numpy.stack(distances), 1, axis=0)
+    return numpy.sqrt(distances[:2])
+
+def stegu_cellular(P):
+    """Returns F1 and F2 of the 3x3x3 cellular noise."""
+    return stegu_cellular_distances(mod289(numpy.floor(P)), fract(P) - f32(0.5), (-1, 0, 1), f32(1.0))
+
+def stegu_cellular2x2x2(P):
+    """Returns F1 and F2 of the fast 2x2x2 cellular noise."""
+    return stegu_cellular_distances(mod289(numpy.floor(P)), fract(P), (0, 1), f32(0.8))
+
+#Inigo Quilez noise
+
+def iq_hash(p):
+    #The error of sin() is amplified by the hash, the result depends on the GPU implementation and can not be reproduced exactly
+    q = numpy.stack((p[0] * f32(127.1) + p[1] * f32(311.7) + p[2] * f32(74.7),
+                     p[0] * f32(269.5) + p[1] * f32(183.3) + p[2] * f32(246.1),
+                     p[0] * f32(113.5) + p[1] * f32(271.9) + p[2] * f32(124.6)))
+    return f32(-1.0) + f32(2.0) * fract(numpy.sin(q) * f32(43758.5453123))
+
+def iq_corners(x):
+    p = numpy.floor(x)
+    w = fract(x)
+    values = []
+    for k in range(2):
+        for j in range(2):
+            for i in range(2):
+                corner = numpy.array([i, j, k], dtype=f32)[:, None]
+                gradient = iq_hash(p + corner)
+                delta = w - corner
+                values.append(gradient[0] * delta[0] + gradient[1] * delta[1] + gradient[2] * delta[2])
+    return (w, values)
+
+def iq_gradient_noise(x):
+    (w, (va, vb, vc, vd, ve, vf, vg, vh)) = iq_corners(x)
+    u = interpolation_c1(w)
+    return mix(mix(mix(va, vb, u[0]), mix(vc, vd, u[0]), u[1]),
+               mix(mix(ve, vf, u[0]), mix(vg, vh, u[0]), u[1]), u[2])
+
+def iq_gradient_noise3d(x):
+    (w, (va, vb, vc, vd, ve, vf, vg, vh)) = iq_corners(x)
+    u = interpolation_c2(w)
+    return (va +
+            u[0] * (vb - va) +
+            u[1] * (vc - va) +
+            u[2] * (ve - va) +
+            u[0] * u[1] * (va - vb - vc + vd) +
+            u[1] * u[2] * (va - vc - ve + vg) +
+            u[2] * u[0] * (va - vb - ve + vf) +
+            u[0] * u[1] * u[2] * (-va + vb + vc - vd + ve - vf - vg + vh))
+
+#Noise tiles
+
+def texel_coords(size):
+    """Texture coordinates of the centers of the texels of the generated tiles.
+    The quad used by the shader generator has a margin of half a texel on each side."""
+    margin = 1.0 / size / 2.0
+    return (-margin + (numpy.arange(size) + 0.5) / size * (1.0 + 2.0 * margin)).astype(f32)
+
+def noise_positions(coord, width, height, offset, scale, face_rot=None):
+    """Returns the position of each texel of the tile, as an array of shape (3, width * height), in the same order as the texture rows."""
+    (u, v) = numpy.meshgrid(texel_coords(width), texel_coords(height))
+    x = f32(offset[0]) + u.ravel() * f32(scale[0])
+    y = f32(offset[1]) + v.ravel() * f32(scale[1])
+    if coord == TexCoord.Cylindrical:
+        nx = f32(2.0 * numpy.pi) * x
+        ny = f32(numpy.pi) * y
+        sny = numpy.sin(ny)
+        position = numpy.stack((numpy.cos(nx) * sny, numpy.sin(nx) * sny, numpy.cos(ny)))
+    elif coord == TexCoord.NormalizedCube or coord == TexCoord.SqrtCube:
+        p = numpy.stack((f32(2.0) * x - f32(1.0), f32(2.0) * y - f32(1.0), numpy.ones_like(x)))
+        p = numpy.dot(numpy.asarray(face_rot, dtype=f32), p)
+        if coord == TexCoord.NormalizedCube:
+            position = p / numpy.sqrt((p * p).sum(axis=0, dtype=f32))
+        else:
+            p2 = p * p
+            position = numpy.stack((p[0] * numpy.sqrt(f32(1.0) - p2[1] * f32(0.5) - p2[2] * f32(0.5) + p2[1] * p2[2] / f32(3.0)),
+                                    p[1] * numpy.sqrt(f32(1.0) - p2[2] * f32(0.5) - p2[0] * f32(0.5) + p2[2] * p2[0] / f32(3.0)),
+                                    p[2] * numpy.sqrt(f32(1.0) - p2[0] * f32(0.5) - p2[1] * f32(0.5) + p2[0] * p2[1] / f32(3.0))))
+    else:
+        position = numpy.stack((x, y, numpy.full_like(x, offset[2])))
+    return position
+
+def generate_noise_tile(noise, coord, width, height, offset, scale, face_rot=None, global_frequency=1.0, global_offset=(0.0, 0.0, 0.0), global_scale=1.0):
+    """Evaluates the noise graph over a tile and returns a float32 array of shape (height, width), indexed like the texture generated on the GPU."""
+    position = noise_positions(coord, width, height, offset, scale, face_rot)
+    position = position * f32(global_frequency) + numpy.asarray(global_offset, dtype=f32)[:, None]
+    value = noise.noise_array(position) * f32(global_scale)
+    return value.astype(f32).reshape((height, width))
+
+supported_noises = WeakKeyDictionary()
+
+def noise_children(noise):
+    for value in vars(noise).values():
+        if hasattr(value, 'cpu_supported'):
+            yield value
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                if hasattr(item, 'cpu_supported'):
+                    yield item
+
+def cpu_supported(noise):
+    """Checks that all the sources of the noise graph can be evaluated on the CPU."""
+    supported = supported_noises.get(noise)
+    if supported is None:
+        supported = noise.cpu_supported and all(cpu_supported(child) for child in noise_children(noise))
+        supported_noises[noise] = supported
+    return supported
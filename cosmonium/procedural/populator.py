@@ -28,9 +28,9 @@ from ..shaders import OffsetScaleInstanceControl
 from .. import settings
 
 from random import random, uniform
-from array import array
-from itertools import chain
-import sys
+from math import ceil, tan, radians
+import numpy
+import zlib
 
 class TerrainObjectFactory(object):
     def __init__(self):
@@ -69,14 +69,7 @@ class TerrainPopulatorBase(object):
         nb_of_instances = self.calc_nb_of_instances(patch)
         if self.max_instances is not None:
             nb_of_instances = min(nb_of_instances, self.max_instances)
-        count = 0
-        offsets = []
-        while count < nb_of_instances:
-            offset = self.placer.place_new(self.terrain, count, patch)
-            if offset is not None:
-                offsets.append(offset)
-            count += 1
-        return offsets
+        return self.placer.place_batch(self.terrain, int(ceil(nb_of_instances)), patch)
 
     def create_object_template(self):
         if self.object_template.instance is None:
@@ -131,13 +124,29 @@ class PatchedTerrainPopulatorBase(TerrainPopulatorBase):
     def create_data_for(self, patch, terrain_patch):
         if settings.debug_lod_split_merge:
             print("Populator create data", terrain_patch.str_id())
-        data = self.generate_instances_info_for(terrain_patch)
+        parent = terrain_patch.parent
+        if parent is not None and parent in self.patch_map and terrain_patch in parent.children:
+            #The objects of a split patch are taken from its parent to avoid popping
+            parent_patch = self.patch_map[parent]
+            if parent_patch.data is None:
+                self.create_data_for(parent_patch, parent)
+            data = self.split_data(parent, parent_patch.data)[parent.children.index(terrain_patch)]
+        else:
+            data = self.generate_instances_info_for(terrain_patch)
         patch.set_data(data)
 
     def create_root_patch(self, terrain_patch):
         if self.patch_valid(terrain_patch):
             self.create_patch_for(terrain_patch)
 
+    def split_data(self, terrain_patch, data):
+        #TODO: Terrain scale should be retrieved properly...
+        size = self.terrain.size
+        (u, v) = terrain_patch.coord_to_uv((data[:, 0] / size, data[:, 1] / size))
+        left = u < 0.5
+        bottom = v < 0.5
+        return (data[left & bottom], data[~left & bottom], data[~left & ~bottom], data[left & ~bottom])
+
     def split_patch(self, terrain_patch):
         if not terrain_patch in self.patch_map: return
         if settings.debug_lod_split_merge:
@@ -145,30 +154,8 @@ class PatchedTerrainPopulatorBase(TerrainPopulatorBase):
         patch = self.patch_map[terrain_patch]
         if patch.data is None:
             self.create_data_for(patch, terrain_patch)
-        bl = []
-        br = []
-        tr = []
-        tl = []
-        #TODO: Terrain scale should be retrieved properly...
-        size = self.terrain.size
-        for data in patch.data:
-            (x, y, height, scale) = data
-            (u, v) = terrain_patch.coord_to_uv((x / size, y / size))
-            if u < 0.5:
-                if v < 0.5:
-                    bl.append(data)
-                else:
-                    tl.append(data)
-            else:
-                if v < 0.5:
-                    br.append(data)
-                else:
-                    tr.append(data)
-        #print(len(bl), len(br), len(tr), len(tl))
-        self.patch_map[terrain_patch.children[0]] = TerrainPopulatorPatch(bl)
-        self.patch_map[terrain_patch.children[1]] = TerrainPopulatorPatch(br)
-        self.patch_map[terrain_patch.children[2]] = TerrainPopulatorPatch(tr)
-        self.patch_map[terrain_patch.children[3]] = TerrainPopulatorPatch(tl)
+        for (child, data) in zip(terrain_patch.children, self.split_data(terrain_patch, patch.data)):
+            self.patch_map[child] = TerrainPopulatorPatch(data)
 
     def merge_patch(self, terrain_patch):
         if not terrain_patch in self.patch_map: return
@@ -206,6 +193,9 @@ class PatchedTerrainPopulatorBase(TerrainPopulatorBase):
             patch = self.visible_patches[terrain_patch]
             self.remove_patch_instances(patch, terrain_patch)
             del self.visible_patches[terrain_patch]
+            if self.placer.deterministic and len(terrain_patch.children) == 0:
+                #The placement is reproducible, the data is created again when the patch is shown
+                patch.set_data(None)
 
 class CpuTerrainPopulator(PatchedTerrainPopulatorBase):
     def __init__(self, object_template, count, max_instances, placer, min_lod=0):
@@ -232,12 +222,121 @@ class CpuTerrainPopulator(PatchedTerrainPopulatorBase):
             instance.remove_node()
         patch.instances = []
 
+class InstanceBuffer(object):
+    """
+    Table of the offsets and scales of the instances drawn with a single instanced call.
+    Each patch owns a range of slots allocated from a free list, showing or hiding a patch only writes its own slots.
+    The free slots have a null scale and are not visible.
+    """
+    def __init__(self, capacity, growable=True):
+        self.capacity = capacity
+        self.growable = growable
+        self.data = numpy.zeros((capacity, 4), dtype=numpy.float32)
+        #Sorted list of the free ranges, as [start, size]
+        self.free = [[0, capacity]]
+        self.count = 0
+        self.offsets = None
+        self.replaced = False
+        self.dirty = None
+        self.create_offsets()
+
+    def create_offsets(self):
+        if settings.instancing_use_tex:
+            texture = Texture()
+            texture.setup_buffer_texture(self.capacity, Texture.T_float, Texture.F_rgba32, GeomEnums.UH_dynamic)
+            texture.set_ram_image(self.data.tobytes())
+            self.offsets = texture
+        else:
+            self.offsets = PTAVecBase4f.emptyArray(self.capacity)
+            self.mark_dirty(0, self.capacity)
+        self.replaced = True
+
+    def update_count(self):
+        if len(self.free) > 0 and self.free[-1][0] + self.free[-1][1] == self.capacity:
+            self.count = self.free[-1][0]
+        else:
+            self.count = self.capacity
+
+    def mark_dirty(self, start, end):
+        if self.dirty is None:
+            self.dirty = (start, end)
+        else:
+            self.dirty = (min(self.dirty[0], start), max(self.dirty[1], end))
+
+    def grow(self, size):
+        tail = 0
+        if len(self.free) > 0 and self.free[-1][0] + self.free[-1][1] == self.capacity:
+            tail = self.free[-1][1]
+        new_capacity = max(self.capacity * 2, self.capacity + size - tail)
+        if tail > 0:
+            self.free[-1][1] += new_capacity - self.capacity
+        else:
+            self.free.append([self.capacity, new_capacity - self.capacity])
+        self.data = numpy.concatenate((self.data, numpy.zeros((new_capacity - self.capacity, 4), dtype=numpy.float32)))
+        self.capacity = new_capacity
+        self.create_offsets()
+
+    def allocate(self, size):
+        """
+        Reserve a range of size slots and return its start, or None if the buffer is full.
+        """
+        if size == 0: return 0
+        for block in self.free:
+            if block[1] >= size:
+                start = block[0]
+                block[0] += size
+                block[1] -= size
+                if block[1] == 0:
+                    self.free.remove(block)
+                self.update_count()
+                return start
+        if not self.growable:
+            return None
+        self.grow(size)
+        return self.allocate(size)
+
+    def release(self, start, size):
+        if size == 0: return
+        self.data[start:start + size] = 0
+        self.mark_dirty(start, start + size)
+        index = 0
+        while index < len(self.free) and self.free[index][0] < start:
+            index += 1
+        self.free.insert(index, [start, size])
+        if index + 1 < len(self.free) and start + size == self.free[index + 1][0]:
+            self.free[index][1] += self.free[index + 1][1]
+            del self.free[index + 1]
+        if index > 0 and self.free[index - 1][0] + self.free[index - 1][1] == start:
+            self.free[index - 1][1] += self.free[index][1]
+            del self.free[index]
+        self.update_count()
+
+    def write(self, start, data):
+        if len(data) == 0: return
+        self.data[start:start + len(data)] = data
+        self.mark_dirty(start, start + len(data))
+
+    def is_modified(self):
+        return self.replaced or self.dirty is not None
+
+    def flush(self):
+        if self.dirty is None: return
+        (start, end) = self.dirty
+        if settings.instancing_use_tex:
+            buffer = self.offsets.modify_ram_image()
+        else:
+            buffer = self.offsets
+        table = numpy.asarray(memoryview(buffer)).view(numpy.float32).reshape((self.capacity, 4))
+        table[start:end] = self.data[start:end]
+        self.dirty = None
+
 class GpuTerrainPopulator(PatchedTerrainPopulatorBase):
     def __init__(self, object_template, count, max_instances, placer, min_lod=0):
         PatchedTerrainPopulatorBase.__init__(self, object_template, count, placer, min_lod)
         self.max_instances = max_instances
         self.object_template.shader.set_instance_control(OffsetScaleInstanceControl(self.max_instances))
-        self.rebuild = False
+        #Without buffer texture, the size of the table is fixed by the uniform array in the shader
+        self.instances = InstanceBuffer(self.max_instances, growable=settings.instancing_use_tex)
 
     def create_object_template_instance_cb(self, terrain_object):
         bounds = OmniBoundingVolume()
@@ -245,61 +344,80 @@ class GpuTerrainPopulator(PatchedTerrainPopulatorBase):
         terrain_object.instance.node().setFinal(1)
 
     def create_patch_instances(self, patch, terrain_patch):
-        self.rebuild = True
+        if patch.slots is not None: return
+        start = self.instances.allocate(len(patch.data))
+        if start is None:
+            print("Populator: no free instance slot for", terrain_patch.str_id())
+            return
+        self.instances.write(start, patch.data)
+        patch.slots = (start, len(patch.data))
 
     def remove_patch_instances(self, patch, terrain_patch):
-        self.rebuild = True
+        if patch.slots is None: return
+        self.instances.release(*patch.slots)
+        patch.slots = None
 
-    def generate_table(self):
-        data = []
-        for patch in self.visible_patches.values():
-            data += patch.data
-        offsets_nb = len(data)
+    def update_table(self):
         if settings.debug_lod_split_merge:
-            print("Populator regenerate", offsets_nb)
-        if settings.instancing_use_tex:
-            offsets = data
-        else:
-            offsets = PTAVecBase4f.emptyArray(offsets_nb)
-            for offset in data:
-                    offsets[offsets_nb] = offset
-        if settings.instancing_use_tex:
-            texture = Texture()
-            texture.setup_buffer_texture(len(offsets), Texture.T_float, Texture.F_rgba32, GeomEnums.UH_static)
-            flattened_data = list(chain.from_iterable(offsets))
-            data = array("f", flattened_data)
-            if sys.version_info[0] < 3:
-                texture.setRamImage(data.tostring())
-            else:
-                texture.setRamImage(data.tobytes())
-            self.object_template.appearance.offsets = texture
-        else:
-            self.object_template.appearance.offsets = offsets
-        self.object_template.instance.set_instance_count(offsets_nb)
-        self.object_template.shader.apply(self.object_template.shape, self.object_template.appearance)
-        self.rebuild = False
+            print("Populator update", self.instances.count, self.instances.dirty)
+        self.instances.flush()
+        if self.instances.replaced:
+            self.object_template.appearance.offsets = self.instances.offsets
+            self.object_template.shader.apply(self.object_template.shape, self.object_template.appearance)
+            self.instances.replaced = False
+        self.object_template.instance.set_instance_count(self.instances.count)
 
     def update_instance(self, camera_pos, camera_rot):
         if self.object_template.instance is not None and self.object_template.instance_ready:
-            if self.rebuild:
-                self.generate_table()
+            if self.instances.is_modified():
+                self.update_table()
             self.object_template.update_instance(camera_pos, camera_rot)
 
 class TerrainPopulatorPatch(object):
     def __init__(self, data=None):
         self.data = data
+        self.slots = None
 
     def set_data(self, data):
         self.data = data
 
 class ObjectPlacer(object):
+    #The same objects are placed each time a patch is populated
+    deterministic = False
+
     def __init__(self):
         pass
 
-    def place_new(self, count):
+    def place_new(self, terrain, count, patch=None):
         return None
 
+    def place_batch(self, terrain, nb, patch=None):
+        """
+        Place nb objects and return their offsets and scales as an array of (x, y, height, scale).
+        """
+        offsets = []
+        for count in range(nb):
+            offset = self.place_new(terrain, count, patch)
+            if offset is not None:
+                offsets.append(offset)
+        return numpy.array(offsets, dtype=numpy.float32).reshape((-1, 4))
+
 class RandomObjectPlacer(ObjectPlacer):
+    """
+    Place the objects uniformly on the patch, above the water and, if max_slope is set, where the slope is lower than max_slope degrees.
+    The placement is seeded with the id of the patch and is the same each time the patch is populated.
+    """
+    deterministic = True
+    #Delta, in patch uv, used to evaluate the slope of the terrain
+    slope_delta = 1.0 / 256
+
+    def __init__(self, seed=0, min_scale=0.1, max_scale=0.5, max_slope=None):
+        ObjectPlacer.__init__(self)
+        self.seed = seed
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.max_slope = max_slope
+
     def place_new(self, terrain, count, patch=None):
         if patch is not None:
             u = random()
@@ -314,7 +432,44 @@ class RandomObjectPlacer(ObjectPlacer):
             height = terrain.get_height((x, y))
         #TODO: Should not have such explicit dependency
         if height > terrain.water.level:
-            scale = uniform(0.1, 0.5)
+            scale = uniform(self.min_scale, self.max_scale)
             return (x, y, height, scale)
         else:
             return None
+
+    def get_random_state(self, patch):
+        seed = self.seed
+        if patch is not None:
+            seed ^= zlib.crc32(patch.str_id().encode('utf-8'))
+        return numpy.random.RandomState(seed & 0xffffffff)
+
+    def get_slopes(self, terrain, patch, us, vs, heights):
+        delta = self.slope_delta
+        (x0, y0) = patch.get_xy_for(us, vs)
+        (x1, y1) = patch.get_xy_for(us + delta, vs + delta)
+        dx = (x1 - x0) * terrain.size
+        dy = (y1 - y0) * terrain.size
+        du = terrain.get_heights_patch(patch, us + delta, vs) - heights
+        dv = terrain.get_heights_patch(patch, us, vs + delta) - heights
+        return numpy.sqrt((du / dx) ** 2 + (dv / dy) ** 2)
+
+    def place_batch(self, terrain, nb, patch=None):
+        random_state = self.get_random_state(patch)
+        if patch is not None:
+            us = random_state.random_sample(nb)
+            vs = random_state.random_sample(nb)
+            heights = terrain.get_heights_patch(patch, us, vs)
+            (xs, ys) = patch.get_xy_for(us, vs)
+            xs = xs * terrain.size
+            ys = ys * terrain.size
+        else:
+            xs = random_state.uniform(-terrain.size, terrain.size, nb)
+            ys = random_state.uniform(-terrain.size, terrain.size, nb)
+            heights = numpy.array([terrain.get_height((x, y)) for (x, y) in zip(xs, ys)], dtype=numpy.float64)
+        scales = random_state.uniform(self.min_scale, self.max_scale, nb)
+        #TODO: Should not have such explicit dependency
+        valid = heights > terrain.water.level
+        if self.max_slope is not None and patch is not None and nb > 0:
+            valid &= self.get_slopes(terrain, patch, us, vs, heights) <= tan(radians(self.max_slope))
+        offsets = numpy.column_stack((xs, ys, heights, scales))[valid]
+        return offsets.astype(numpy.float32)
@@ -22,8 +22,9 @@ from __future__ import absolute_import
 
 from panda3d.core import Texture
 
-from .generator import TexGenerator, GeneratorPool
+from .generator import TexGenerator, CpuTexGenerator, create_patch_generator, use_cpu_generator
 from .shadernoise import NoiseShader, FloatTarget
+from .tilecache import tileCache
 
 from ..heightmap import TextureHeightmapBase, HeightmapPatch, HeightmapPatchFactory
 from ..textures import TexCoord
@@ -31,6 +32,7 @@ from .. import settings
 
 class ShaderHeightmap(TextureHeightmapBase):
     tex_generators = {}
+    cpu_generators = {}
 
     def __init__(self, name, width, height, height_scale, median, noise, offset=None, scale=None, coord = TexCoord.Cylindrical, interpolator=None):
         TextureHeightmapBase.__init__(self, name, width, height, height_scale, 1.0, 1.0, median, interpolator)
@@ -61,14 +63,6 @@ class ShaderHeightmap(TextureHeightmapBase):
         shape.instance.set_shader_input("heightmap_%s" % self.name, self.texture)
 
     def do_load(self, shape, callback, cb_args):
-        if not self.tex_id in ShaderHeightmap.tex_generators:
-            ShaderHeightmap.tex_generators[self.tex_id] = TexGenerator()
-            if settings.encode_float:
-                texture_format = Texture.F_rgba
-            else:
-                texture_format = Texture.F_r32
-            ShaderHeightmap.tex_generators[self.tex_id].make_buffer(self.width, self.height, texture_format)
-        tex_generator = ShaderHeightmap.tex_generators[self.tex_id]
         if self.shader is None:
             self.shader = NoiseShader(noise_source=self.noise,
                                       noise_target=FloatTarget(),
@@ -77,6 +71,20 @@ class ShaderHeightmap(TextureHeightmapBase):
                                       scale = self.scale)
             self.shader.global_frequency = self.global_frequency
             self.shader.global_scale = self.global_scale
+        if use_cpu_generator(self.noise):
+            if not self.tex_id in ShaderHeightmap.cpu_generators:
+                ShaderHeightmap.cpu_generators[self.tex_id] = CpuTexGenerator()
+                ShaderHeightmap.cpu_generators[self.tex_id].make_buffer(self.width, self.height, Texture.F_r32)
+            tex_generator = ShaderHeightmap.cpu_generators[self.tex_id]
+        else:
+            if not self.tex_id in ShaderHeightmap.tex_generators:
+                ShaderHeightmap.tex_generators[self.tex_id] = TexGenerator()
+                if settings.encode_float:
+                    texture_format = Texture.F_rgba
+                else:
+                    texture_format = Texture.F_r32
+                ShaderHeightmap.tex_generators[self.tex_id].make_buffer(self.width, self.height, texture_format)
+            tex_generator = ShaderHeightmap.tex_generators[self.tex_id]
             self.shader.create_and_register_shader(None, None)
         tex_generator.generate(self.shader, 0, self.texture, self.heightmap_ready_cb, (callback, cb_args))
 
@@ -90,6 +98,7 @@ class ShaderHeightmapPatchFactory(HeightmapPatchFactory):
 
 class ShaderHeightmapPatch(HeightmapPatch):
     tex_generators = {}
+    cpu_generators = {}
     cachable = False
     def __init__(self, noise, parent,
                  x0, y0, x1, y1,
@@ -103,19 +112,12 @@ class ShaderHeightmapPatch(HeightmapPatch):
         self.shader = None
         self.noise = noise
         self.tex_generator = None
+        self.request = None
 
     def apply(self, patch):
         patch.instance.set_shader_input("heightmap_%s" % self.parent.name, self.texture)
 
     def do_load(self, patch, callback, cb_args):
-        if not self.width in ShaderHeightmapPatch.tex_generators:
-            ShaderHeightmapPatch.tex_generators[self.width] = GeneratorPool(settings.patch_pool_size)
-            if settings.encode_float:
-                texture_format = Texture.F_rgba
-            else:
-                texture_format = Texture.F_r32
-            ShaderHeightmapPatch.tex_generators[self.width].make_buffer(self.width, self.height, texture_format)
-        tex_generator = ShaderHeightmapPatch.tex_generators[self.width]
         if self.shader is None:
             self.shader = NoiseShader(coord=self.coord,
                                       noise_source=self.noise,
@@ -124,5 +126,39 @@ class ShaderHeightmapPatch(HeightmapPatch):
                                       scale=(self.lod_scale_x, self.lod_scale_y, 1.0))
             self.shader.global_frequency = self.parent.global_frequency
             self.shader.global_scale = self.parent.global_scale
+        key = tileCache.get_key(self.shader, self.face, self.lod, self.width, self.height)
+        if tileCache.load_texture(key, self.texture):
+            self.heightmap_ready_cb(self.texture, callback, cb_args)
+            return
+        if use_cpu_generator(self.noise):
+            if not self.width in ShaderHeightmapPatch.cpu_generators:
+                ShaderHeightmapPatch.cpu_generators[self.width] = CpuTexGenerator()
+                ShaderHeightmapPatch.cpu_generators[self.width].make_buffer(self.width, self.height, Texture.F_r32)
+            tex_generator = ShaderHeightmapPatch.cpu_generators[self.width]
+        else:
+            if not self.width in ShaderHeightmapPatch.tex_generators:
+                if settings.encode_float:
+                    texture_format = Texture.F_rgba
+                else:
+                    texture_format = Texture.F_r32
+                ShaderHeightmapPatch.tex_generators[self.width] = create_patch_generator(self.width, self.height, texture_format)
+            tex_generator = ShaderHeightmapPatch.tex_generators[self.width]
             self.shader.create_and_register_shader(None, None)
-        tex_generator.generate(self.shader, self.face, self.texture, self.heightmap_ready_cb, (callback, cb_args))
+        self.request = tex_generator.generate(self.shader, self.face, self.texture, tileCache.texture_ready_cb, (key, self.heightmap_ready_cb, (callback, cb_args)),
+                                              patch, self.generation_cancelled_cb)
+
+    def rebind(self, patch, callback, cb_args):
+        HeightmapPatch.rebind(self, patch, callback, cb_args)
+        #The pending request now follows the new patch, it is only dropped if that patch is removed too
+        if self.request is not None:
+            self.request.patch = patch
+
+    def heightmap_ready_cb(self, texture, callback, cb_args):
+        self.request = None
+        HeightmapPatch.heightmap_ready_cb(self, texture, callback, cb_args)
+
+    def generation_cancelled_cb(self):
+        #The patch was removed before its heightmap was generated, it will be generated again if the patch is recreated
+        self.request = None
+        self.texture = None
+        self.parent.remove_heightmap(self.patch)
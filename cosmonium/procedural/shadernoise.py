@@ -28,8 +28,13 @@ from ..parameters import ParametersGroup, AutoUserParameter
 from .. import settings
 
 from .generator import GeneratorVertexShader
+from . import numpynoise
+
+from math import ceil
+import numpy
 
 class NoiseSource(object):
+    cpu_supported = False
     last_id = 0
     last_tmp = 0
     def __init__(self, name, prefix, ranges={}):
@@ -65,6 +70,9 @@ class NoiseSource(object):
     def noise_value(self, code, value, point):
         pass
 
+    def noise_array(self, point):
+        raise NotImplementedError("%s has no CPU implementation" % self.__class__.__name__)
+
     def update(self, instance):
         pass
 
@@ -92,6 +100,7 @@ class BasicNoiseSource(NoiseSource):
         return self.noise.get_user_parameters()
 
 class NoiseConst(NoiseSource):
+    cpu_supported = True
     def __init__(self, value, dynamic=False, name=None, ranges={}):
         NoiseSource.__init__(self, name, 'const', ranges)
         self.value = value
@@ -113,6 +122,9 @@ class NoiseConst(NoiseSource):
         else:
             code.append('        %s  = %g;' % (value, self.value))
 
+    def noise_array(self, point):
+        return numpy.full(point.shape[1], self.value, dtype=numpy.float32)
+
     def update(self, instance):
         if self.dynamic:
             instance.set_shader_input('%s' % self.str_id, self.value)
@@ -124,6 +136,7 @@ class NoiseConst(NoiseSource):
         return [group]
 
 class NoiseCoord(NoiseSource):
+    cpu_supported = True
     def __init__(self, coord, name=None):
         NoiseSource.__init__(self, name, 'coord')
         self.coord = coord
@@ -134,7 +147,11 @@ class NoiseCoord(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('        %s  = %s.%s;' % (value, point, self.coord))
 
+    def noise_array(self, point):
+        return point['xyz'.index(self.coord)]
+
 class GpuNoiseLibPerlin3D(NoiseSource):
+    cpu_supported = True
     def __init__(self, name=None):
         NoiseSource.__init__(self, name, 'gnl-perlin3d')
 
@@ -149,7 +166,11 @@ class GpuNoiseLibPerlin3D(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('        %s  = Perlin3D(%s);' % (value, point))
 
+    def noise_array(self, point):
+        return numpynoise.gnl_perlin3d(point)
+
 class GpuNoiseLibCellular3D(NoiseSource):
+    cpu_supported = True
     def __init__(self, name=None):
         NoiseSource.__init__(self, name, 'gnl-cell3d')
 
@@ -163,7 +184,11 @@ class GpuNoiseLibCellular3D(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('        %s  = sqrt(Cellular3D(%s));' % (value, point))
 
+    def noise_array(self, point):
+        return numpy.sqrt(numpynoise.gnl_cellular3d(point))
+
 class GpuNoiseLibPolkaDot3D(NoiseSource):
+    cpu_supported = True
     def __init__(self, name=None):
         NoiseSource.__init__(self, name, 'gnl-polkadot3d')
 
@@ -183,7 +208,11 @@ class GpuNoiseLibPolkaDot3D(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('        %s  = PolkaDot3D(%s, %g, %g);' % (value, point, self.min_radius, self.max_radius))
 
+    def noise_array(self, point):
+        return numpynoise.gnl_polkadot3d(point, self.min_radius, self.max_radius)
+
 class SteGuPerlin3D(NoiseSource):
+    cpu_supported = True
     def __init__(self, name=None):
         NoiseSource.__init__(self, name, 'stegu-perlin3d')
 
@@ -197,7 +226,11 @@ class SteGuPerlin3D(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('        %s  = snoise(%s);' % (value, point))
 
+    def noise_array(self, point):
+        return numpynoise.stegu_snoise(point)
+
 class SteGuCellular3D(NoiseSource):
+    cpu_supported = True
     def __init__(self, fast, name=None, prefix='stegu-cellular3d'):
         NoiseSource.__init__(self, name, prefix)
         self.fast = fast
@@ -221,7 +254,18 @@ class SteGuCellular3D(NoiseSource):
         else:
             code.append('        %s = cellular(%s).x;' % (value, point))
 
+
+    def cellular_array(self, point):
+        if self.fast:
+            return numpynoise.stegu_cellular2x2x2(point)
+        else:
+            return numpynoise.stegu_cellular(point)
+
+    def noise_array(self, point):
+        return self.cellular_array(point)[0]
+
 class SteGuCellularDiff3D(SteGuCellular3D):
+    cpu_supported = True
     def __init__(self, fast, name=None):
         SteGuCellular3D.__init__(self, fast, name, 'stegu-cellular3d-diff')
 
@@ -235,7 +279,12 @@ class SteGuCellularDiff3D(SteGuCellular3D):
             code.append('        vec2 F = cellular(%s);' % (point))
         code.append('        %s  = F.y - F.x;' % (value))
 
+    def noise_array(self, point):
+        F = self.cellular_array(point)
+        return F[1] - F[0]
+
 class QuilezPerlin3D(NoiseSource):
+    cpu_supported = True
     def __init__(self, name=None):
         NoiseSource.__init__(self, name, 'quilez-perlin3d')
 
@@ -248,7 +297,11 @@ class QuilezPerlin3D(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('        %s  = noise(%s);' % (value, point))
 
+    def noise_array(self, point):
+        return numpynoise.iq_gradient_noise3d(point)
+
 class QuilezGradientNoise3D(NoiseSource):
+    cpu_supported = True
     def __init__(self, name=None):
         NoiseSource.__init__(self, name, 'quilez-gradientnoise3d')
 
@@ -261,7 +314,11 @@ class QuilezGradientNoise3D(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('        %s  = noise(%s);' % (value, point))
 
+    def noise_array(self, point):
+        return numpynoise.iq_gradient_noise(point)
+
 class SinCosNoise(NoiseSource):
+    cpu_supported = True
     def __init__(self, name=None):
         NoiseSource.__init__(self, name, 'sincos')
 
@@ -274,7 +331,11 @@ class SinCosNoise(NoiseSource):
         code.append('        %s = sin(tmp_sincos.y) + cos(tmp_sincos.x);' % value)
         code.append('        }')
 
+    def noise_array(self, point):
+        return numpy.sin(point[1]) + numpy.cos(point[0])
+
 class AbsNoise(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, name=None):
         BasicNoiseSource.__init__(self, noise, name, 'abs')
 
@@ -286,7 +347,11 @@ class AbsNoise(BasicNoiseSource):
         self.noise.noise_value(code, tmp, point)
         code.append('          %s = abs(%s);' % (value, tmp))
 
+    def noise_array(self, point):
+        return numpy.abs(self.noise.noise_array(point))
+
 class NegNoise(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, name=None):
         BasicNoiseSource.__init__(self, noise, name, 'neg')
 
@@ -298,7 +363,11 @@ class NegNoise(BasicNoiseSource):
         self.noise.noise_value(code, tmp, point)
         code.append('          %s = -(%s);' % (value, tmp))
 
+    def noise_array(self, point):
+        return -self.noise.noise_array(point)
+
 class RidgedNoise(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, offset=0.33, shift=True, name=None):
         BasicNoiseSource.__init__(self, noise, name, 'ridged')
         self.offset = offset
@@ -317,7 +386,14 @@ class RidgedNoise(BasicNoiseSource):
             code.append('        %s  = (1.0 - abs(tmp_ridged) - %g);' % (value, self.offset))
         code.append('        }')
 
+    def noise_array(self, point):
+        value = numpy.float32(1.0) - numpy.abs(self.noise.noise_array(point)) - numpy.float32(self.offset)
+        if self.shift:
+            value = value * numpy.float32(2.0) - numpy.float32(1.0)
+        return value
+
 class SquareNoise(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, name=None):
         BasicNoiseSource.__init__(self, noise, name, 'square')
 
@@ -331,7 +407,12 @@ class SquareNoise(BasicNoiseSource):
         code.append('        %s = tmp_square * tmp_square;' % value)
         code.append('        }')
 
+    def noise_array(self, point):
+        value = self.noise.noise_array(point)
+        return value * value
+
 class CubeNoise(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, name=None):
         BasicNoiseSource.__init__(self, noise, name, 'cube')
 
@@ -345,7 +426,12 @@ class CubeNoise(BasicNoiseSource):
         code.append('        %s = tmp_cube * tmp_cube * tmp_cube;' % value)
         code.append('        }')
 
+    def noise_array(self, point):
+        value = self.noise.noise_array(point)
+        return value * value * value
+
 class PositionMap(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, offset=0.0, scale=1.0, dynamic=True, name=None):
         BasicNoiseSource.__init__(self, noise, name, 'pos')
         self.offset = offset
@@ -369,6 +455,9 @@ class PositionMap(BasicNoiseSource):
         else:
             self.noise.noise_value(code, value, '(%s * %g + %g)' % (point, self.scale, self.offset))
 
+    def noise_array(self, point):
+        return self.noise.noise_array(point * numpy.float32(self.scale) + numpy.float32(self.offset))
+
     def update(self, instance):
         BasicNoiseSource.update(self, instance)
         if self.dynamic:
@@ -386,6 +475,7 @@ class PositionMap(BasicNoiseSource):
         return [group]
 
 class NoiseAdd(NoiseSource):
+    cpu_supported = True
     def __init__(self, noises, name=None):
         NoiseSource.__init__(self, name, 'add')
         self.noises = noises
@@ -417,6 +507,12 @@ class NoiseAdd(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_add_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        value = self.noises[0].noise_array(point)
+        for noise in self.noises[1:]:
+            value = value + noise.noise_array(point)
+        return value
+
     def update(self, instance):
         for noise in self.noises:
             noise.update(instance)
@@ -428,6 +524,7 @@ class NoiseAdd(NoiseSource):
         return parameters
 
 class NoiseSub(NoiseSource):
+    cpu_supported = True
     def __init__(self, noise_a, noise_b, name=None):
         NoiseSource.__init__(self, name, 'sub')
         self.noise_a = noise_a
@@ -459,6 +556,9 @@ class NoiseSub(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_sub_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        return self.noise_a.noise_array(point) - self.noise_b.noise_array(point)
+
     def update(self, instance):
         self.noise_a.update(instance)
         self.noise_b.update(instance)
@@ -467,6 +567,7 @@ class NoiseSub(NoiseSource):
         return self.noise_a.get_user_parameters() + self.noise_b.get_user_parameters()
 
 class NoiseMul(NoiseSource):
+    cpu_supported = True
     def __init__(self, noises, name=None):
         NoiseSource.__init__(self, name, 'mul')
         self.noises = noises
@@ -498,6 +599,12 @@ class NoiseMul(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_mul_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        value = self.noises[0].noise_array(point)
+        for noise in self.noises[1:]:
+            value = value * noise.noise_array(point)
+        return value
+
     def update(self, instance):
         for noise in self.noises:
             noise.update(instance)
@@ -509,6 +616,7 @@ class NoiseMul(NoiseSource):
         return parameters
 
 class NoisePow(NoiseSource):
+    cpu_supported = True
     def __init__(self, noise_a, noise_b, name=None):
         NoiseSource.__init__(self, name, 'pow')
         self.noise_a = noise_a
@@ -540,6 +648,10 @@ class NoisePow(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_pow_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return numpy.power(self.noise_a.noise_array(point), self.noise_b.noise_array(point))
+
     def update(self, instance):
         self.noise_a.update(instance)
         self.noise_b.update(instance)
@@ -548,6 +660,7 @@ class NoisePow(NoiseSource):
         return self.noise_a.get_user_parameters() + self.noise_b.get_user_parameters()
 
 class NoiseExp(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, name=None):
         BasicNoiseSource.__init__(self, noise, name, 'exp')
 
@@ -559,7 +672,11 @@ class NoiseExp(BasicNoiseSource):
         self.noise.noise_value(code, tmp, point)
         code.append('      %s = exp(%s);' % (value, tmp))
 
+    def noise_array(self, point):
+        return numpy.exp(self.noise.noise_array(point))
+
 class NoiseThreshold(NoiseSource):
+    cpu_supported = True
     def __init__(self, noise_a, noise_b, name=None):
         NoiseSource.__init__(self, name, 'threshold')
         self.noise_a = noise_a
@@ -591,6 +708,9 @@ class NoiseThreshold(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_threshold_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        return numpy.maximum(self.noise_a.noise_array(point) - self.noise_b.noise_array(point), numpy.float32(0.0))
+
     def update(self, instance):
         self.noise_a.update(instance)
         self.noise_b.update(instance)
@@ -599,6 +719,7 @@ class NoiseThreshold(NoiseSource):
         return self.noise_a.get_user_parameters() + self.noise_b.get_user_parameters()
 
 class NoiseClamp(NoiseSource):
+    cpu_supported = True
     def __init__(self, noise, min_value, max_value, dynamic=False, name=None, ranges={}):
         NoiseSource.__init__(self, name, 'clamp', ranges)
         self.noise = noise
@@ -636,6 +757,9 @@ class NoiseClamp(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_clamp_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        return numpy.clip(self.noise.noise_array(point), numpy.float32(self.min_value), numpy.float32(self.max_value))
+
     def update(self, instance):
         self.noise.update(instance)
         if self.dynamic:
@@ -650,6 +774,7 @@ class NoiseClamp(NoiseSource):
         return [group]
 
 class NoiseMin(NoiseSource):
+    cpu_supported = True
     def __init__(self, noise_a, noise_b, name=None):
         NoiseSource.__init__(self, name, 'min')
         self.noise_a = noise_a
@@ -681,6 +806,9 @@ class NoiseMin(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_min_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        return numpy.minimum(self.noise_a.noise_array(point), self.noise_b.noise_array(point))
+
     def update(self, instance):
         self.noise_a.update(instance)
         self.noise_b.update(instance)
@@ -689,6 +817,7 @@ class NoiseMin(NoiseSource):
         return self.noise_a.get_user_parameters() + self.noise_b.get_user_parameters()
 
 class NoiseMax(NoiseSource):
+    cpu_supported = True
     def __init__(self, noise_a, noise_b, name=None):
         NoiseSource.__init__(self, name, 'max')
         self.noise_a = noise_a
@@ -720,6 +849,9 @@ class NoiseMax(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_max_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        return numpy.maximum(self.noise_a.noise_array(point), self.noise_b.noise_array(point))
+
     def update(self, instance):
         self.noise_a.update(instance)
         self.noise_b.update(instance)
@@ -728,6 +860,7 @@ class NoiseMax(NoiseSource):
         return self.noise_a.get_user_parameters() + self.noise_b.get_user_parameters()
 
 class NoiseMap(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, min_value=0.0, max_value=1.0, src_min_value=-1.0, src_max_value=1.0, name=None):
         BasicNoiseSource.__init__(self, noise, name, 'map')
         self.min_value = min_value
@@ -753,7 +886,12 @@ class NoiseMap(BasicNoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_map_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        value = (self.noise.noise_array(point) - numpy.float32(self.src_min_value)) * numpy.float32(self.range_factor) + numpy.float32(self.min_value)
+        return numpy.clip(value, numpy.float32(self.min_value), numpy.float32(self.max_value))
+
 class Noise1D(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, axis, name=None):
         BasicNoiseSource.__init__(self, noise, name, 'axis')
         self.axis = axis
@@ -775,7 +913,14 @@ class Noise1D(BasicNoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_axis_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        axis = 'xyz'.index(self.axis)
+        point_1d = numpy.zeros_like(point)
+        point_1d[axis] = point[axis]
+        return self.noise.noise_array(point_1d)
+
 class FbmNoise(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, octaves=8, frequency=1.0, lacunarity=2.0, geometric=True, h=0.25, gain=0.5, name=None, ranges={}):
         BasicNoiseSource.__init__(self, noise, name, 'fbm', ranges)
         self.octaves = octaves
@@ -831,6 +976,23 @@ class FbmNoise(BasicNoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = Fbm_%s(%s);' % (value, self.str_id, point))
 
+    def noise_array(self, point):
+        frequency = numpy.float32(self.frequency)
+        lacunarity = numpy.float32(self.lacunarity)
+        if self.geometric:
+            gain = numpy.float32(self.gain)
+        else:
+            gain = lacunarity ** -numpy.float32(self.h)
+        result = numpy.zeros(point.shape[1], dtype=numpy.float32)
+        amplitude = numpy.float32(1.0)
+        max_value = numpy.float32(0.0)
+        for i in range(int(ceil(self.octaves))):
+            result += self.noise.noise_array(point * frequency) * amplitude
+            max_value += amplitude
+            amplitude *= gain
+            frequency *= lacunarity
+        return result / max_value
+
     def update(self, instance):
         self.noise.update(instance)
         instance.set_shader_input('%s_octaves' % self.str_id, self.octaves)
@@ -852,6 +1014,7 @@ class FbmNoise(BasicNoiseSource):
         return [group]
 
 class SpiralNoise(BasicNoiseSource):
+    cpu_supported = True
     def __init__(self, noise, octaves=8, frequency=1.0, lacunarity=2.0, gain=0.5, nudge=0.5, name=None, ranges={}):
         BasicNoiseSource.__init__(self, noise, name, 'spiral', ranges)
         self.octaves = octaves
@@ -904,6 +1067,27 @@ class SpiralNoise(BasicNoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = Spiral_%s(%s);' % (value, self.str_id, point))
 
+    def noise_array(self, point):
+        nudge = numpy.float32(self.nudge)
+        normalizer = numpy.float32(1.0) / numpy.sqrt(numpy.float32(1.0) + nudge * nudge)
+        frequency = numpy.float32(self.frequency)
+        lacunarity = numpy.float32(self.lacunarity)
+        gain = numpy.float32(self.gain)
+        point = point.copy()
+        result = numpy.zeros(point.shape[1], dtype=numpy.float32)
+        amplitude = numpy.float32(1.0)
+        max_value = numpy.float32(0.0)
+        for i in range(int(ceil(self.octaves))):
+            result += self.noise.noise_array(point * frequency) * amplitude
+            max_value += amplitude
+            amplitude *= gain
+            frequency *= lacunarity
+            (point[0], point[1]) = (point[0] + point[1] * nudge, point[1] - point[0] * nudge)
+            point[:2] *= normalizer
+            (point[0], point[2]) = (point[0] + point[2] * nudge, point[2] - point[0] * nudge)
+            point[0::2] *= normalizer
+        return result / max_value
+
     def update(self, instance):
         self.noise.update(instance)
         instance.set_shader_input('%s_octaves' % self.str_id, self.octaves)
@@ -924,6 +1108,7 @@ class SpiralNoise(BasicNoiseSource):
         return [group]
 
 class NoiseWarp(NoiseSource):
+    cpu_supported = True
     def __init__(self, noise_main, noise_warp, scale=4.0, name=None, ranges={}):
         NoiseSource.__init__(self, name, 'warp', ranges)
         self.noise_main = noise_main
@@ -959,6 +1144,12 @@ class NoiseWarp(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_warp_%d(%s);' % (value, self.num_id, point))
 
+    def noise_array(self, point):
+        warped_point = numpy.stack((self.noise_warp.noise_array(point),
+                                    self.noise_warp.noise_array(point + numpy.array([[1.0], [2.0], [3.0]], dtype=numpy.float32)),
+                                    self.noise_warp.noise_array(point + numpy.array([[4.0], [3.0], [2.0]], dtype=numpy.float32))))
+        return self.noise_main.noise_array(point + numpy.float32(self.scale) * warped_point)
+
     def update(self, instance):
         self.noise_main.update(instance)
         self.noise_warp.update(instance)
@@ -973,6 +1164,7 @@ class NoiseWarp(NoiseSource):
         return [group]
 
 class NoiseRotate(NoiseSource):
+    cpu_supported = True
     def __init__(self, noise_main, noise_angle, axis, name=None):
         NoiseSource.__init__(self, name, 'rot' + axis)
         self.noise_main = noise_main
@@ -1019,6 +1211,19 @@ class NoiseRotate(NoiseSource):
     def noise_value(self, code, value, point):
         code.append('%s = noise_rot%s_%d(%s);' % (value, self.axis, self.num_id, point))
 
+    def noise_array(self, point):
+        theta = self.noise_angle.noise_array(point)
+        cos_theta = numpy.cos(theta)
+        sin_theta = numpy.sin(theta)
+        (x, y, z) = point
+        if self.axis == 'x':
+            rotated = (x, cos_theta * y + sin_theta * z, cos_theta * z - sin_theta * y)
+        elif self.axis == 'y':
+            rotated = (cos_theta * x - sin_theta * z, y, sin_theta * x + cos_theta * z)
+        else:
+            rotated = (cos_theta * x + sin_theta * y, cos_theta * y - sin_theta * x, z)
+        return self.noise_main.noise_array(numpy.stack(rotated))
+
     def update(self, instance):
         self.noise_main.update(instance)
         self.noise_angle.update(instance)
@@ -1147,7 +1352,8 @@ class NoiseShader(StructuredShader):
             name += '-' + target
         return name
 
-    def get_rot_for_face(self, face):
+    @staticmethod
+    def get_rot_for_face(face):
         if face == 0:
             return LMatrix3(0.0, 0.0, 1.0,
                             0.0, 1.0, 0.0,
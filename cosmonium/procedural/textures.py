@@ -23,9 +23,9 @@ from __future__ import absolute_import
 from panda3d.core import Texture
 
 from ..textures import TextureSource
-from .generator import GeneratorPool
+from .generator import create_patch_generator
 from .shadernoise import NoiseShader
-from .. import settings
+from .tilecache import tileCache
 
 class ProceduralVirtualTextureSource(TextureSource):
     tex_generators = {}
@@ -81,19 +81,13 @@ class ProceduralVirtualTextureSource(TextureSource):
             callback(*(self.map_patch[patch] + cb_args))
 
     def _make_texture(self, patch, callback, cb_args):
-        if not self.texture_size in ProceduralVirtualTextureSource.tex_generators:
-            ProceduralVirtualTextureSource.tex_generators[self.texture_size] = GeneratorPool(settings.patch_pool_size)
-            ProceduralVirtualTextureSource.tex_generators[self.texture_size].make_buffer(self.texture_size, self.texture_size, Texture.F_rgba)
-        self.tex_generator = ProceduralVirtualTextureSource.tex_generators[self.texture_size]
-        if True:#self.shader is None:
-            shader = NoiseShader(coord = patch.coord,
-                                 noise_source=self.noise,
-                                 noise_target=self.target,
-                                 offset=(patch.x0, patch.y0, 0.0),
-                                 scale=(patch.lod_scale_x, patch.lod_scale_y, 1.0))
-            shader.global_frequency = self.global_frequency
-            shader.global_scale = self.global_scale
-            shader.create_and_register_shader(None, None)
+        shader = NoiseShader(coord = patch.coord,
+                             noise_source=self.noise,
+                             noise_target=self.target,
+                             offset=(patch.x0, patch.y0, 0.0),
+                             scale=(patch.lod_scale_x, patch.lod_scale_y, 1.0))
+        shader.global_frequency = self.global_frequency
+        shader.global_scale = self.global_scale
         self.texture = Texture()
         self.texture.set_wrap_u(Texture.WMClamp)
         self.texture.set_wrap_v(Texture.WMClamp)
@@ -102,8 +96,15 @@ class ProceduralVirtualTextureSource(TextureSource):
         else:
             self.texture.setMinfilter(Texture.FT_linear)
         self.texture.setMagfilter(Texture.FT_linear)
-
-        self.tex_generator.generate(shader, patch.face, self.texture, self.texture_ready_cb, (patch, callback, cb_args))
+        key = tileCache.get_key(shader, patch.face, patch.lod, self.texture_size, self.texture_size)
+        if tileCache.load_texture(key, self.texture):
+            self.texture_ready_cb(self.texture, patch, callback, cb_args)
+            return
+        if not self.texture_size in ProceduralVirtualTextureSource.tex_generators:
+            ProceduralVirtualTextureSource.tex_generators[self.texture_size] = create_patch_generator(self.texture_size, self.texture_size, Texture.F_rgba)
+        self.tex_generator = ProceduralVirtualTextureSource.tex_generators[self.texture_size]
+        shader.create_and_register_shader(None, None)
+        self.tex_generator.generate(shader, patch.face, self.texture, tileCache.texture_ready_cb, (key, self.texture_ready_cb, (patch, callback, cb_args)), patch)
 
     def get_texture(self, patch):
         if patch in self.map_patch:
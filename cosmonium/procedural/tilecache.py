@@ -0,0 +1,322 @@
+#
+#This file is part of Cosmonium.
+#
+#Copyright (C) 2018-2019 Laurent Deru.
+#
+#Cosmonium is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Cosmonium is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Cosmonium.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+from .shadernoise import NoiseSource
+from ..cache import create_path_for, replace_file
+from ..workers import AsyncLoader
+from .. import workers
+from .. import settings
+from .. import pstats
+
+from collections import OrderedDict
+import hashlib
+import numpy
+import sys
+import os
+
+#Attributes of the noise sources which do not change the generated values
+ignored_attributes = ('num_id', 'str_id', 'name', 'ranges', 'shader')
+
+def noise_description(value, visited=None):
+    """
+    Build a description of the noise graph and of all its parameters, suitable to be hashed.
+    The generated ids of the noise sources are ignored as they are not stable between runs.
+    """
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if visited is None:
+        visited = set()
+    if id(value) in visited:
+        return 'cycle'
+    visited.add(id(value))
+    if isinstance(value, (list, tuple)):
+        return [noise_description(item, visited) for item in value]
+    if isinstance(value, dict):
+        return sorted((repr(key), noise_description(item, visited)) for (key, item) in value.items())
+    if isinstance(value, numpy.ndarray):
+        return value.tolist()
+    if isinstance(value, NoiseSource):
+        attributes = []
+        for (name, item) in sorted(vars(value).items()):
+            if name in ignored_attributes: continue
+            attributes.append((name, noise_description(item, visited)))
+        return [value.__class__.__name__, attributes]
+    try:
+        return tuple(value)
+    except TypeError:
+        #Unknown object, its repr could contain its address, it will only make the tile miss the cache
+        return repr(value)
+
+class TileCacheEntry(object):
+    __slots__ = ['data', 'width', 'height', 'component_type', 'texture_format', 'memory']
+
+    def __init__(self, data, width, height, component_type, texture_format):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.component_type = component_type
+        self.texture_format = texture_format
+        self.memory = data.nbytes
+
+    @classmethod
+    def create_from_texture(cls, texture):
+        ram_image = texture.get_ram_image()
+        if sys.version_info[0] < 3:
+            data = numpy.fromstring(ram_image.get_data(), dtype=numpy.uint8)
+        else:
+            data = numpy.frombuffer(ram_image, dtype=numpy.uint8).copy()
+        return cls(data, texture.get_x_size(), texture.get_y_size(), texture.get_component_type(), texture.get_format())
+
+    def apply(self, texture):
+        texture.setup_2d_texture(self.width, self.height, self.component_type, self.texture_format)
+        texture.set_ram_image(self.data.tobytes())
+
+class TileCache(object):
+    """
+    Cache of the generated heightmap and texture tiles.
+    The most recently used tiles are kept in memory, up to a memory budget in bytes, in front of a
+    compressed disk cache, itself bounded by a disk budget. The least recently used files are removed first.
+    """
+    cache_version = 1
+    #Fraction of the disk budget kept when the disk cache is trimmed, to avoid a trim after each new tile
+    disk_trim_ratio = 0.9
+
+    def __init__(self, max_size=None, max_disk_size=None):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self.size = 0
+        self.disk_size = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.writer = None
+
+    def get_max_size(self):
+        if self.max_size is not None:
+            return self.max_size
+        return settings.tile_cache_size
+
+    def get_max_disk_size(self):
+        if self.max_disk_size is not None:
+            return self.max_disk_size
+        return settings.tile_disk_cache_size
+
+    def get_key(self, shader, face, lod, width, height):
+        """
+        Return the key of the tile generated by the given noise shader, or None if the tiles are not cached.
+        The position of the tile is part of the offset and scale of the shader.
+        """
+        if not settings.cache_tiles: return None
+        target = shader.noise_target
+        parameters = [self.cache_version,
+                      noise_description(shader.noise_source),
+                      target.__class__.__name__, target.get_id(),
+                      shader.coord,
+                      tuple(shader.offset), tuple(shader.scale),
+                      shader.global_frequency, tuple(shader.global_offset), shader.global_scale]
+        digest = hashlib.sha1(repr(parameters).encode('utf-8')).hexdigest()
+        return '%d-%d-%dx%d-%s' % (face, lod, width, height, digest)
+
+    def get_path(self):
+        return create_path_for('tiles')
+
+    def get_filename(self, key):
+        return os.path.join(self.get_path(), key + '.npz')
+
+    def load(self, key):
+        filename = self.get_filename(key)
+        if not os.path.exists(filename): return None
+        try:
+            with numpy.load(filename) as data:
+                entry = TileCacheEntry(data['data'], int(data['width']), int(data['height']),
+                                       int(data['component_type']), int(data['format']))
+        except Exception as e:
+            #The file is corrupted or truncated, remove it so that the tile is generated and stored again
+            print("Could not load tile cache", filename, ':', e)
+            self.remove_file(filename)
+            return None
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return entry
+
+    def store(self, key, entry):
+        """
+        Write the tile in the disk cache. When the application is running, the file is written by a dedicated
+        worker thread, so that the compression and the scan of the cache directory are not done on the render thread.
+        """
+        if self.writer is None and workers.asyncTextureLoader is not None:
+            self.writer = AsyncLoader(base, 'TileCacheWriter', 1)
+        if self.writer is not None:
+            self.writer.add_job(self.write, [key, entry], self.write_done_cb, [])
+        else:
+            self.write(key, entry)
+
+    def write(self, key, entry):
+        #The size must be known before the file is written, otherwise the first scan would already include it
+        disk_size = self.get_disk_size()
+        filename = self.get_filename(key)
+        tmp_filename = filename + '.tmp'
+        try:
+            with open(tmp_filename, 'wb') as f:
+                numpy.savez_compressed(f, data=entry.data, width=entry.width, height=entry.height,
+                                       component_type=int(entry.component_type), format=int(entry.texture_format))
+            replace_file(tmp_filename, filename)
+        except (IOError, OSError) as e:
+            print("Could not write tile cache", filename, ':', e)
+            return
+        self.disk_size = disk_size + os.path.getsize(filename)
+        if self.disk_size > self.get_max_disk_size():
+            self.trim_disk()
+
+    def write_done_cb(self, result):
+        self.update_stats()
+
+    def remove_file(self, filename):
+        try:
+            os.remove(filename)
+        except OSError as e:
+            print("Could not remove tile cache", filename, ':', e)
+
+    def list_files(self):
+        path = self.get_path()
+        files = []
+        for name in os.listdir(path):
+            if not name.endswith('.npz'): continue
+            filename = os.path.join(path, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+        return files
+
+    def get_disk_size(self):
+        if self.disk_size is None:
+            self.disk_size = sum(size for (mtime, size, filename) in self.list_files())
+        return self.disk_size
+
+    def trim_disk(self):
+        max_disk_size = self.get_max_disk_size() * self.disk_trim_ratio
+        files = sorted(self.list_files())
+        self.disk_size = sum(size for (mtime, size, filename) in files)
+        for (mtime, size, filename) in files:
+            if self.disk_size <= max_disk_size: break
+            try:
+                os.remove(filename)
+            except OSError as e:
+                print("Could not remove tile cache", filename, ':', e)
+                continue
+            self.disk_size -= size
+            self.disk_evictions += 1
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+            self.hits += 1
+        else:
+            entry = self.load(key)
+            if entry is not None:
+                self.disk_hits += 1
+                self.add(key, entry)
+            else:
+                self.misses += 1
+        self.update_stats()
+        return entry
+
+    def add(self, key, entry):
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous.memory
+        self.entries[key] = entry
+        self.size += entry.memory
+        self.evict()
+
+    def evict(self):
+        max_size = self.get_max_size()
+        while self.size > max_size and len(self.entries) > 0:
+            (key, entry) = self.entries.popitem(last=False)
+            self.size -= entry.memory
+            self.evictions += 1
+
+    def load_texture(self, key, texture):
+        """
+        Fill the texture with the cached tile, return False if the tile is not in the cache.
+        """
+        if key is None: return False
+        entry = self.get(key)
+        if entry is None: return False
+        entry.apply(texture)
+        return True
+
+    def store_texture(self, key, texture):
+        if key is None or texture is None or not texture.has_ram_image(): return
+        entry = TileCacheEntry.create_from_texture(texture)
+        self.add(key, entry)
+        self.store(key, entry)
+        self.update_stats()
+
+    def texture_ready_cb(self, texture, key, callback, cb_args):
+        self.store_texture(key, texture)
+        if callback is not None:
+            callback(texture, *cb_args)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def clear_disk(self):
+        for (mtime, size, filename) in self.list_files():
+            try:
+                os.remove(filename)
+            except OSError as e:
+                print("Could not remove tile cache", filename, ':', e)
+        self.disk_size = None
+
+    def update_stats(self):
+        pstats.levelpstat('hits', 'Tiles').set_level(self.hits)
+        pstats.levelpstat('disk_hits', 'Tiles').set_level(self.disk_hits)
+        pstats.levelpstat('misses', 'Tiles').set_level(self.misses)
+        pstats.levelpstat('evictions', 'Tiles').set_level(self.evictions)
+        pstats.levelpstat('memory', 'Tiles').set_level(self.size)
+        if self.disk_size is not None:
+            pstats.levelpstat('disk', 'Tiles').set_level(self.disk_size)
+
+tileCache = TileCache()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Inspect the disk cache of the generated tiles")
+    parser.add_argument("--clear", help="Remove all the cached tiles", action="store_true")
+    args = parser.parse_args()
+    files = tileCache.list_files()
+    print("Tile cache:", tileCache.get_path())
+    print("%d tiles, %.1f MiB (budget %.1f MiB)" % (len(files), tileCache.get_disk_size() / 1024.0 / 1024.0,
+                                                   tileCache.get_max_disk_size() / 1024.0 / 1024.0))
+    if args.clear:
+        tileCache.clear_disk()
+        print("Cleared")
@@ -17,10 +17,193 @@
 #along with Cosmonium.  If not, see <https://www.gnu.org/licenses/>.
 #
 
+from __future__ import print_function
+from __future__ import absolute_import
+
 from panda3d.core import PStatCollector
 from functools import wraps
+from collections import deque
+from threading import Lock
+import json
+import csv
+import atexit
+
+try:
+    from time import perf_counter as timer
+except ImportError:
+    from time import time as timer
+
+import numpy
+
+class FrameProfiler(object):
+    """In-process collection of named timers and levels.
+    The values are accumulated during a frame and kept per frame in ring buffers,
+    so that percentiles can be computed and exported without a PStats server."""
+    percentiles = (50, 90, 95, 99)
+
+    def __init__(self, history=1000):
+        self.enabled = False
+        self.history = history
+        self.lock = Lock()
+        self.kinds = {}
+        self.current = {}
+        self.current_calls = {}
+        self.samples = {}
+        self.calls = {}
+        self.frame_ids = deque(maxlen=history)
+        self.nb_frames = 0
+        self.frame_start = None
+
+    def enable(self, history=None, output=None):
+        if history is not None and history != self.history:
+            self.history = history
+            self.reset()
+        self.enabled = True
+        if output is not None:
+            atexit.register(self.export, output)
+
+    def disable(self):
+        self.enabled = False
+        self.frame_start = None
+
+    def reset(self):
+        with self.lock:
+            self.kinds = {}
+            self.current = {}
+            self.current_calls = {}
+            self.samples = {}
+            self.calls = {}
+            self.frame_ids = deque(maxlen=self.history)
+            self.nb_frames = 0
+            self.frame_start = None
+
+    def add_time(self, name, duration):
+        with self.lock:
+            self.kinds[name] = 'time'
+            self.current[name] = self.current.get(name, 0.0) + duration
+            self.current_calls[name] = self.current_calls.get(name, 0) + 1
+
+    def set_level(self, name, value):
+        with self.lock:
+            self.kinds[name] = 'level'
+            self.current[name] = value
+
+    def next_frame(self):
+        """Close the current frame, if any, and start a new one"""
+        if not self.enabled: return
+        now = timer()
+        if self.frame_start is not None:
+            self.add_time('Frame:time', now - self.frame_start)
+            self.end_frame()
+        self.frame_start = now
+
+    def end_frame(self):
+        with self.lock:
+            current = self.current
+            current_calls = self.current_calls
+            self.current = {}
+            self.current_calls = {}
+            self.frame_ids.append(self.nb_frames)
+            self.nb_frames += 1
+            for (name, kind) in self.kinds.items():
+                samples = self.samples.get(name)
+                if samples is None:
+                    self.samples[name] = samples = deque(maxlen=self.history)
+                if kind == 'level':
+                    #A level keeps its value until it is set again
+                    value = current.get(name, samples[-1] if len(samples) > 0 else 0)
+                else:
+                    value = current.get(name, 0)
+                samples.append(value)
+                if kind == 'time':
+                    calls = self.calls.get(name)
+                    if calls is None:
+                        self.calls[name] = calls = deque(maxlen=self.history)
+                    calls.append(current_calls.get(name, 0))
+
+    def summary(self):
+        """Return, for each entry, the statistics of its per frame values; times are in ms"""
+        result = {}
+        with self.lock:
+            entries = [(name, self.kinds[name], list(samples), list(self.calls.get(name, ()))) for (name, samples) in self.samples.items()]
+        for (name, kind, samples, calls) in entries:
+            if len(samples) == 0: continue
+            values = numpy.array(samples, dtype=numpy.float64)
+            if kind == 'time':
+                values *= 1000.0
+            stats = {'kind': kind,
+                     'frames': len(values),
+                     'mean': float(values.mean()),
+                     'min': float(values.min()),
+                     'max': float(values.max()),
+                     }
+            for (percentile, value) in zip(self.percentiles, numpy.percentile(values, self.percentiles)):
+                stats['p%d' % percentile] = float(value)
+            if kind == 'time':
+                stats['calls'] = float(numpy.mean(calls))
+            result[name] = stats
+        return result
+
+    def print_summary(self):
+        summary = self.summary()
+        print("%-40s %6s %10s %10s %10s %10s" % ("Entry", "Kind", "Mean", "P50", "P95", "Max"))
+        for name in sorted(summary.keys()):
+            stats = summary[name]
+            print("%-40s %6s %10.3f %10.3f %10.3f %10.3f" % (name, stats['kind'], stats['mean'], stats['p50'], stats['p95'], stats['max']))
+
+    def export(self, filename):
+        if filename.endswith('.csv'):
+            self.export_csv(filename)
+        else:
+            self.export_json(filename)
+
+    def to_dict(self):
+        with self.lock:
+            samples = dict([(name, list(values)) for (name, values) in self.samples.items()])
+            nb_frames = self.nb_frames
+        return {'frames': nb_frames,
+                'summary': self.summary(),
+                'samples': samples}
+
+    def export_json(self, filename):
+        data = self.to_dict()
+        with open(filename, 'w') as output:
+            json.dump(data, output, indent=1, sort_keys=True)
+        print("Profile written to", filename)
+
+    def export_csv(self, filename):
+        """Write one row per recorded frame, with one column per entry. Times are in ms"""
+        with self.lock:
+            names = sorted(self.samples.keys())
+            frame_ids = list(self.frame_ids)
+            columns = []
+            for name in names:
+                values = list(self.samples[name])
+                if self.kinds[name] == 'time':
+                    values = [value * 1000.0 for value in values]
+                #Entries created after the first recorded frame have fewer samples
+                columns.append([''] * (len(frame_ids) - len(values)) + values)
+        with open(filename, 'w') as output:
+            writer = csv.writer(output)
+            writer.writerow(['frame'] + names)
+            for (i, frame_id) in enumerate(frame_ids):
+                writer.writerow([frame_id] + [column[i] for column in columns])
+        print("Profile written to", filename)
+
+profiler = FrameProfiler()
 
 custom_collectors = {}
+level_collectors = {}
+
+class LevelCollector(object):
+    def __init__(self, name):
+        self.name = name
+        self.collector = PStatCollector(name)
+
+    def set_level(self, value):
+        self.collector.set_level(value)
+        if profiler.enabled:
+            profiler.set_level(self.name, value)
 
 def named_pstat(name):
     def pstat(func):
@@ -30,9 +213,16 @@ def named_pstat(name):
         pstat = custom_collectors[collectorName]
         @wraps(func)
         def doPstat(*args, **kargs):
-            pstat.start()
-            returned = func(*args, **kargs)
-            pstat.stop()
+            if profiler.enabled:
+                start = timer()
+                pstat.start()
+                returned = func(*args, **kargs)
+                pstat.stop()
+                profiler.add_time(collectorName, timer() - start)
+            else:
+                pstat.start()
+                returned = func(*args, **kargs)
+                pstat.stop()
             return returned
         return doPstat
     return pstat
@@ -42,7 +232,6 @@ def pstat(func):
 
 def levelpstat(name, category='Engine'):
     collectorName = category + ':' + name
-    if not collectorName in custom_collectors.keys():
-        custom_collectors[collectorName] = PStatCollector(collectorName)
-    pstat = custom_collectors[collectorName]
-    return pstat
+    if not collectorName in level_collectors.keys():
+        level_collectors[collectorName] = LevelCollector(collectorName)
+    return level_collectors[collectorName]
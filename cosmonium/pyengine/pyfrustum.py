@@ -22,6 +22,8 @@ from __future__ import absolute_import
 
 from panda3d.core import LPlaned
 
+import numpy
+
 class InfiniteFrustum(object):
     def __init__(self, frustum, view_mat, view_position):
         self.planes = []
@@ -34,6 +36,12 @@ class InfiniteFrustum(object):
             new_plane[2] = plane[2]
             new_plane[3] = plane[3] - new_plane.get_normal().dot(view_position)
             self.planes.append(new_plane)
+        self.planes_array = None
+
+    def get_planes_array(self):
+        if self.planes_array is None:
+            self.planes_array = numpy.array([tuple(plane) for plane in self.planes])
+        return self.planes_array
 
     def is_sphere_in(self, center, radius):
         for plane in self.planes:
@@ -41,5 +49,18 @@ class InfiniteFrustum(object):
             if dist > radius: return False
         return True
 
+    def is_sphere_fully_in(self, center, radius):
+        for plane in self.planes:
+            dist = plane.dist_to_plane(center)
+            if dist > -radius: return False
+        return True
+
+    def are_spheres_in(self, centers, radii):
+        """Batched version of is_sphere_in(), centers is a (N, 3) array and radii a (N) array.
+        Returns a boolean mask of the spheres inside the frustum."""
+        planes = self.get_planes_array()
+        distances = numpy.dot(centers, planes[:, :3].T) + planes[:, 3]
+        return numpy.all(distances <= radii[:, numpy.newaxis], axis=1)
+
     def get_position(self):
         return self.position
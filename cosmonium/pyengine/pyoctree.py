@@ -23,8 +23,10 @@ from __future__ import absolute_import
 from panda3d.core import LPoint3d
 
 from ..astro.astro import abs_to_app_mag, app_to_abs_mag
+from ..astro import units
 
-from math import sqrt
+from math import sqrt, log10
+import numpy
 
 def OctreeLeaf(ref_object, *args):
     return ref_object
@@ -96,7 +98,7 @@ class OctreeNode(object):
                 child_center.z += child_offset
             else:
                 child_center.z -= child_offset
-            child = OctreeNode(self.level + 1, child_center, self.width / 2.0, self.threshold + self.child_threshold, index)
+            child = self.__class__(self.level + 1, child_center, self.width / 2.0, self.threshold + self.child_threshold, index)
             self.children[index] = child
         self.children[index]._add(obj, position, magnitude)
 
@@ -142,6 +144,58 @@ class OctreeNode(object):
         print("Nb cells:", self.nb_cells)
         print("Nb leaves:", self.nb_leaves)
 
+class ArrayOctreeNode(OctreeNode):
+    """Octree node storing the position, magnitude and extend of its leaves in contiguous arrays,
+    the visibility of all the leaves of the cell is then tested in one batched operation."""
+    min_array_leaves = 16
+
+    def __init__(self, level, center, width, threshold, index = -1):
+        OctreeNode.__init__(self, level, center, width, threshold, index)
+        self.arrays_dirty = True
+        self.nb_changes = 0
+        self.positions = None
+        self.magnitudes = None
+        self.extends = None
+
+    def update_arrays(self):
+        nb_leaves = len(self.leaves)
+        self.positions = numpy.empty((nb_leaves, 3))
+        self.magnitudes = numpy.empty(nb_leaves)
+        self.extends = numpy.empty(nb_leaves)
+        for (i, leaf) in enumerate(self.leaves):
+            self.positions[i] = tuple(leaf._global_position)
+            self.magnitudes[i] = leaf.get_abs_magnitude()
+            self.extends[i] = leaf._extend
+            #Allow the leaf to invalidate the arrays when its extend or magnitude changes
+            try:
+                leaf.octree_cell = self
+            except AttributeError:
+                pass
+        self.arrays_dirty = False
+
+    def leaf_changed(self):
+        self.arrays_dirty = True
+        self.nb_changes += 1
+
+    def traverse(self, traverser):
+        if len(self.leaves) < self.min_array_leaves:
+            traverser.traverse(self, self.leaves)
+        else:
+            if self.arrays_dirty:
+                self.update_arrays()
+            traverser.traverse_arrays(self, self.leaves, self.positions, self.magnitudes, self.extends)
+        for child in self.children:
+            if child is not None and traverser.enter(child):
+                child.traverse(traverser)
+
+    def _add(self, obj, position, magnitude):
+        OctreeNode._add(self, obj, position, magnitude)
+        self.arrays_dirty = True
+
+    def _split(self):
+        OctreeNode._split(self)
+        self.arrays_dirty = True
+
 class VisibleObjectsTraverser(object):
     def __init__(self, frustum, limit, update_id):
         self.frustum = frustum
@@ -192,3 +246,129 @@ class VisibleObjectsTraverser(object):
             if add:
                 self.collected_leaves.append(leaf)
                 leaf.update_id = self.update_id
+
+    def traverse_arrays(self, octree, leaves, positions, magnitudes, extends):
+        frustum = self.frustum
+        frustum_position = frustum.get_position()
+        distance = (octree.center - frustum_position).length() - octree.radius
+        if distance > 0.0:
+            faintest = app_to_abs_mag(self.limit, distance)
+            candidates = numpy.flatnonzero(magnitudes < faintest)
+            if len(candidates) == 0: return
+        else:
+            candidates = numpy.flatnonzero(magnitudes < 99.0)
+        directions = positions[candidates] - tuple(frustum_position)
+        distances = numpy.sqrt(numpy.einsum('ij,ij->i', directions, directions))
+        at_origin = distances <= 0.0
+        #Avoid log of 0, those leaves are always added
+        distances[at_origin] = 1.0
+        app_magnitudes = magnitudes[candidates] + 5 * (numpy.log10(distances / units.KmPerParsec) - 1)
+        selected = app_magnitudes < self.limit
+        selected[selected] = frustum.are_spheres_in(positions[candidates[selected]], extends[candidates[selected]])
+        selected |= at_origin
+        update_id = self.update_id
+        for index in candidates[selected].tolist():
+            leaf = leaves[index]
+            self.collected_leaves.append(leaf)
+            leaf.update_id = update_id
+
+class CellVisibility(object):
+    __slots__ = ('position', 'planes', 'limit', 'fully_in', 'min_distance', 'margin', 'leaves', 'update_id', 'nb_changes')
+
+    def __init__(self, position, planes, limit, fully_in, min_distance, margin, leaves, update_id, nb_changes):
+        self.position = position
+        self.planes = planes
+        self.limit = limit
+        self.fully_in = fully_in
+        self.min_distance = min_distance
+        self.margin = margin
+        self.leaves = leaves
+        self.update_id = update_id
+        self.nb_changes = nb_changes
+
+class CoherentVisibleObjectsTraverser(VisibleObjectsTraverser):
+    """Frame-coherent version of VisibleObjectsTraverser.
+    The visible leaves of each cell are kept in cells_cache and reused as long as the visibility status
+    of the cell can not have changed : either the frustum is the same, or the cell is entirely in the frustum
+    and the observer did not move enough to bring any leaf across the magnitude limit.
+    The leaves leaving the visible set are collected per cell, so their instances can be removed."""
+    def __init__(self, frustum, limit, update_id, cells_cache):
+        VisibleObjectsTraverser.__init__(self, frustum, limit, update_id)
+        self.cells_cache = cells_cache
+        self.planes = tuple(tuple(plane) for plane in frustum.planes)
+        self.visited_cells = []
+        self.removed_leaves = []
+        self.nb_cells_revisited = 0
+        self.nb_cells_reused = 0
+
+    def can_reuse(self, octree, entry):
+        if entry.limit != self.limit or entry.nb_changes != getattr(octree, 'nb_changes', 0):
+            return False
+        position = self.frustum.get_position()
+        moved = (position - entry.position).length()
+        if moved == 0.0 and entry.planes == self.planes:
+            return True
+        if not entry.fully_in or moved >= entry.min_distance:
+            return False
+        #Upper bound of the change of apparent magnitude of the leaves of the cell
+        delta_magnitude = 5 * log10(entry.min_distance / (entry.min_distance - moved))
+        if delta_magnitude >= entry.margin:
+            return False
+        return self.frustum.is_sphere_fully_in(octree.center, octree.radius)
+
+    def check_reuse(self, octree):
+        entry = self.cells_cache.get(octree)
+        self.visited_cells.append(octree)
+        if entry is None or not self.can_reuse(octree, entry):
+            self.nb_cells_revisited += 1
+            return False
+        self.nb_cells_reused += 1
+        update_id = self.update_id
+        for leaf in entry.leaves:
+            leaf.update_id = update_id
+        self.collected_leaves += entry.leaves
+        entry.update_id = update_id
+        return True
+
+    def store(self, octree, start, margin):
+        frustum = self.frustum
+        position = frustum.get_position()
+        leaves = self.collected_leaves[start:]
+        entry = self.cells_cache.get(octree)
+        if entry is not None and entry.update_id == self.update_id - 1:
+            new_ids = set(map(id, leaves))
+            self.removed_leaves += [leaf for leaf in entry.leaves if id(leaf) not in new_ids]
+        min_distance = (octree.center - position).length() - octree.radius
+        fully_in = min_distance > 0.0 and frustum.is_sphere_fully_in(octree.center, octree.radius)
+        self.cells_cache[octree] = CellVisibility(LPoint3d(position), self.planes, self.limit, fully_in, min_distance, margin, leaves, self.update_id,
+                                                  getattr(octree, 'nb_changes', 0))
+
+    def calc_leaves_margin(self, leaves):
+        position = self.frustum.get_position()
+        margin = 99.0
+        for leaf in leaves:
+            distance = (leaf._global_position - position).length()
+            if distance <= 0.0:
+                return 0.0
+            margin = min(margin, abs(abs_to_app_mag(leaf.get_abs_magnitude(), distance) - self.limit))
+        return margin
+
+    def calc_arrays_margin(self, positions, magnitudes):
+        directions = positions - tuple(self.frustum.get_position())
+        distances = numpy.sqrt(numpy.einsum('ij,ij->i', directions, directions))
+        if numpy.any(distances <= 0.0):
+            return 0.0
+        app_magnitudes = magnitudes + 5 * (numpy.log10(distances / units.KmPerParsec) - 1)
+        return float(numpy.min(numpy.abs(app_magnitudes - self.limit)))
+
+    def traverse(self, octree, leaves):
+        if self.check_reuse(octree): return
+        start = len(self.collected_leaves)
+        VisibleObjectsTraverser.traverse(self, octree, leaves)
+        self.store(octree, start, self.calc_leaves_margin(leaves))
+
+    def traverse_arrays(self, octree, leaves, positions, magnitudes, extends):
+        if self.check_reuse(octree): return
+        start = len(self.collected_leaves)
+        VisibleObjectsTraverser.traverse_arrays(self, octree, leaves, positions, magnitudes, extends)
+        self.store(octree, start, self.calc_arrays_margin(positions, magnitudes))
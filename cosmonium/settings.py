@@ -69,6 +69,17 @@ deferred=False
 deferred_split=False
 deferred_load=True
 patch_pool_size = 4
+#Generate up to generator_batch_size patch tiles per frame in a single pass, instead of one tile per generator of the pool
+batch_generator = False
+generator_batch_size = 16
+#Generate the noise heightmaps on the CPU, using a pool of cpu_generator_workers processes (None for one per core)
+cpu_generator = False
+cpu_generator_workers = None
+#Keep the generated heightmap and texture tiles in a memory cache of tile_cache_size bytes,
+#backed by a disk cache of tile_disk_cache_size bytes
+cache_tiles = True
+tile_cache_size = 64 * 1024 * 1024
+tile_disk_cache_size = 1024 * 1024 * 1024
 
 mouse_over = False
 use_color_picking = True
@@ -86,6 +97,8 @@ patch_max_density = 64
 patch_constant_density = 32
 cull_far_patches = False
 cull_far_patches_threshold = 10
+#Memory budget, in bytes, of the virtual textures cache
+texture_cache_size = 512 * 1024 * 1024
 
 use_patch_adaptation = True
 use_patch_skirts = True
@@ -158,7 +171,33 @@ dump_panda_shaders = False
 debug_shadow_frustum = False
 
 sync_data_load = False
+columnar_star_catalog = True
+octree_array_leaves = True
+cache_octree = True
+octree_coherent_traversal = True
+batch_ephemeris = True
+#Skip the update of the bodies whose extrapolated position is within update_error_budget pixels
+coherent_update = True
+update_error_budget = 0.5
+#Maximum number of consecutive skipped updates of a body
+update_max_skip = 30
+stream_celestia_parser = True
+cache_celestia_catalogs = True
+deferred_ssc_bodies = True
+cache_galaxies = True
+#Number of generated galaxy point clouds kept in memory
+galaxy_cache_size = 64
+#Size in bytes of the disk cache of the galaxy point clouds
+galaxy_disk_cache_size = 256 * 1024 * 1024
+#Number of orbit paths kept in memory
+orbit_path_cache_size = 4096
 sync_texture_load = False
+#Number of threads used to load the textures in the background
+loader_threads = 2
+#In-process frame profiler, the timers and levels are exported to frame_profiler_output at exit
+frame_profiler = False
+frame_profiler_history = 1000
+frame_profiler_output = None
 
 debug_jump = False
 
@@ -225,6 +264,8 @@ query_color = LColor(0.7, 0.7, 1.0, 1.0)
 query_delay = 0.333
 query_text_size = 18
 query_suggestion_text_size = 12
+#Maximum number of ranked suggestions returned by the object search
+query_max_results = 100
 
 default_window_width = 800
 default_window_height = 600
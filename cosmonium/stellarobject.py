@@ -102,8 +102,12 @@ class StellarObject(LabelledObject):
     has_resolved_halo = False
     virtual_object = False
     support_offset_body_center = True
+    deferred_factory = None
+    #Cell of the array octree holding the object, set when the arrays of the cell are built
+    octree_cell = None
     background = False
     nb_update = 0
+    nb_update_skipped = 0
     nb_obs = 0
     nb_visibility = 0
     nb_instance = 0
@@ -164,6 +168,13 @@ class StellarObject(LabelledObject):
         self.init_annotations = False
         self.init_components = False
         self.update_frozen = False
+        #Temporal coherence of the updates
+        self.last_update_time = None
+        self.last_local_position = None
+        self.update_velocity = None
+        self.update_acceleration = None
+        self.update_interval = 0.0
+        self.nb_skipped_updates = 0
         #TODO: Should be done properly
         self.orbit.body = self
         self.rotation.body = self
@@ -209,6 +220,7 @@ class StellarObject(LabelledObject):
             if self.orbit_object is not None:
                 self.orbit_object.update_user_parameters()
         self.rotation.update_user_parameters()
+        self.reset_update_tracking()
 
     def get_fullname(self, separator='/'):
         if hasattr(self, "primary") and self.primary is not None:
@@ -279,6 +291,7 @@ class StellarObject(LabelledObject):
             self.orbit_object = None
         self.orbit = orbit
         self.orbit.set_body(self)
+        self.reset_update_tracking()
         if self.has_orbit and self.init_annotations:
             self.create_orbit_object()
 
@@ -286,6 +299,7 @@ class StellarObject(LabelledObject):
         self.rotation = rotation
         if self.rotation:
             self.rotation.body = self
+        self.reset_update_tracking()
 
     def find_by_name(self, name, name_up=None):
         if self.is_named(name, name_up):
@@ -343,6 +357,11 @@ class StellarObject(LabelledObject):
     def get_abs_magnitude(self):
         return 99.0
 
+    def octree_leaf_changed(self):
+        #Must be called when the extend or the magnitude of the object is modified once in the octree
+        if self.octree_cell is not None:
+            self.octree_cell.leaf_changed()
+
     def get_app_magnitude(self):
         if self.distance_to_obs != None and self.distance_to_obs > 0:
             return abs_to_app_mag(self.get_abs_magnitude(), self.distance_to_obs)
@@ -440,7 +459,59 @@ class StellarObject(LabelledObject):
     def first_update(self, time):
         self.update(time, 0)
 
+    def reset_update_tracking(self):
+        self.last_update_time = None
+        self.update_velocity = None
+        self.update_acceleration = None
+        self.update_interval = 0.0
+
+    def can_skip_update(self, time):
+        """Check if the position extrapolated from the last full update is within the error budget, in pixels.
+        Resolved and selected bodies are always updated."""
+        if self.last_update_time is None or self.resolved or self.selected: return False
+        if self.nb_skipped_updates >= settings.update_max_skip: return False
+        delta = time - self.last_update_time
+        if delta == 0.0: return True
+        if self.update_acceleration is None or not self.distance_to_obs: return False
+        delta = abs(delta)
+        #Bound of the error of a linear extrapolation from the mean velocity of the last interval,
+        #the quadratic extrapolation done in skip_update() is usually much better
+        error = 0.5 * self.update_acceleration.length() * delta * (delta + abs(self.update_interval))
+        return error < settings.update_error_budget * self.distance_to_obs * self.context.observer.pixel_size
+
+    def track_update(self, time):
+        if self.last_update_time is not None:
+            delta = time - self.last_update_time
+            if delta != 0.0:
+                velocity = (self._local_position - self.last_local_position) / delta
+                #Mean velocities are known at the middle of their intervals
+                interval = (self.update_interval + delta) / 2.0
+                if self.update_velocity is not None and interval != 0.0:
+                    self.update_acceleration = (velocity - self.update_velocity) / interval
+                else:
+                    self.update_acceleration = None
+                self.update_velocity = velocity
+                self.update_interval = delta
+        self.last_update_time = time
+        self.last_local_position = LPoint3d(self._local_position)
+        self.nb_skipped_updates = 0
+
+    def skip_update(self, time, dt):
+        StellarObject.nb_update_skipped += 1
+        self.nb_skipped_updates += 1
+        delta = time - self.last_update_time
+        if delta != 0.0:
+            #Orientation and distance to the star are kept from the last full update
+            acceleration = self.update_acceleration
+            velocity = self.update_velocity + acceleration * (self.update_interval / 2.0)
+            self._local_position = self.last_local_position + velocity * delta + acceleration * (delta * delta / 2.0)
+            self._position = self._global_position + self._local_position
+        CompositeObject.update(self, time, dt)
+
     def update(self, time, dt):
+        if settings.coherent_update and self.can_skip_update(time):
+            self.skip_update(time, dt)
+            return
         StellarObject.nb_update += 1
         self._orientation = self.rotation.get_rotation_at(time)
         self._equatorial = self.rotation.get_equatorial_orientation_at(time)
@@ -449,6 +520,8 @@ class StellarObject(LabelledObject):
         self._position = self._global_position + self._local_position
         if self.star is not None:
             (self.vector_to_star, self.distance_to_star) = self.calc_local_distance_to(self.star.get_local_position())
+        if settings.coherent_update:
+            self.track_update(time)
         CompositeObject.update(self, time, dt)
         self.update_frozen = not self.resolved and not (self.orbit.dynamic or self.rotation.dynamic)
 
@@ -477,6 +550,8 @@ class StellarObject(LabelledObject):
             self.visible_size = 0.0
         self._app_magnitude = self.get_app_magnitude()
         self.resolved = self.visible_size > settings.min_body_size
+        if self.resolved and self.deferred_factory is not None:
+            self.create_deferred()
         if not self.visibility_override:
             if self.resolved:
                 radius = self.get_extend()
@@ -499,6 +574,11 @@ class StellarObject(LabelledObject):
             self.context.add_visible(self)
         LabelledObject.check_visibility(self, pixel_size)
 
+    def create_deferred(self):
+        factory = self.deferred_factory
+        self.deferred_factory = None
+        factory.create(self)
+
     def check_and_update_instance(self, camera_pos, camera_rot, pointset):
         StellarObject.nb_instance += 1
         if self.support_offset_body_center and self.visible and self.resolved and settings.offset_body_center:
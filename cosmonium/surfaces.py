@@ -24,6 +24,7 @@ from .shapes import ShapeObject
 from .shadows import SphereShadowCaster, CustomShadowMapShadowCaster
 
 from math import floor, ceil
+import numpy
 
 class SurfaceCategory(object):
     def __init__(self, name):
@@ -96,6 +97,9 @@ class Surface(ShapeObject):
     def get_height_patch(self, patch, u, v):
         raise NotImplementedError
 
+    def get_heights_patch(self, patch, us, vs):
+        return numpy.array([self.get_height_patch(patch, u, v) for (u, v) in zip(us, vs)], dtype=numpy.float64)
+
     def get_normals_at(self, x, y):
         coord = self.shape.global_to_shape_coord(x, y)
         return self.shape.get_normals_at(coord)
@@ -107,6 +111,9 @@ class FlatSurface(Surface):
     def get_height_patch(self, patch, u, v):
         return self.owner.get_apparent_radius()
 
+    def get_heights_patch(self, patch, us, vs):
+        return numpy.full(len(us), self.owner.get_apparent_radius())
+
 class MeshSurface(Surface):
     def is_flat(self):
         return False
@@ -250,6 +257,23 @@ class HeightmapSurface(ProceduralSurface):
         h_11 = heightmap.get_height(x1, y1)
         return h_00 + (h_10 - h_00) * dx + (h_01 - h_00) * dy + (h_00 + h_11 - h_01 - h_10) * dx * dy
 
+    def get_mesh_heights_uv(self, heightmap, us, vs, density):
+        x = us * density
+        y = vs * density
+        x0 = numpy.floor(x) / density * heightmap.width
+        y0 = numpy.floor(y) / density * heightmap.height
+        x1 = numpy.ceil(x) / density * heightmap.width
+        y1 = numpy.ceil(y) / density * heightmap.height
+        dx = us * heightmap.width - x0
+        dx = numpy.where(x1 != x0, dx / numpy.where(x1 != x0, x1 - x0, 1.0), dx)
+        dy = vs * heightmap.height - y0
+        dy = numpy.where(y1 != y0, dy / numpy.where(y1 != y0, y1 - y0, 1.0), dy)
+        h_00 = heightmap.get_heights(x0, y0)
+        h_01 = heightmap.get_heights(x0, y1)
+        h_10 = heightmap.get_heights(x1, y0)
+        h_11 = heightmap.get_heights(x1, y1)
+        return h_00 + (h_10 - h_00) * dx + (h_01 - h_00) * dy + (h_00 + h_11 - h_01 - h_10) * dx * dy
+
     def get_height_patch(self, patch, u, v, recursive=False):
         if not self.displacement:
             return self.radius
@@ -269,3 +293,23 @@ class HeightmapSurface(ProceduralSurface):
             h = heightmap.get_height_uv(u, v)
         height = h * self.height_scale + self.heightmap_base
         return height
+
+    def get_heights_patch(self, patch, us, vs):
+        us = numpy.asarray(us, dtype=numpy.float64)
+        vs = numpy.asarray(vs, dtype=numpy.float64)
+        if not self.displacement:
+            return numpy.full(len(us), self.radius)
+        heightmap = self.heightmap.get_heightmap(patch)
+        while heightmap is None and patch is not None:
+            patch = patch.parent
+            heightmap = self.heightmap.get_heightmap(patch)
+            us = us / 2.0
+            vs = vs / 2.0
+        if heightmap is None:
+            print("No heightmap")
+            return numpy.full(len(us), self.radius)
+        if self.follow_mesh:
+            h = self.get_mesh_heights_uv(heightmap, us, vs, patch.density)
+        else:
+            h = heightmap.get_heights_uv(us, vs)
+        return h * self.height_scale + self.heightmap_base
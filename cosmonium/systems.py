@@ -150,6 +150,7 @@ class StellarSystem(StellarObject):
             orbit_size = child.orbit.get_apparent_radius()
             if orbit_size > self._extend:
                 self._extend = orbit_size
+                self.octree_leaf_changed()
         #TODO: Calc consolidated abs magnitude here
 
     def remove_child_fast(self, child):
@@ -171,7 +172,9 @@ class StellarSystem(StellarObject):
                 size += child.orbit.get_apparent_radius()
             if size > extend:
                 extend = size
-        self._extend = extend
+        if extend != self._extend:
+            self._extend = extend
+            self.octree_leaf_changed()
 
     def recalc_recursive(self):
         for child in self.children:
@@ -272,6 +275,7 @@ class SimpleSystem(StellarSystem):
             self.body_class = primary.body_class
             if not self.star_system:
                 self.abs_magnitude = self.primary.get_abs_magnitude()
+                self.octree_leaf_changed()
             self.point_color = primary.point_color
 
     def add_child(self, child):
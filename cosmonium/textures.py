@@ -27,7 +27,10 @@ from .dircontext import defaultDirContext
 from .utils import TransparencyBlend
 from . import workers
 from . import settings
+from . import pstats
 
+from collections import OrderedDict
+import weakref
 import os
 
 class TexCoord(object):
@@ -577,11 +580,103 @@ class HeightMapTexture(DataTexture):
     def get_default_color(self):
         return (0, 0, 0, 0)
 
+class TextureCacheEntry(object):
+    __slots__ = ['texture', 'texture_size', 'lod', 'patch_ref', 'memory']
+
+    def __init__(self, texture, texture_size, lod, patch, memory):
+        self.texture = texture
+        self.texture_size = texture_size
+        self.lod = lod
+        self.patch_ref = weakref.ref(patch)
+        self.memory = memory
+
+    def is_pinned(self):
+        patch = self.patch_ref()
+        return patch is not None and patch.instance is not None
+
+class TextureCache(object):
+    """LRU cache of the patch textures, bounded by a memory budget in bytes.
+    Textures used by a patch which currently has an instance are pinned and never evicted."""
+    def __init__(self, max_size=None):
+        self.entries = OrderedDict()
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_max_size(self):
+        if self.max_size is not None:
+            return self.max_size
+        return settings.texture_cache_size
+
+    def estimate_memory(self, texture):
+        try:
+            return texture.estimate_texture_memory()
+        except AttributeError:
+            return texture.get_x_size() * texture.get_y_size() * texture.get_num_components()
+
+    def contains(self, key):
+        return key in self.entries
+
+    def get(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.update_stats()
+        return entry
+
+    def peek(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, texture, texture_size, lod, patch):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.memory
+        entry = TextureCacheEntry(texture, texture_size, lod, patch, self.estimate_memory(texture))
+        self.entries[key] = entry
+        self.size += entry.memory
+        self.evict()
+        self.update_stats()
+        return entry
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry.memory
+
+    def evict(self):
+        max_size = self.get_max_size()
+        if self.size <= max_size: return
+        for key in list(self.entries.keys()):
+            entry = self.entries[key]
+            if entry.is_pinned(): continue
+            del self.entries[key]
+            self.size -= entry.memory
+            self.evictions += 1
+            if self.size <= max_size: break
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def update_stats(self):
+        pstats.levelpstat('hits', 'Textures').set_level(self.hits)
+        pstats.levelpstat('misses', 'Textures').set_level(self.misses)
+        pstats.levelpstat('evictions', 'Textures').set_level(self.evictions)
+        pstats.levelpstat('memory', 'Textures').set_level(self.size)
+
+textureCache = TextureCache()
+
 class VirtualTextureSource(TextureSource):
     cached = False
     def __init__(self, root, ext, size, attribution=None, context=defaultDirContext):
         TextureSource.__init__(self, attribution)
-        self.map_patch = {}
+        self.cache = textureCache
+        self.cache_id = None
         self.root = root
         self.ext = ext
         self.texture_size = size
@@ -601,27 +696,60 @@ class VirtualTextureSource(TextureSource):
 
     def can_split(self, patch):
         tex_name = self.child_texture_name(patch)
-        exists = os.path.isfile(tex_name)
+        exists = self.context.file_exists(tex_name)
         return exists
 
+    def get_cache_id(self):
+        #The texture names are relative to the texture paths of the context, they are part of the identity of the source
+        if self.cache_id is None:
+            self.cache_id = (self.texture_size, tuple(self.context.category_paths['textures']))
+        return self.cache_id
+
+    def cache_key(self, patch):
+        #Keyed by the name of the texture file, so a source created again for the same files reuses the cached tiles
+        return (self.get_cache_id(), self.texture_name(patch))
+
+    def find_cached_ancestor(self, patch):
+        parent_patch = patch.parent
+        while parent_patch is not None:
+            entry = self.cache.peek(self.cache_key(parent_patch))
+            if entry is not None:
+                return entry
+            parent_patch = parent_patch.parent
+        return None
+
+    def load_priority(self, patch):
+        #The larger the patch appears on screen, the sooner its texture is loaded.
+        #Non patched textures use the default priority 0 and are always loaded first
+        apparent_size = getattr(patch, 'apparent_size', None)
+        if apparent_size:
+            return 1.0 / apparent_size
+        else:
+            return float(patch.lod + 1)
+
+    def is_patch_attached(self, patch):
+        #A merged patch is detached from its parent, its texture is no longer needed
+        while patch.parent is not None:
+            patch = patch.parent
+        return patch.lod == 0
+
     def texture_loaded_cb(self, texture, patch, callback, cb_args):
         if texture is not None:
-            self.map_patch[patch.str_id()] = (texture, self.texture_size, patch.lod)
+            self.cache.add(self.cache_key(patch), texture, self.texture_size, patch.lod, patch)
             if callback is not None:
                 callback(texture, self.texture_size, patch.lod, *cb_args)
         else:
-            parent_patch = patch.parent
-            while parent_patch is not None and parent_patch.str_id() not in self.map_patch:
-                parent_patch = parent_patch.parent
-            if parent_patch is not None:
+            entry = self.find_cached_ancestor(patch)
+            if entry is not None:
                 if callback is not None:
-                    callback(*(self.map_patch[parent_patch.str_id()] + cb_args))
+                    callback(entry.texture, entry.texture_size, entry.lod, *cb_args)
             else:
                 if callback is not None:
                     callback(None, self.texture_size, patch.lod, *cb_args)
 
     def load(self, patch, color_space=None, callback=None, cb_args=()):
-        if not patch.str_id() in self.map_patch:
+        entry = self.cache.get(self.cache_key(patch))
+        if entry is None:
             tex_name = self.texture_name(patch)
             filename = self.context.find_texture(tex_name)
             alpha_tex_name = self.alpha_texture_name(patch)
@@ -631,23 +759,20 @@ class VirtualTextureSource(TextureSource):
                     texture = workers.syncTextureLoader.load_texture(filename, alpha_filename)
                     self.texture_loaded_cb(texture, patch, callback, cb_args)
                 else:
-                    workers.asyncTextureLoader.load_texture(filename, alpha_filename, self.texture_loaded_cb, (patch, callback, cb_args))
+                    workers.asyncTextureLoader.load_texture(filename, alpha_filename, self.texture_loaded_cb, (patch, callback, cb_args),
+                                                            self.load_priority(patch), lambda: self.is_patch_attached(patch))
             else:
                 print("File", tex_name, "not found")
                 self.texture_loaded_cb(None, patch, callback, cb_args)
         else:
-            callback(*(self.map_patch[patch.str_id()] + cb_args))
+            if callback is not None:
+                callback(entry.texture, entry.texture_size, entry.lod, *cb_args)
 
     def get_texture(self, patch, strict=False):
-        if patch.str_id() in self.map_patch:
-            return self.map_patch[patch.str_id()]
-        elif not strict:
-            parent_patch = patch.parent
-            while parent_patch is not None and parent_patch.str_id() not in self.map_patch:
-                parent_patch = parent_patch.parent
-            if parent_patch is not None:
-                return self.map_patch[parent_patch.str_id()]
-            else:
-                return (None, self.texture_size, patch.lod)
+        entry = self.cache.peek(self.cache_key(patch))
+        if entry is None and not strict:
+            entry = self.find_cached_ancestor(patch)
+        if entry is not None:
+            return (entry.texture, entry.texture_size, entry.lod)
         else:
             return (None, self.texture_size, patch.lod)
@@ -843,9 +843,7 @@ class Gui(object):
         return result
 
     def list_objects(self, prefix):
-        result = objectsDB.startswith(prefix)
-        result.sort(key=lambda x: x[0])
-        return result
+        return objectsDB.search(prefix, settings.query_max_results)
 
     def open_find_object(self):
         self.query.open_query(self)
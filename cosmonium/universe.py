@@ -26,17 +26,27 @@ from .astro.orbits import FixedOrbit
 from .astro.rotations import FixedRotation
 from .astro.astro import app_to_abs_mag
 from .astro.frame import AbsoluteReferenceFrame
+from .astro.ephemeris import EphemerisBatch
 from .astro import units
 
 from .foundation import CompositeObject
 from .systems import StellarSystem
-from .octree import OctreeNode, OctreeLeaf, InfiniteFrustum, VisibleObjectsTraverser, hasOctreeLeaf
+from .catalogs import StarCatalogLeaf, objectsDB
+from .octree import OctreeNode, OctreeLeaf, InfiniteFrustum, VisibleObjectsTraverser, CoherentVisibleObjectsTraverser, hasOctreeLeaf
+from .octreecache import OctreeCache
 from .pstats import pstat
+from . import pstats
+from . import settings
 
 from math import sqrt
 from time import time
+import numpy
 
 class Universe(StellarSystem):
+    #Number of frames a cell of the coherent traversal is kept in the cache without being visited
+    cells_cache_max_age = 300
+    cells_cache_prune_interval = 60
+
     def __init__(self, context):
         StellarSystem.__init__(self, ['Universe'], [],
                                orbit=FixedOrbit(frame=AbsoluteReferenceFrame()),
@@ -56,11 +66,19 @@ class Universe(StellarSystem):
         self.to_update = []
         self.to_update_extra = []
         self.to_remove = []
+        self.octree_cells_cache = {}
+        self.ephemeris_batch = EphemerisBatch()
+        self.visited_cells = []
+        self.nb_cells_revisited = 0
+        self.nb_cells_reused = 0
         self.nb_cells = 0
         self.nb_leaves = 0
         self.nb_leaves_in_cells = 0
         self.dump_octree = False
         self.dump_octree_stats = False
+        self.star_catalogs = []
+        self.octree_build_time = None
+        self.octree_load_time = None
         #TODO: Temporary until non physical objects, like cockpit and annotations are properly managed
         self.scene_position = LPoint3d(0, 0, 0)
         self.scene_orientation = LQuaterniond()
@@ -79,11 +97,65 @@ class Universe(StellarSystem):
     def dumpOctreeStats(self):
         self.dump_octree_stats = not self.dump_octree_stats
 
+    def add_star_catalog(self, catalog):
+        catalog.set_parent(self)
+        self.star_catalogs.append(catalog)
+        objectsDB.add_catalog(catalog)
+
+    def find_by_name(self, name, name_up=None):
+        if name_up is None:
+            name_up = name.upper()
+        found = StellarSystem.find_by_name(self, name, name_up)
+        if found is None:
+            for catalog in self.star_catalogs:
+                found = catalog.find_by_name(name_up)
+                if found is not None: break
+        return found
+
+    def collect_octree_leaves(self):
+        objects = []
+        positions = []
+        magnitudes = []
+        extends = []
+        for child in self.children:
+            objects.append(child)
+            positions.append(tuple(child.get_global_position()))
+            magnitudes.append(child.get_abs_magnitude())
+            extends.append(child.get_extend())
+        positions = [numpy.array(positions, dtype=float).reshape(-1, 3)]
+        magnitudes = [numpy.array(magnitudes, dtype=float)]
+        extends = [numpy.array(extends, dtype=float)]
+        for catalog in self.star_catalogs:
+            objects += catalog.create_leaves()
+            positions.append(catalog.positions)
+            magnitudes.append(catalog.abs_magnitudes)
+            extends.append(catalog.extends)
+        return (objects, numpy.concatenate(positions), numpy.concatenate(magnitudes), numpy.concatenate(extends))
+
+    def build_octree(self, objects, positions, magnitudes, extends):
+        for (i, obj) in enumerate(objects):
+            self.octree.add(OctreeLeaf(obj, LPoint3d(*positions[i]), float(magnitudes[i]), float(extends[i])))
+
     def create_octree(self):
         print("Creating octree...")
         start = time()
-        for child in self.children:
-            self.octree.add(OctreeLeaf(child, child.get_global_position(), child.get_abs_magnitude(), child.get_extend()))
+        (objects, positions, magnitudes, extends) = self.collect_octree_leaves()
+        #The C++ octree can only be created by adding the leaves
+        if settings.cache_octree and not hasOctreeLeaf:
+            octree_cache = OctreeCache()
+            key = octree_cache.calc_key(self.octree, positions, magnitudes, extends)
+            load_start = time()
+            if octree_cache.load(self.octree, key, objects):
+                self.octree_load_time = time() - load_start
+                print("Octree loaded from cache, load time:", self.octree_load_time)
+            else:
+                build_start = time()
+                self.build_octree(objects, positions, magnitudes, extends)
+                self.octree_build_time = time() - build_start
+                print("Octree build time:", self.octree_build_time)
+                octree_cache.store(self.octree, key, objects)
+        else:
+            self.build_octree(objects, positions, magnitudes, extends)
         end = time()
         print("Creation time:", end - start)
 
@@ -94,34 +166,68 @@ class Universe(StellarSystem):
         mat = self.context.camera.getMat()
         bh = self.context.observer.realCamLens.make_bounds()
         f = InfiniteFrustum(bh, mat, pos)
-        t = VisibleObjectsTraverser(f, limit, self.update_id)
-        self.octree.traverse(t)
-        self.to_update_leaves = t.get_leaves()
-        self.to_remove = []
-        if hasOctreeLeaf:
-            self.to_update = list(map(lambda x: x.get_object(), self.to_update_leaves))
-            for old in self.previous_leaves:
-                if old.get_update_id() != self.update_id:
-                    self.to_remove.append(old.get_object())
+        if settings.octree_coherent_traversal and CoherentVisibleObjectsTraverser is not None:
+            self.build_octree_cells_list_coherent(f, limit)
         else:
-            self.to_update = self.to_update_leaves
-            for old in self.previous_leaves:
-                if old.update_id != self.update_id:
-                    self.to_remove.append(old)
+            t = VisibleObjectsTraverser(f, limit, self.update_id)
+            self.octree.traverse(t)
+            self.to_update_leaves = t.get_leaves()
+            self.to_remove = []
+            if hasOctreeLeaf:
+                self.to_update = list(map(lambda x: x.get_object(), self.to_update_leaves))
+                for old in self.previous_leaves:
+                    if old.get_update_id() != self.update_id:
+                        self.to_remove.append(old.get_object())
+            else:
+                self.to_update = self.to_update_leaves
+                for old in self.previous_leaves:
+                    if old.update_id != self.update_id:
+                        self.to_remove.append(old)
+        if len(self.star_catalogs) > 0:
+            self.resolve_catalog_leaves()
         self.octree_cells_to_clean = []
         self.to_update_extra = []
-#         cells = pstats.levelpstat('cells')
-#         leaves = pstats.levelpstat('leaves')
-#         cleans = pstats.levelpstat('cleans')
-#         visibles = pstats.levelpstat('visibles')
-#         in_cells = pstats.levelpstat('in_cells')
-#         in_view = pstats.levelpstat('in_view')
-#         cells.set_level(self.nb_cells)
-#         leaves.set_level(self.nb_leaves_in_cells)
-#         cleans.set_level(len(self.octree_cells_to_clean))
-#         visibles.set_level(len(self.to_update))
-#         in_cells.set_level(self.in_cells)
-#         in_view.set_level(self.in_view)
+        pstats.levelpstat('visibles', 'Octree').set_level(len(self.to_update))
+        pstats.levelpstat('removed', 'Octree').set_level(len(self.to_remove))
+
+    def build_octree_cells_list_coherent(self, frustum, limit):
+        t = CoherentVisibleObjectsTraverser(frustum, limit, self.update_id, self.octree_cells_cache)
+        self.octree.traverse(t)
+        self.to_update_leaves = t.get_leaves()
+        self.to_update = self.to_update_leaves
+        self.to_remove = t.removed_leaves
+        #The leaves of the cells no longer visited are all leaving the visible set
+        for cell in self.visited_cells:
+            entry = self.octree_cells_cache.get(cell)
+            if entry is not None and entry.update_id != self.update_id:
+                self.to_remove += entry.leaves
+        self.visited_cells = t.visited_cells
+        self.nb_cells_revisited = t.nb_cells_revisited
+        self.nb_cells_reused = t.nb_cells_reused
+        if self.update_id % self.cells_cache_prune_interval == 0:
+            self.prune_octree_cells_cache()
+        pstats.levelpstat('cells_revisited', 'Octree').set_level(self.nb_cells_revisited)
+        pstats.levelpstat('cells_reused', 'Octree').set_level(self.nb_cells_reused)
+        pstats.levelpstat('cells_cached', 'Octree').set_level(len(self.octree_cells_cache))
+
+    def prune_octree_cells_cache(self):
+        #Forget the cells not visited recently, they will be tested again if they are visited
+        min_update_id = self.update_id - self.cells_cache_max_age
+        cache = self.octree_cells_cache
+        for cell in [cell for (cell, entry) in cache.items() if entry.update_id < min_update_id]:
+            del cache[cell]
+
+    def resolve_catalog_leaves(self):
+        #Replace the catalog leaves by the actual star, the star is created if it becomes visible
+        #and ignored if it is no longer visible and was never created
+        self.to_update = [x.get_object() if isinstance(x, StarCatalogLeaf) else x for x in self.to_update]
+        to_remove = []
+        for old in self.to_remove:
+            if isinstance(old, StarCatalogLeaf):
+                old = old.get_created_object()
+                if old is None: continue
+            to_remove.append(old)
+        self.to_remove = to_remove
 
     def first_update(self):
         CompositeObject.update(self, self.context.time.time_full, 0)
@@ -138,7 +244,25 @@ class Universe(StellarSystem):
             if extra is not None and extra not in self.to_update_extra:
                 self.to_update_extra.append(extra)
 
+    def add_to_ephemeris_batch(self, batch, body, time):
+        #Same condition as in StellarObject.update()
+        if not settings.coherent_update or not body.can_skip_update(time):
+            batch.add_body(body)
+        #Same condition as in StellarSystem.update()
+        if isinstance(body, StellarSystem) and body.visible and body.resolved:
+            for child in body.children:
+                self.add_to_ephemeris_batch(batch, child, time)
+
+    def update_ephemeris(self, time):
+        self.ephemeris_batch.clear()
+        for leaf in self.to_update:
+            if isinstance(leaf, StellarSystem) or not leaf.update_frozen:
+                self.add_to_ephemeris_batch(self.ephemeris_batch, leaf, time)
+        self.ephemeris_batch.evaluate(time)
+
     def update(self, time, dt):
+        if settings.batch_ephemeris:
+            self.update_ephemeris(time)
         for leaf in self.to_update:
             if isinstance(leaf, StellarSystem):
                 #print("Update system", leaf.get_name())
@@ -26,6 +26,9 @@ from panda3d.core import ColorBlendAttrib, TransparencyAttrib
 from . import settings
 from .astro import units
 
+import os
+import sys
+
 def join_names(names):
     return ' / '.join(names)
 
@@ -69,6 +72,21 @@ def LQuaternionromAxisAngle(axis, angle, angle_units=units.Rad):
 def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
     return abs(a-b) <= max(rel_tol * max(abs(a), abs(b)), abs_tol)
 
+def get_rss():
+    """Return the resident set size of the process in bytes, or 0 if unknown"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        #Peak RSS, in kilobytes on Linux and in bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if sys.platform == 'darwin' else rss * 1024
+    except ImportError:
+        return 0
+
 class TransparencyBlend:
     TB_None = 0
     TB_Alpha = 1
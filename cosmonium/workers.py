@@ -22,10 +22,16 @@ from __future__ import print_function
 from panda3d.core import Texture, Filename
 from direct.task.Task import Task
 
+from . import settings
+from . import pstats
+from .pstats import named_pstat
+
 try:
     import queue
 except ImportError:
     import Queue as queue
+from itertools import count
+from time import time
 import traceback
 
 # These will be initialized in cosmonium base class
@@ -66,39 +72,80 @@ class AsyncMethod():
             self.callback()
             return task.done
 
+class AsyncJob(object):
+    __slots__ = ['func', 'fargs', 'callback', 'cb_args', 'priority', 'is_valid', 'submit_time', 'cancelled']
+
+    def __init__(self, func, fargs, callback, cb_args, priority, is_valid):
+        self.func = func
+        self.fargs = fargs
+        self.callback = callback
+        self.cb_args = cb_args
+        self.priority = priority
+        self.is_valid = is_valid
+        self.submit_time = time()
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def is_cancelled(self):
+        if not self.cancelled and self.is_valid is not None and not self.is_valid():
+            self.cancelled = True
+        return self.cancelled
+
 class AsyncLoader():
-    def __init__(self, base, name):
+    """Pool of worker threads processing the jobs by priority, the lowest value first.
+    Jobs are processed in submission order when they have the same priority."""
+    #Maximum time a worker thread blocks waiting for a new job
+    wait_timeout = 0.05
+
+    def __init__(self, base, name, nb_threads=None):
         self.base = base
-        self.in_queue = queue.Queue()
+        self.name = name
+        if nb_threads is None:
+            nb_threads = settings.loader_threads
+        self.nb_threads = max(1, nb_threads)
+        self.in_queue = queue.PriorityQueue()
         self.cb_queue = queue.Queue()
+        self.job_count = count()
+        self.nb_cancelled = 0
+        self.last_latency = 0.0
         self.base.taskMgr.setupTaskChain(name,
-                                         numThreads = 1,
+                                         numThreads = self.nb_threads,
                                          tickClock = False,
                                          threadPriority = None,
                                          frameBudget = -1,
                                          frameSync = False,
                                          timeslicePriority = True)
 
-        self.process_task = self.base.taskMgr.add(self.processTask, name + 'ProcessTask', taskChain=name)
+        #A task can only be run by one thread at a time, so one task is needed per thread
+        self.process_tasks = []
+        for i in range(self.nb_threads):
+            task = self.base.taskMgr.add(self.processTask, name + 'ProcessTask%d' % i, taskChain=name)
+            self.process_tasks.append(task)
         self.callback_task = self.base.taskMgr.add(self.callbackTask, name + 'CallbackTask')
 
     def remove(self):
-        self.base.taskMgr.remove(self.process_task)
-        self.process_task = None
+        for task in self.process_tasks:
+            self.base.taskMgr.remove(task)
+        self.process_tasks = []
         self.base.taskMgr.remove(self.callback_task)
         self.callback_task = None
 
-    def add_job(self, func, fargs, callback, cb_args):
-        job = [func, fargs, callback, cb_args]
-        self.in_queue.put(job)
+    def add_job(self, func, fargs, callback, cb_args, priority=0, is_valid=None):
+        job = AsyncJob(func, fargs, callback, cb_args, priority, is_valid)
+        self.in_queue.put((priority, next(self.job_count), job))
+        return job
 
     def processTask(self, task):
         try:
-            #A small but not null timeout is required to avoid draining CPU resources
-            job = self.in_queue.get(timeout=0.001)
-            (func, fargs, callback, cb_args) = job
-            result = func(*fargs)
-            self.cb_queue.put([callback, result, cb_args])
+            (priority, index, job) = self.in_queue.get(timeout=self.wait_timeout)
+            if job.is_cancelled():
+                #The cancelled jobs are counted by the callback task, so only the main thread updates the counter
+                self.cb_queue.put([job, None])
+            else:
+                result = job.func(*job.fargs)
+                self.cb_queue.put([job, result])
         except queue.Empty:
             pass
         return Task.cont
@@ -106,23 +153,33 @@ class AsyncLoader():
     def callbackTask(self, task):
         try:
             while True:
-                job = self.cb_queue.get_nowait()
-                (callback, result, cb_args) = job
-                callback(result, *cb_args)
+                (job, result) = self.cb_queue.get_nowait()
+                self.last_latency = time() - job.submit_time
+                if not job.is_cancelled():
+                    job.callback(result, *job.cb_args)
+                else:
+                    self.nb_cancelled += 1
         except queue.Empty:
             pass
+        self.update_stats()
         return Task.cont
 
+    def update_stats(self):
+        pstats.levelpstat('queue', self.name).set_level(self.in_queue.qsize())
+        pstats.levelpstat('latency', self.name).set_level(self.last_latency * 1000)
+        pstats.levelpstat('cancelled', self.name).set_level(self.nb_cancelled)
+
 class AsyncTextureLoader(AsyncLoader):
     def __init__(self, base):
         AsyncLoader.__init__(self, base, 'TextureLoader')
 
-    def load_texture(self, filename, alpha_filename, callback, args):
-        self.add_job(self.do_load_texture, [filename, alpha_filename], callback, args)
+    def load_texture(self, filename, alpha_filename, callback, args, priority=0, is_valid=None):
+        return self.add_job(self.do_load_texture, [filename, alpha_filename], callback, args, priority, is_valid)
 
-    def load_texture_array(self, textures, callback, args):
-        self.add_job(self.do_load_texture_array, [textures], callback, args)
+    def load_texture_array(self, textures, callback, args, priority=0, is_valid=None):
+        return self.add_job(self.do_load_texture_array, [textures], callback, args, priority, is_valid)
 
+    @named_pstat("texture_load")
     def do_load_texture(self, filename, alpha_filename):
         tex = Texture()
         panda_filename = Filename.from_os_specific(filename)
@@ -134,6 +191,7 @@ class AsyncTextureLoader(AsyncLoader):
                  primary_file_num_channels=0, alpha_file_channel=0)
         return tex
 
+    @named_pstat("texture_load")
     def do_load_texture_array(self, textures):
         tex = Texture()
         tex.setup_2d_texture_array(len(textures))
@@ -149,6 +207,7 @@ class AsyncTextureLoader(AsyncLoader):
         return tex
 
 class SyncTextureLoader():
+    @named_pstat("texture_load")
     def load_texture(self, filename, alpha_filename=None):
         texture = None
         try:
@@ -162,6 +221,7 @@ class SyncTextureLoader():
             print("Could not load texture", filename)
         return texture
 
+    @named_pstat("texture_load")
     def load_texture_array(self, textures):
         tex = Texture()
         tex.setup_2d_texture_array(len(textures))
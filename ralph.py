@@ -74,6 +74,7 @@ from cosmonium import settings
 
 from math import pow, pi, sqrt
 import argparse
+import numpy
 
 class TileFactory(object):
     def __init__(self, heightmap, tile_density, size, height_scale, has_water, water, has_physics, physics):
@@ -617,6 +618,12 @@ class RoamingRalphDemo(CosmoniumBase):
             height = self.water.level
         return height
 
+    def get_heights_patch(self, patch, us, vs):
+        heights = self.terrain_object.get_heights_patch(patch, us, vs)
+        if self.has_water and self.water.visible:
+            heights = numpy.maximum(heights, self.water.level)
+        return heights
+
     def get_normals_under(self, position):
         return self.terrain_object.get_normals_at(position[0], position[1])
 
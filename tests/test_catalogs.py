@@ -0,0 +1,69 @@
+#
+#This file is part of Cosmonium.
+#
+#Copyright (C) 2018-2019 Laurent Deru.
+#
+#Cosmonium is free software: you can redistribute it and/or modify
+#it under the terms of the GNU General Public License as published by
+#the Free Software Foundation, either version 3 of the License, or
+#(at your option) any later version.
+#
+#Cosmonium is distributed in the hope that it will be useful,
+#but WITHOUT ANY WARRANTY; without even the implied warranty of
+#MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#GNU General Public License for more details.
+#
+#You should have received a copy of the GNU General Public License
+#along with Cosmonium.  If not, see <https://www.gnu.org/licenses/>.
+#
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import unittest
+
+from cosmonium.catalogs import NameIndex
+
+class NameIndexTestCase(unittest.TestCase):
+    def keys(self, matches):
+        return [key for (rank, key, value) in matches]
+
+    def test_readd_after_compact(self):
+        index = NameIndex()
+        index.add('SIRIUS', 1)
+        index.add('SOL', 2)
+        #Removed while still pending, then compacted with the pending names merged
+        index.remove('SIRIUS')
+        index.update()
+        index.add('SIRIUS', 3)
+        self.assertEqual(self.keys(index.startswith('S')), ['SOL', 'SIRIUS'])
+        self.assertEqual(self.keys(index.search('IRI')), ['SIRIUS'])
+        self.assertEqual(index.get('SIRIUS'), 3)
+
+    def test_remove_compact_readd(self):
+        index = NameIndex()
+        for name in ('ALPHA', 'BETA', 'GAMMA', 'DELTA'):
+            index.add(name, name)
+        index.update()
+        index.remove('BETA')
+        index.remove('GAMMA')
+        index.update()
+        self.assertEqual(index.keys, {5: ['ALPHA', 'DELTA']})
+        self.assertEqual(self.keys(index.contains('AMM')), [])
+        index.add('GAMMA', 'GAMMA')
+        index.add('BETA', 'BETA')
+        index.remove('BETA')
+        index.add('BETA', 'BETA')
+        self.assertEqual(self.keys(index.startswith('')), ['BETA', 'ALPHA', 'DELTA', 'GAMMA'])
+        self.assertEqual(index.keys, {4: ['BETA'], 5: ['ALPHA', 'DELTA', 'GAMMA']})
+
+    def test_startswith_limit(self):
+        index = NameIndex()
+        for name in ('HIP 1000', 'HIP 10', 'HIP 1', 'HIP 100', 'HADAR'):
+            index.add(name, name)
+        self.assertEqual(self.keys(index.startswith('HIP 1', 2)), ['HIP 1', 'HIP 10'])
+        self.assertEqual(self.keys(index.startswith('H', 2)), ['HADAR', 'HIP 1'])
+        self.assertEqual(self.keys(index.startswith('H', 2, accept=lambda value: value != 'HADAR')), ['HIP 1', 'HIP 10'])
+
+if __name__ == '__main__':
+    unittest.main()